@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+bench_epg.py
+
+Benchmark dos estagios do epg_generator.py / build_epg_br.py com entradas
+sinteticas (XMLTV + M3U) geradas de forma deterministica (seed fixa).
+
+Estagios medidos separadamente:
+  m3u            : open_m3u + iter_m3u (parser incremental)
+  epg_raw        : parse_external_epg_raw (documento inteiro)
+  epg_stream     : parse_external_epg_stream (iterparse)
+  mapping        : build_mapping (--matcher)
+  final_epg      : build_final_epg
+  filtered_epg   : build_filtered_epg (build_epg_br.py)
+
+Para cada estagio: melhor tempo de --repeat execucoes e pico de memoria Python
+(tracemalloc, numa execucao extra para nao distorcer o tempo).
+
+Uso:
+  python benchmarks/bench_epg.py --size small
+  python benchmarks/bench_epg.py --size medium --save-baseline benchmarks/baseline_medium.json
+  python benchmarks/bench_epg.py --size medium --compare benchmarks/baseline_medium.json
+
+Tamanhos (canais EPG x programas por canal, entradas M3U):
+  tiny   :    200 x 48,   1k entradas
+  small  :  1 000 x 48,   3k entradas
+  medium : 10 000 x 48,  25k entradas
+  large  : 50 000 x 40,  80k entradas (2M programas)
+
+Os arquivos gerados ficam em --workdir (default benchmarks/.data) e sao
+reaproveitados entre execucoes com os mesmos parametros.
+Com --compare, sai com codigo 1 se algum estagio piorar mais que --threshold.
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import gc
+import io
+import json
+import mmap
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import epg_generator as eg  # noqa: E402
+import build_epg_br as br  # noqa: E402
+from fetch_cache import open_bytes, read_bytes  # noqa: E402
+from xmltv_writer import open_xmltv  # noqa: E402
+
+SIZES = {
+    "tiny": {"channels": 200, "programmes": 48, "entries": 1_000},
+    "small": {"channels": 1_000, "programmes": 48, "entries": 3_000},
+    "medium": {"channels": 10_000, "programmes": 48, "entries": 25_000},
+    "large": {"channels": 50_000, "programmes": 40, "entries": 80_000},
+}
+
+BRANDS = [
+    "Globo", "Record", "SBT", "Band", "RedeTV", "TV Cultura", "TV Brasil", "SporTV", "ESPN",
+    "Premiere", "Combate", "Discovery", "Animal Planet", "HBO", "Telecine", "Megapix", "AXN",
+    "Warner", "TNT", "Space", "Cartoon Network", "Disney", "Nickelodeon", "GloboNews", "CNN",
+    "BandNews", "Multishow", "GNT", "Viva", "Canal Brasil", "History", "A&E", "Paramount",
+    "Universal", "Sony", "FX", "Star", "National Geographic", "BBC", "Euronews", "RAI",
+    "TVE", "RTP", "France 24", "DW", "Sky Sports", "Fox", "ABC", "NBC", "CBS",
+]
+REGIONS = [
+    "SP", "RJ", "MG", "BH", "Recife", "Salvador", "Fortaleza", "Belem", "Manaus", "Curitiba",
+    "Porto Alegre", "Florianopolis", "Goiania", "Brasilia", "Campinas", "Nordeste", "Sul",
+    "Minas", "Bahia", "Parana", "US", "UK", "ES", "PT", "IT", "DE", "FR", "Latam",
+]
+QUALITIES = ["", " HD", " FHD", " 4K", " SD", " H265", " ²", " (ALT)"]
+GROUPS = ["ABERTOS", "ESPORTES", "FILMES E SERIES", "NOTICIAS", "INFANTIL", "DOCUMENTARIOS",
+          "REALITY SHOW", "INTERNACIONAIS"]
+TITLE_WORDS = [
+    "Jornal", "Hora", "Noticias", "Futebol", "Campeonato", "Filme", "Serie", "Novela", "Desenho",
+    "Documentario", "Show", "Musica", "Debate", "Entrevista", "Culinaria", "Viagem", "Ciencia",
+    "Historia", "Reality", "Auditorio", "Esporte", "Ao Vivo", "Especial", "Classicos",
+]
+
+# inicio fixo da grade sintetica: arquivos gerados sao reaproveitaveis entre execucoes
+SYNTHETIC_START = dt.datetime(2024, 1, 1, 6, 0, tzinfo=eg.TZ)
+# diferencas de tempo abaixo disso sao ruido de medicao no --compare
+MIN_SECONDS = 0.05
+
+STAGES = ["m3u", "epg_raw", "epg_stream", "mapping", "final_epg", "filtered_epg"]
+
+
+# ---------------- geradores sinteticos ----------------
+
+def synthetic_channels(n, seed=1):
+    """Lista [(epg_id, display_name)] com nomes realistas (marca + regiao + numero)."""
+    rng = random.Random(seed)
+    out = []
+    ids = set()
+    for i in range(n):
+        name = f"{rng.choice(BRANDS)} {rng.choice(REGIONS)}"
+        if rng.random() < 0.3:
+            name = f"{name} {i}"
+        slug = eg.normalize_name(name).replace(" ", "")
+        suffix = ".br" if rng.random() < 0.6 else ".int"
+        cid = slug + suffix
+        if cid in ids:
+            cid = f"{slug}{i}{suffix}"
+        ids.add(cid)
+        out.append((cid, name))
+    return out
+
+
+def write_synthetic_xmltv(path, channels, programmes_per_channel, seed=1, start=None):
+    """Grava um XMLTV com programas consecutivos (30-120 min) por canal, a partir de start."""
+    rng = random.Random(seed)
+    if start is None:
+        start = SYNTHETIC_START
+    titles = [" ".join(rng.sample(TITLE_WORDS, rng.randint(1, 3))) for _ in range(500)]
+    with open_xmltv(path, {"generator-info-name": "bench_epg.py"}) as w:
+        for cid, name in channels:
+            w.write_channel(cid, name, [{"src": f"http://logos.example/{cid}.png"}])
+        for cid, name in channels:
+            t = start
+            for _ in range(programmes_per_channel):
+                stop = t + dt.timedelta(minutes=rng.choice((30, 45, 60, 60, 90, 120)))
+                title = rng.choice(titles)
+                w.write_programme(eg.format_xmltv_datetime(t), eg.format_xmltv_datetime(stop), cid,
+                                  title, f"{title} - {name}. Episodio {rng.randint(1, 300)}.")
+                t = stop
+
+
+def write_synthetic_m3u(path, channels, entries, seed=1):
+    """
+    Grava uma playlist com variantes do mesmo canal (HD/FHD/ALT...) compartilhando
+    tvg-id (duplicados), ~5% de tvg-id vazio, ~5% sem tvg-id e ~15% de canais que
+    nao existem no EPG.
+    """
+    rng = random.Random(seed)
+    lines = ["#EXTM3U"]
+    for i in range(entries):
+        r = rng.random()
+        if r < 0.15:
+            base = f"{rng.choice(BRANDS)} {rng.choice(TITLE_WORDS)} {rng.randint(1, 99)}"
+        else:
+            base = rng.choice(channels)[1]
+            if rng.random() < 0.3:
+                base = base.upper()
+        name = base + rng.choice(QUALITIES)
+        tvg = eg.normalize_name(base).replace(" ", "")
+        r = rng.random()
+        if r < 0.05:
+            attr_id = 'tvg-id="" '
+        elif r < 0.10:
+            attr_id = ""
+        else:
+            attr_id = f'tvg-id="{tvg}" '
+        lines.append(f'#EXTINF:-1 {attr_id}tvg-name="{name}" tvg-logo="http://logos.example/{tvg}.png" '
+                     f'group-title="{rng.choice(GROUPS)}", {name}')
+        lines.append(f"http://stream.example/{i}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def ensure_inputs(workdir, size, seed):
+    """Gera (ou reaproveita) os arquivos sinteticos do tamanho pedido; retorna (m3u, xmltv)."""
+    spec = SIZES[size]
+    os.makedirs(workdir, exist_ok=True)
+    base = os.path.join(workdir, f"{size}-s{seed}")
+    xml_path, m3u_path = f"{base}.xml", f"{base}.m3u"
+    channels = synthetic_channels(spec["channels"], seed)
+    if not os.path.exists(xml_path):
+        print(f"Gerando {xml_path} ({spec['channels']} canais x {spec['programmes']} programas)...")
+        write_synthetic_xmltv(xml_path, channels, spec["programmes"], seed)
+    if not os.path.exists(m3u_path):
+        print(f"Gerando {m3u_path} ({spec['entries']} entradas)...")
+        write_synthetic_m3u(m3u_path, channels, spec["entries"], seed)
+    return m3u_path, xml_path
+
+
+# ---------------- execucao ----------------
+
+def reset_caches():
+    """Zera memos de modulo para cada execucao medir o custo 'a frio'."""
+    eg._TS_CACHE.clear()
+    eg._FMT_CACHE.clear()
+    eg._SHIFT_CACHE.clear()
+
+
+def measure(fn, repeat, memory):
+    """Executa fn() repeat vezes; retorna (resultado, melhor tempo em s, pico MB ou None)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        result = None
+        reset_caches()
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        result = None
+        reset_caches()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = fn()
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+
+def run_stages(m3u_path, xml_path, matcher, repeat, memory, outdir):
+    stages = {}
+
+    def record(name, fn):
+        result, secs, peak = measure(fn, repeat, memory)
+        stages[name] = {"seconds": round(secs, 4), "peak_mb": None if peak is None else round(peak, 2)}
+        mem = "" if peak is None else f"  pico {peak:8.1f} MB"
+        print(f"  {name:<13} {secs:8.3f} s{mem}")
+        return result
+
+    def m3u():
+        with eg.open_m3u(m3u_path) as f:
+            return list(eg.iter_m3u(eg.iter_m3u_lines(f)))
+    m3u_channels = record("m3u", m3u)
+
+    def raw():
+        data = read_bytes(xml_path)
+        try:
+            return eg.parse_external_epg_raw(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    epg_channels, epg_events = record("epg_raw", raw)
+
+    def stream():
+        with open_bytes(xml_path) as f:
+            return eg.parse_external_epg_stream(f)
+    record("epg_stream", stream)
+
+    mapping = record("mapping", lambda: eg.build_mapping(m3u_channels, epg_channels, matcher=matcher))
+    final_out = os.path.join(outdir, "epg.xml")
+    record("final_epg", lambda: eg.build_final_epg(m3u_channels, epg_events, mapping, out_path=final_out))
+    filtered_out = os.path.join(outdir, "epg_br.xml")
+    record("filtered_epg", lambda: br.build_filtered_epg(
+        xml_path, br.KeywordClassifier(br.DEFAULT_KEYWORDS), out_path=filtered_out))
+
+    counts = {
+        "m3u_entries": len(m3u_channels),
+        "epg_channels": len(epg_channels),
+        "programmes": sum(len(v) for v in epg_events.values()),
+        "matched": sum(1 for mid, _ in mapping.values() if mid),
+    }
+    return stages, counts
+
+
+def compare(results, baseline, threshold):
+    """Imprime a variacao por estagio; retorna lista de regressoes acima de threshold."""
+    regressions = []
+    print(f"\nComparacao com baseline ({baseline.get('created', '?')}, limite +{threshold:.0%}):")
+    for name in STAGES:
+        cur, base = results["stages"].get(name), baseline.get("stages", {}).get(name)
+        if not cur or not base:
+            continue
+        parts = []
+        for key, unit in (("seconds", "s"), ("peak_mb", "MB")):
+            if cur.get(key) is None or not base.get(key):
+                continue
+            delta = cur[key] / base[key] - 1
+            flag = ""
+            if delta > threshold and not (key == "seconds" and cur[key] - base[key] < MIN_SECONDS):
+                flag = " REGRESSAO"
+                regressions.append(f"{name}.{key}")
+            parts.append(f"{key} {base[key]:.3f}->{cur[key]:.3f} {unit} ({delta:+.1%}){flag}")
+        print(f"  {name:<13} " + "; ".join(parts))
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--size", choices=list(SIZES), default="small", help="Tamanho das entradas sinteticas")
+    p.add_argument("--seed", type=int, default=1, help="Seed dos geradores (default 1)")
+    p.add_argument("--repeat", type=int, default=3, help="Execucoes por estagio; vale o melhor tempo (default 3)")
+    p.add_argument("--matcher", choices=sorted(eg.MATCHERS), default="indexed", help="Motor do build_mapping")
+    p.add_argument("--no-memory", action="store_true", help="Nao mede pico de memoria (tracemalloc)")
+    p.add_argument("--workdir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data"),
+                   help="Diretorio dos arquivos sinteticos gerados")
+    p.add_argument("--save-baseline", help="Grava os resultados em JSON (baseline para --compare)")
+    p.add_argument("--compare", help="JSON de baseline para comparar")
+    p.add_argument("--threshold", type=float, default=0.2, help="Piora relativa tolerada no --compare (default 0.2)")
+    args = p.parse_args()
+
+    m3u_path, xml_path = ensure_inputs(args.workdir, args.size, args.seed)
+    print(f"Benchmark size={args.size} matcher={args.matcher} repeat={args.repeat}")
+    with tempfile.TemporaryDirectory() as outdir:
+        stages, counts = run_stages(m3u_path, xml_path, args.matcher, max(1, args.repeat),
+                                    not args.no_memory, outdir)
+
+    results = {
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "size": args.size,
+        "seed": args.seed,
+        "matcher": args.matcher,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "counts": counts,
+        "stages": stages,
+    }
+    if resource is not None:
+        # ru_maxrss: KB no Linux, bytes no macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results["max_rss_mb"] = round(rss / (1e6 if sys.platform == "darwin" else 1e3), 1)
+    print("  " + ", ".join(f"{k}={v}" for k, v in counts.items())
+          + (f", max_rss={results['max_rss_mb']} MB" if "max_rss_mb" in results else ""))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+        print(f"Baseline gravado em: {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline.get("size"), baseline.get("matcher")) != (args.size, args.matcher):
+            print("Aviso: baseline com size/matcher diferentes; comparacao pouco significativa")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,15 +15,24 @@ Opcoes:
   --min-kw-matches N      Minimo de keywords que devem aparecer para considerar o canal BR (default 1).
   --use-curl              Forca usar curl para baixar (em vez de requests).
   --preview N             Mostra N canais detectados e sai (sem gravar).
+  --compact               Grava XML sem indentacao.
+  --cache-dir DIR         Cache de downloads com requisicoes condicionais (ETag/Last-Modified).
+  --metrics-json PATH     Grava tempos (parede/CPU), memoria e contadores por estagio em JSON.
 """
 import argparse
 import sys
 import os
 import re
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 from urllib.parse import urlparse
 import subprocess
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from xmltv_writer import open_xmltv
+from fetch_cache import fetch, FetchError, open_bytes, decompressing, response_stream
+from run_metrics import RunMetrics, CountingReader, TimedWriter
 
 try:
     import requests
@@ -43,54 +52,45 @@ DEFAULT_KEYWORDS = [
 TZ_STR = ""  # not used here, kept for compatibility
 
 
-def pretty_xml(elem):
-    rough = ET.tostring(elem, encoding="utf-8")
-    reparsed = minidom.parseString(rough)
-    return reparsed.toprettyxml(indent="  ", encoding="utf-8")
-
-
-def download_text(url, use_curl=False, ua=None):
-    """Retorna o conteúdo (texto) de uma URL ou caminho local."""
+@contextmanager
+def open_source(url, use_curl=False, ua=None):
+    """
+    Abre uma URL ou caminho local como stream binario (para ET.iterparse),
+    sem carregar o documento inteiro em memoria: requests (stream) e, se falhar
+    ou nao estiver instalado, curl via pipe.
+    Fontes gzip/xz (.gz/.xz, Content-Type ou Content-Encoding) sao
+    descompactadas em streaming; arquivo local simples e lido via mmap.
+    """
     ua = ua or "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0"
-    # se for caminho local
     parsed = urlparse(url)
     if parsed.scheme in ("", "file"):
         path = url if parsed.scheme == "" else parsed.path
         if not os.path.exists(path):
             raise FileNotFoundError(f"Arquivo local nao encontrado: {path}")
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            return f.read()
-    # URL
-    if use_curl or requests is None:
-        # usar curl
-        cmd = ["curl", "-sSL", "-A", ua, url]
-        try:
-            out = subprocess.check_output(cmd)
-            return out.decode("utf-8", errors="replace")
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"curl falhou: {e}")
-    else:
+        with open_bytes(path) as f:
+            yield f
+        return
+    if not use_curl and requests is not None:
         try:
-            r = requests.get(url, timeout=60, headers={"User-Agent": ua})
+            r = requests.get(url, timeout=60, headers={"User-Agent": ua}, stream=True)
             r.raise_for_status()
-            return r.text
         except Exception as e:
-            # fallback para curl se requests falhar
-            try:
-                cmd = ["curl", "-sSL", "-A", ua, url]
-                out = subprocess.check_output(cmd)
-                return out.decode("utf-8", errors="replace")
-            except Exception:
-                raise RuntimeError(f"download falhou: {e}")
-
-
-def extract_channels_and_programmes(xml_text):
-    """Parseia XML e retorna root, channels(list), programmes(list)."""
-    # parse
-    root = ET.fromstring(xml_text.encode("utf-8"))
-    channels = root.findall("channel")
-    programmes = root.findall("programme")
-    return root, channels, programmes
+            print(f"requests falhou ({e}); tentando curl")
+        else:
+            with r:
+                yield response_stream(r)
+            return
+    proc = subprocess.Popen(["curl", "-sSL", "--compressed", "-A", ua, url], stdout=subprocess.PIPE)
+    try:
+        yield decompressing(proc.stdout)
+    finally:
+        # leitura interrompida (ex. --preview): encerrar o curl
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        code = proc.wait()
+    if code not in (0, -9):
+        raise RuntimeError(f"curl falhou (exit {code})")
 
 
 def normalize(s):
@@ -102,88 +102,181 @@ def normalize(s):
     return s
 
 
-def is_brazilian_channel(channel_el, keywords, min_kw_matches=1):
+class KeywordClassifier:
     """
-    Decide se um <channel> Element é "brasileiro" por heurística:
-    - olha o id (attribute "id")
-    - olha display-name(s)
-    - conta quantas keywords aparecem (normalizadas)
+    Classificador de canais "brasileiros" compilado uma vez a partir das keywords.
+
+    As keywords sao normalizadas (e deduplicadas) uma unica vez e viram um
+    automato Aho-Corasick; cada string normalizada e percorrida em uma passada,
+    contando as keywords distintas que aparecem como substring (inclusive
+    sobrepostas, ex. 'sportv' -> spor, sportv, tv). O resultado e guardado por
+    id de canal, entao o pre-scan do main e o build_filtered_epg reaproveitam.
     """
-    cid = channel_el.get("id") or ""
-    displays = [d.text or "" for d in channel_el.findall("display-name")]
-    concat = " ".join([cid] + displays)
-    s = normalize(concat)
-
-    matches = 0
-    for kw in keywords:
-        kwn = normalize(kw)
-        if not kwn:
-            continue
-        # match word boundary or substring (some ids like 'globo.sp' or 'globosp' need substring)
-        if re.search(r"\b" + re.escape(kwn) + r"\b", s) or kwn in s:
-            matches += 1
-    return matches >= max(1, min_kw_matches)
 
+    def __init__(self, keywords, min_kw_matches=1):
+        self.keywords = list(dict.fromkeys(k for k in (normalize(kw) for kw in keywords) if k))
+        self.min_kw_matches = max(1, min_kw_matches)
+        self._cache = {}
+        # trie
+        goto, out = [{}], [set()]
+        for idx, kw in enumerate(self.keywords):
+            state = 0
+            for c in kw:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][c] = nxt
+                    goto.append({})
+                    out.append(set())
+                state = nxt
+            out[state].add(idx)
+        # links de falha (BFS)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in goto[state].items():
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(c, 0)
+                out[nxt] |= out[fail[nxt]]
+                queue.append(nxt)
+        self._goto = goto
+        self._fail = fail
+        self._out = [frozenset(o) for o in out]
+
+    def count_hits(self, s, limit=None):
+        """Numero de keywords distintas contidas em s (ja normalizada); para ao atingir limit."""
+        goto, fail, out = self._goto, self._fail, self._out
+        hits = set()
+        state = 0
+        for c in s:
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                hits.update(out[state])
+                if limit and len(hits) >= limit:
+                    break
+        return len(hits)
+
+    def is_brazilian(self, channel_el):
+        """
+        Decide se um <channel> Element é "brasileiro" por heurística:
+        - olha o id (attribute "id")
+        - olha display-name(s)
+        - conta quantas keywords distintas aparecem (normalizadas)
+        """
+        cid = channel_el.get("id") or ""
+        if cid and cid in self._cache:
+            return self._cache[cid]
+        displays = [d.text or "" for d in channel_el.findall("display-name")]
+        s = normalize(" ".join([cid] + displays))
+        result = self.count_hits(s, limit=self.min_kw_matches) >= self.min_kw_matches
+        if cid:
+            self._cache[cid] = result
+        return result
 
-def build_filtered_epg(xml_text, keywords, min_kw_matches=1):
+
+def is_brazilian_channel(channel_el, keywords, min_kw_matches=1):
+    """Atalho para um unico canal; para varios, reutilize um KeywordClassifier."""
+    return KeywordClassifier(keywords, min_kw_matches).is_brazilian(channel_el)
+
+
+def iter_brazilian(source, classifier, metrics=None):
+    """
+    Le o XMLTV fonte uma unica vez (ET.iterparse) e produz ("channel", el) para
+    canais aceitos pelo classifier e ("programme", el) para programas desses
+    canais. Os ids aceitos ficam num set, entao cada programa custa O(1).
+    Cada elemento e liberado depois de consumido pelo chamador, entao a memoria
+    nao depende do tamanho da fonte. Como no XMLTV os <channel> vem antes dos
+    <programme>, programas de canais ainda nao vistos sao descartados.
+    metrics: opcional (RunMetrics); conta canais/programas lidos e acumula o
+    tempo de classificacao no estagio "classify".
+    """
+    br_ids = set()
+    root = None
+    channels_in = programmes_in = 0
+    classify_s = 0.0
+    try:
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == "channel":
+                channels_in += 1
+                cid = elem.get("id")
+                t0 = time.perf_counter()
+                accepted = cid and classifier.is_brazilian(elem)
+                classify_s += time.perf_counter() - t0
+                if accepted:
+                    br_ids.add(cid)
+                    yield "channel", elem
+            elif elem.tag == "programme":
+                programmes_in += 1
+                if elem.get("channel") in br_ids:
+                    yield "programme", elem
+            else:
+                continue
+            elem.clear()
+            root.clear()
+    finally:
+        if metrics is not None:
+            metrics.add_time("classify", classify_s, channels_in)
+            metrics.count("channels_in", channels_in)
+            metrics.count("programmes_in", programmes_in)
+
+
+def build_filtered_epg(source, classifier, out_path="epg_br.xml", indent="  ", metrics=None):
     """
-    Constrói um novo root XML apenas com canais/programas brasileiros.
-    Retorna bytes (utf-8) do XML resultante.
+    Grava em out_path um novo XML apenas com canais/programas brasileiros.
+    source: caminho ou stream binario do XMLTV fonte (lido uma vez, ver iter_brazilian);
+    classifier: KeywordClassifier. Programas aceitos vao direto para o xmltv_writer.
+    metrics: opcional (RunMetrics); tempos de classify/serialize/write e contadores.
+    Retorna o numero de programas copiados.
     """
-    root = ET.fromstring(xml_text.encode("utf-8"))
-    # coletar canais BR
-    channels = root.findall("channel")
-    br_ids = []
-    for ch in channels:
-        if is_brazilian_channel(ch, keywords, min_kw_matches):
-            cid = ch.get("id")
-            if cid:
-                br_ids.append(cid)
-
-    print(f"Channels found in source: {len(channels)}. Brazilian channels matched: {len(br_ids)}")
-
-    # criar novo tv root
-    tv = ET.Element("tv", {
+    root_attrs = {
         "source-info-name": "epg-filter-br",
         "generator-info-name": "build_epg_br.py"
-    })
-
-    # adicionar apenas canais filtrados (com seus display-name)
-    for ch in channels:
-        cid = ch.get("id")
-        if not cid or cid not in br_ids:
-            continue
-        newch = ET.SubElement(tv, "channel", {"id": cid})
-        for dn in ch.findall("display-name"):
-            dn_el = ET.SubElement(newch, "display-name")
-            dn_el.text = dn.text
-
-        # copiar icon/other tags if present
-        for icon in ch.findall("icon"):
-            ic = ET.SubElement(newch, "icon")
-            for k,v in icon.attrib.items():
-                ic.set(k, v)
-
-    # adicionar programas com channel attr em br_ids
-    progs = root.findall("programme")
-    count_prog = 0
-    for p in progs:
-        ch = p.get("channel")
-        if ch and ch in br_ids:
-            # append programme (clone)
-            prog = ET.SubElement(tv, "programme", dict(p.attrib))
-            for child in list(p):
-                # copiar elementos filhos (title, desc, category etc)
-                el = ET.SubElement(prog, child.tag)
-                el.text = child.text
-                # se houver atributos em child, copie-os
-                for k,v in child.attrib.items():
-                    el.set(k, v)
-            count_prog += 1
+    }
+    wrap = (lambda f: TimedWriter(f, metrics)) if metrics is not None else None
+    serialize_s = 0.0
+    with open_xmltv(out_path, root_attrs, indent=indent, wrap=wrap) as w:
+        for kind, el in iter_brazilian(source, classifier, metrics):
+            t0 = time.perf_counter()
+            if kind == "channel":
+                # apenas display-name e icon do canal
+                w.write_channel(el.get("id"),
+                                [dn.text for dn in el.findall("display-name")],
+                                [dict(icon.attrib) for icon in el.findall("icon")])
+            else:
+                # programa inteiro (title, desc, category etc)
+                w.write_element(el)
+            serialize_s += time.perf_counter() - t0
+        count_prog = w.programmes
+        print(f"Brazilian channels matched: {w.channels}")
+    if metrics is not None:
+        metrics.add_time("serialize", serialize_s, w.channels + w.programmes)
+        metrics.count("channels_out", w.channels)
+        metrics.count("programmes_out", count_prog)
+        metrics.count("bytes_out", w.bytes_out)
 
     print(f"Programmes copied: {count_prog}")
+    return count_prog
 
-    return pretty_xml(tv)
+
+def preview_brazilian(source, classifier, limit):
+    """Lista ate limit canais BR (id, display-names), parando a leitura no limite."""
+    found = []
+    for kind, el in iter_brazilian(source, classifier):
+        if kind != "channel":
+            continue
+        found.append((el.get("id"), " / ".join([dn.text or "" for dn in el.findall("display-name")])))
+        if len(found) >= limit:
+            break
+    return found
 
 
 def main():
@@ -196,59 +289,70 @@ def main():
     p.add_argument("--min-kw-matches", type=int, default=1,
                    help="Numero minimo de keywords que devem aparecer para considerar canal BR (default 1)")
     p.add_argument("--use-curl", action="store_true", help="Forcar uso de curl para baixar")
+    p.add_argument("--compact", action="store_true", help="Grava XML sem indentacao")
+    p.add_argument("--cache-dir", help="Opcional: cache de downloads com requisicoes condicionais (ETag/Last-Modified)")
     p.add_argument("--preview", type=int, default=0, help="Se >0, mostra N canais detectados e sai (nao grava)")
+    p.add_argument("--metrics-json", help="Opcional: grava tempos/memoria/contadores por estagio em JSON")
     args = p.parse_args()
 
+    metrics = RunMetrics("build_epg_br.py")
+    try:
+        run(args, metrics)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            metrics.status = "error"
+        raise
+    finally:
+        if args.metrics_json:
+            metrics.write(args.metrics_json)
+
+
+def run(args, metrics):
     keywords = [k.strip() for k in args.keywords.split(",") if k.strip()]
     print(f"Using keywords: {keywords[:10]}{'...' if len(keywords)>10 else ''}  min_matches={args.min_kw_matches}")
+    classifier = KeywordClassifier(keywords, args.min_kw_matches)
 
-    try:
-        text = download_text(args.epg_url, use_curl=args.use_curl)
-    except Exception as e:
-        print(f"Erro ao baixar/ler EPG fonte: {e}")
-        sys.exit(2)
+    source_url = args.epg_url
+    if args.cache_dir and not args.use_curl:
+        try:
+            with metrics.stage("download"):
+                res = fetch(args.epg_url, args.cache_dir)
+        except FetchError as e:
+            print(f"Erro ao baixar/ler EPG fonte: {e}")
+            sys.exit(2)
+        print(f"EPG fonte: {res.status} ({'alterado' if res.changed else 'inalterado'})")
+        source_url = res.path
 
-    # teste parse rápido
     try:
-        root, channels, programmes = None, None, None
-        root, channels, programmes = (None, None, None)
-        parsed_root = ET.fromstring(text.encode("utf-8"))
-        channels = parsed_root.findall("channel")
-    except Exception as e:
+        # passe unico: download (sem --cache-dir), parse, classify, serialize e write intercalados
+        with metrics.stage("filter"), open_source(source_url, use_curl=args.use_curl) as raw:
+            source = CountingReader(raw)
+            try:
+                if args.preview > 0:
+                    br_list = preview_brazilian(source, classifier, args.preview)
+                    print("--- preview of matched channels ---")
+                    for cid, name in br_list:
+                        print(f"{cid} -> {name}")
+                    sys.exit(0)
+
+                # construir epg filtrado e gravar em disco (uma unica leitura da fonte)
+                build_filtered_epg(source, classifier, out_path=args.out,
+                                   indent=None if args.compact else "  ", metrics=metrics)
+            finally:
+                metrics.count("bytes_in", source.bytes)
+        print(f"EPG brasileiro gerado com sucesso: {args.out}")
+    except ET.ParseError as e:
         print("Erro ao parsear XML fonte:", e)
-        # exibir inicio do arquivo para debug (limitado)
-        print("Snippet (first 1000 chars):")
-        print(text[:1000])
         sys.exit(2)
-
-    # identificar quais canais o script considera BR
-    br_list = []
-    for ch in channels:
-        if is_brazilian_channel(ch, keywords, args.min_kw_matches):
-            br_list.append((ch.get("id"), " / ".join([dn.text or "" for dn in ch.findall("display-name")])))
-    print(f"Detected {len(br_list)} Brazilian channels (heuristic).")
-
-    if args.preview > 0:
-        print("--- preview of matched channels ---")
-        for cid, name in br_list[:args.preview]:
-            print(f"{cid} -> {name}")
-        sys.exit(0)
-
-    # construir epg filtrado
-    try:
-        out_bytes = build_filtered_epg(text, keywords, args.min_kw_matches)
-    except Exception as e:
-        print("Erro ao construir EPG filtrado:", e)
+    except (FileNotFoundError, RuntimeError) as e:
+        print(f"Erro ao baixar/ler EPG fonte: {e}")
         sys.exit(2)
-
-    # gravar em disco
-    try:
-        with open(args.out, "wb") as f:
-            f.write(out_bytes)
-        print(f"EPG brasileiro gerado com sucesso: {args.out}")
-    except Exception as e:
+    except OSError as e:
         print("Erro ao escrever arquivo de saida:", e)
         sys.exit(2)
+    except Exception as e:
+        print("Erro ao construir EPG filtrado:", e)
+        sys.exit(2)
 
 
 if __name__ == "__main__":
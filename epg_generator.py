@@ -6,35 +6,99 @@ Gera epg.xml (XMLTV) a partir de uma playlist M3U (local) e mescla com um EPG ex
 Inclui:
  - fallback se o EPG externo for inválido
  - mapeamento automatico (fuzzy match) entre canais da M3U e canais do EPG externo
- - pretty-print do XML de saida
+ - gravacao incremental do XML de saida (xmltv_writer), indentado ou compacto
+ - varias fontes de EPG (--epg-source repetido): download concorrente, parse em
+   processos paralelos e uniao por prioridade (a primeira fonte vence sobreposicoes)
 
 Uso:
   python epg_generator.py lista.m3u --epg-source epg_remote.xml --out epg.xml
   python epg_generator.py lista.m3u --epg-source "https://epg.brtwo.fyi/epg.xml"
+  python epg_generator.py lista.m3u --epg-source a.xml.gz --epg-source b.xml   (a tem prioridade)
 
 Opcoes:
   --hours N        : horas de placeholders ao gerar fallback (default 48)
+  --placeholder-block-minutes N : duracao de cada bloco de placeholder (default 60); blocos
+                     maiores deixam horizontes longos baratos (ex. --hours 168 com blocos de 360)
+  --shift TVG=H    : timeshift por canal em horas (repetivel) aplicado no EPG: o canal reaproveita
+                     os eventos do epg_id mapeado com horarios somados
+  --apply-tvg-shift : aplica tambem o tvg-shift da M3U no EPG (so para players que ignoram
+                     tvg-shift; os que o respeitam deslocariam a grade duas vezes)
   --min-ratio R    : ratio minimo (0..1) do fuzzy match para aceitar um match (default 0.6)
+  --matcher NAME   : motor de fuzzy match: indexed (padrao), difflib (varredura completa) ou tfidf (numpy)
+  --map-cache FILE : opcional, cache CSV do mapeamento reutilizado entre execucoes;
+                     linhas com source=manual sao overrides (tvg-id -> epg id) que sempre vencem
   --write-map FILE : opcional, grava CSV com mapeamento sugerido (tvg-id,matched_epg_id,score)
+  --past-hours N   : descarta no parse eventos que terminaram ha mais de N horas
+  --future-hours N : descarta no parse eventos que comecam daqui a mais de N horas
+  --compact        : grava XML sem indentacao
+  --passthrough    : copia a marcacao original de cada <programme> do EPG externo (category, icon,
+                     episode-num, rating, lang...) em vez de reconstruir so title/desc
+  --jobs N         : renderiza os canais em N processos (0 = numero de CPUs), saida byte a byte
+                     identica a de um processo
+  --canonical      : saida deterministica (canais ordenados por tvg-id, placeholders e janela de
+                     --past/--future-hours alinhados a meia-noite, sem campos volateis); o arquivo
+                     so e regravado quando o conteudo muda, entao o git so ve commits reais
+  --fragment-cache PREFIX : cache de fragmentos XML por canal; so canais alterados sao renderizados
+  --cache-dir DIR  : cache de downloads com requisicoes condicionais (ETag/Last-Modified)
+  --skip-unchanged : com --cache-dir, nao regenera se fontes e opcoes nao mudaram
+  --require-epg    : sai com codigo 2 (sem gravar) se nenhuma fonte de EPG produzir eventos, em vez
+                     de gerar uma saida so com placeholders
+  --stream         : parse incremental do EPG externo (memoria limitada aos eventos retidos)
+  --store PATH     : grava canais/programas num SQLite (epg_store) e renderiza lendo um canal
+                     por vez; programas de execucoes anteriores cobrem dias que a fonte deixou de publicar
+  --metrics-json PATH : grava tempos (parede/CPU), memoria e contadores por estagio em JSON
+  --shard-by group|N : grava um XMLTV por group-title (ou por blocos de N canais) em --shard-dir
+                       (padrao epg_shards) + manifest.json com sha256 por shard, em vez de --out
+  --serve [HOST:]PORT : modo servidor (epg_server): EPG e mapping em memoria, atualizados a cada
+                        --refresh-minutes (padrao 30), servidos em /epg.xml com gzip pre-computado,
+                        ETag e Range (usa --cache-dir, padrao .epg_cache)
 """
 
 import argparse
+import bisect
 import datetime as dt
 from zoneinfo import ZoneInfo
 import xml.etree.ElementTree as ET
 import sys
 import os
 import re
-from xml.dom import minidom
 import difflib
 import csv
+import collections
+import math
+import time
+import glob
+import hashlib
+import heapq
+import io
+import json
+import mmap
+import multiprocessing
+import pickle
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from xmltv_writer import open_xmltv, render_fragment, ProgrammeTemplate
+from run_metrics import RunMetrics, CountingReader, TimedWriter
+from epg_server import serve
+from epg_store import ProgrammeStore
+from fetch_cache import (fetch, FetchError, READ_ERRORS, open_bytes, read_bytes, response_stream, decompress_bytes,
+                         file_sha256)
 
 try:
     import requests
 except ImportError:
     requests = None
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 TZ = ZoneInfo("America/Recife")
+# --canonical: o relogio e truncado a blocos deste tamanho (horas, divisor de 24);
+# execucoes dentro do mesmo bloco com as mesmas fontes geram bytes identicos
+CANONICAL_ALIGN_HOURS = 24
 
 
 # ---------------- utilities ----------------
@@ -43,65 +107,143 @@ def now_tz():
     return dt.datetime.now(TZ)
 
 
-def pretty_xml_bytes(elem):
-    rough = ET.tostring(elem, encoding="utf-8")
-    reparsed = minidom.parseString(rough)
-    return reparsed.toprettyxml(indent="  ", encoding="utf-8")
+def canonical_now():
+    """now_tz() truncado ao inicio do bloco de CANONICAL_ALIGN_HOURS (meia-noite com 24)."""
+    now = now_tz()
+    return now.replace(hour=now.hour - now.hour % CANONICAL_ALIGN_HOURS, minute=0, second=0, microsecond=0)
 
 
 def format_xmltv_datetime(dtobj):
     return dtobj.strftime("%Y%m%d%H%M%S %z")
 
 
-def safe_read_text(path):
-    with open(path, "r", encoding="utf-8", errors="replace") as f:
-        return f.read()
+M3U_ATTR_RE = re.compile(r'([A-Za-z0-9_-]+)="([^"]*)"')
+# caminho rapido: duracao, bloco de atributos bem formados, resto ate a virgula, titulo
+M3U_EXTINF_RE = re.compile(r'#EXTINF:[^\s,]*((?:\s+[A-Za-z0-9_-]+="[^"]*")*)([^,]*),?(.*)')
+
+
+class M3UEntry:
+    """
+    Entrada da playlist: tvg_id (ou o nome, se vazio), name, url, group
+    (group-title ou #EXTGRP) e attrs, tupla com todos os pares key="value" do
+    #EXTINF (tvg-name, tvg-logo, tvg-shift...). Chaves e grupos sao internados,
+    entao playlists grandes nao repetem essas strings.
+    """
+
+    __slots__ = ("tvg_id", "name", "url", "group", "attrs")
+
+    def __init__(self, tvg_id, name, url="", group="", attrs=()):
+        self.tvg_id = tvg_id
+        self.name = name
+        self.url = url
+        self.group = group
+        self.attrs = attrs
+
+    def attr(self, key, default=None):
+        for k, v in self.attrs:
+            if k == key:
+                return v
+        return default
+
+    def __repr__(self):
+        return f"M3UEntry({self.tvg_id!r}, {self.name!r}, group={self.group!r})"
+
+
+def parse_extinf(line):
+    """'#EXTINF:-1 k="v" ...,Nome' -> (attrs, nome)."""
+    intern = sys.intern
+    m = M3U_EXTINF_RE.match(line)
+    if m and '="' not in m.group(2):
+        return tuple([(intern(k), v) for k, v in M3U_ATTR_RE.findall(m.group(1))]), m.group(3).strip()
+    # atributos fora do padrao (ex. texto solto entre eles): varre a linha toda
+    attrs = []
+    end = line.find(":") + 1
+    for m in M3U_ATTR_RE.finditer(line):
+        attrs.append((intern(m.group(1)), m.group(2)))
+        end = m.end()
+    # o titulo vem depois da primeira virgula fora dos atributos (valores podem conter virgulas)
+    comma = line.find(",", end)
+    name = line[comma + 1:].strip() if comma != -1 else ""
+    return tuple(attrs), name
 
 
-def load_m3u(path_or_url):
-    """Carrega playlist M3U (arquivo local ou URL)."""
+def iter_m3u(lines):
+    """
+    Parser incremental de M3U: lines e qualquer iteravel de linhas (str), como
+    um arquivo texto ou iter_m3u_lines. Produz um M3UEntry por #EXTINF; a URL e
+    a proxima linha que nao comeca com '#' (#EXTVLCOPT/#KODIPROP etc. entre
+    o #EXTINF e a URL sao ignorados; #EXTGRP vale como group-title ausente).
+    Linhas CRLF e BOM utf-8 no inicio do arquivo sao aceitos.
+    """
+    pending = None
+    n = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == "\ufeff":
+            # BOM (str.strip nao remove): sem isso um #EXTINF na primeira linha viraria URL
+            line = line[1:].lstrip()
+        if line.startswith("#EXTINF"):
+            if pending is not None:
+                yield pending
+            n += 1
+            attrs, name = parse_extinf(line)
+            fields = dict(attrs)
+            tvg_id = (fields.get("tvg-id") or "").strip()
+            name = name or tvg_id or f"chan{n}"
+            pending = M3UEntry(tvg_id or name, name, "", sys.intern((fields.get("group-title") or "").strip()), attrs)
+        elif line.startswith("#"):
+            if pending is not None and not pending.group and line.startswith("#EXTGRP:"):
+                pending.group = sys.intern(line[8:].strip())
+        elif pending is not None:
+            pending.url = line
+            yield pending
+            pending = None
+    if pending is not None:
+        yield pending
+
+
+def iter_m3u_lines(reader):
+    """Linhas (str) de um stream binario com readline (arquivo, mmap, gzip, resposta HTTP)."""
+    for raw in iter(reader.readline, b""):
+        yield raw.decode("utf-8", "replace")
+
+
+@contextmanager
+def open_m3u(path_or_url):
+    """
+    Abre a playlist (arquivo local ou URL) como stream binario, sem ler tudo:
+    gzip/xz descompactados em streaming, arquivo local simples via mmap.
+    Sai com sys.exit(2) se a playlist nao puder ser obtida.
+    """
     if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
         if not requests:
             print("Erro: requests necessário para baixar M3U. Instale: pip install requests")
             sys.exit(2)
         try:
-            r = requests.get(path_or_url, timeout=30)
+            r = requests.get(path_or_url, timeout=30, stream=True)
             r.raise_for_status()
-            return r.text
         except requests.exceptions.RequestException as e:
             print(f"Erro ao baixar M3U: {e}")
             sys.exit(2)
-    else:
-        if not os.path.exists(path_or_url):
-            print(f"Arquivo M3U nao encontrado: {path_or_url}")
-            sys.exit(2)
-        return safe_read_text(path_or_url)
-
-
-def parse_m3u_text(text):
-    """Retorna lista de canais {tvg_id, name, url}."""
-    lines = [l.rstrip("\n\r") for l in text.splitlines() if l.strip() != ""]
-    channels = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        if line.startswith("#EXTINF"):
-            # tenta tvg-id e nome
-            m_id = re.search(r'tvg-id="([^"]+)"', line)
-            tvg_id = m_id.group(1).strip() if m_id else None
-            name = line.split(",", 1)[1].strip() if "," in line else (tvg_id or f"chan{i}")
-            url = lines[i+1] if i+1 < len(lines) and not lines[i+1].startswith("#") else ""
-            channels.append({"tvg_id": tvg_id or name, "name": name, "url": url})
-            i += 2
-        else:
-            i += 1
-    return channels
+        with r:
+            yield response_stream(r)
+        return
+    if not os.path.exists(path_or_url):
+        print(f"Arquivo M3U nao encontrado: {path_or_url}")
+        sys.exit(2)
+    with open_bytes(path_or_url) as f:
+        yield f
 
 
 # ------------- load external EPG --------------
 
 def load_external_raw(epg_source):
-    """Retorna string do EPG remoto/local ou None em caso de erro."""
+    """
+    Retorna os bytes do EPG remoto/local (descompactados se gzip/xz; mmap para
+    arquivo local simples, fechado pelo chamador) ou None em caso de erro.
+    """
     is_url = epg_source.startswith("http://") or epg_source.startswith("https://")
     if is_url:
         if not requests:
@@ -110,13 +252,32 @@ def load_external_raw(epg_source):
         try:
             r = requests.get(epg_source, timeout=60)
             r.raise_for_status()
-            # gravar copia local para debug (opcional)
-            try:
-                with open("epg_remote.xml", "wb") as f:
-                    f.write(r.content)
-            except Exception:
-                pass
-            return r.content.decode("utf-8", errors="replace")
+            return decompress_bytes(r.content)
+        except requests.exceptions.RequestException as e:
+            print(f"Erro ao baixar EPG remoto: {e}")
+            return None
+    else:
+        if not os.path.exists(epg_source):
+            print(f"Arquivo EPG nao encontrado: {epg_source}")
+            return None
+        return read_bytes(epg_source)
+
+
+def open_external_stream(epg_source):
+    """
+    Abre o EPG remoto/local como stream binario (para parse_external_epg_stream):
+    gzip/xz descompactados em streaming, arquivo local simples via mmap.
+    Retorna objeto com .read() ou None em caso de erro.
+    """
+    is_url = epg_source.startswith("http://") or epg_source.startswith("https://")
+    if is_url:
+        if not requests:
+            print("Aviso: requests nao instalado; nao e possivel baixar EPG remoto.")
+            return None
+        try:
+            r = requests.get(epg_source, timeout=60, stream=True)
+            r.raise_for_status()
+            return response_stream(r)
         except requests.exceptions.RequestException as e:
             print(f"Erro ao baixar EPG remoto: {e}")
             return None
@@ -124,86 +285,401 @@ def load_external_raw(epg_source):
         if not os.path.exists(epg_source):
             print(f"Arquivo EPG nao encontrado: {epg_source}")
             return None
-        return safe_read_text(epg_source)
+        return open_bytes(epg_source)
 
 
-def parse_external_epg_raw(text):
+def parse_external_epg_raw(text, window=None, passthrough=False):
     """
-    Parseia texto XML do EPG externo e retorna:
+    Parseia o XML do EPG externo (str, bytes ou mmap) e retorna:
       - epg_channels: list of dicts {id, display}
-      - epg_events: dict epg_id -> list of events {start_dt,stop_dt,title,desc}
+      - epg_events: dict epg_id -> Schedule (lista ordenada) de Programme
+    window: opcional (lo_ts, hi_ts) em epoch; eventos fora da janela sao descartados no parse.
+    passthrough: guarda a marcacao original de cada <programme> (iter_external_epg_spans).
     Retorna (None, None) em caso de parse falho.
     """
-    if not text or "<tv" not in text:
+    data = text.encode("utf-8") if isinstance(text, str) else text
+    if not data or data.find(b"<tv") == -1:
         print("Conteudo do EPG parece invalido (nao contem <tv>)")
         try:
             print("Snippet (primeiras 1000 chars):")
-            print((text or "")[:1000])
+            print(str(data[:1000] if data else b"", "utf-8", "replace"))
         except Exception:
             pass
         return None, None
+    if passthrough:
+        return parse_external_epg_stream(data, window, passthrough=True)
 
     try:
-        root = ET.fromstring(text.encode("utf-8"))
+        root = ET.fromstring(data)
     except ET.ParseError as e:
         print(f"Erro ao parsear EPG externo: {e}")
         # salvar snippet para debug
         try:
             with open("epg_remote_debug_snippet.txt", "w", encoding="utf-8", errors="replace") as f:
-                f.write((text or "")[:5000])
+                f.write(str(data[:5000], "utf-8", "replace"))
             print("Gravado epg_remote_debug_snippet.txt")
         except Exception:
             pass
         return None, None
 
     # coletar canais (id + display-name)
-    epg_channels = []
-    for ch in root.findall("channel"):
-        cid = ch.get("id")
-        display = ch.findtext("display-name") or ""
-        epg_channels.append({"id": cid, "display": display.strip()})
+    epg_channels = [channel_record(ch) for ch in root.findall("channel")]
 
     # coletar events por channel id
     events = {}
+    strings = {}
     for prog in root.findall("programme"):
-        ch = prog.get("channel")
-        if not ch:
+        add_programme_event(events, prog, window, strings)
+
+    return epg_channels, events
+
+
+def channel_record(ch):
+    """Converte um <channel> em {id, display}."""
+    display = ch.findtext("display-name") or ""
+    return {"id": ch.get("id"), "display": display.strip()}
+
+
+class Programme:
+    """
+    Evento compacto do EPG externo: inicio/fim em epoch (int) para ordenacao e
+    janelas, timestamps XMLTV canonicos internados (compartilhados entre canais
+    da mesma grade e escritos sem reformatar) e title/desc da tabela de strings
+    do parse. raw (so com --passthrough): marcacao original do <programme> apos
+    start/stop/channel, copiada para a saida (ver iter_external_epg_spans).
+    """
+
+    __slots__ = ("start", "stop", "start_s", "stop_s", "title", "desc", "raw")
+
+    def __init__(self, start, stop, start_s, stop_s, title, desc, raw=None):
+        self.start = start
+        self.stop = stop
+        self.start_s = start_s
+        self.stop_s = stop_s
+        self.title = title
+        self.desc = desc
+        self.raw = raw
+
+    def __getstate__(self):
+        return (self.start, self.stop, self.start_s, self.stop_s, self.title, self.desc, self.raw)
+
+    def __setstate__(self, state):
+        self.start, self.stop, self.start_s, self.stop_s, self.title, self.desc, self.raw = state
+
+    def __eq__(self, other):
+        return isinstance(other, Programme) and self.__getstate__() == other.__getstate__()
+
+    def __repr__(self):
+        return f"Programme({self.start_s!r}, {self.stop_s!r}, {self.title!r})"
+
+
+class Schedule(list):
+    """
+    Eventos (Programme) de um canal, sempre ordenados por inicio (empates na
+    ordem de chegada, como o sort estavel anterior). starts guarda o inicio em
+    epoch para bisect; max_len (maior duracao vista) limita a busca para tras
+    em consultas de janela/sobreposicao.
+    """
+
+    __slots__ = ("starts", "max_len")
+
+    def __init__(self):
+        super().__init__()
+        self.starts = []
+        self.max_len = 0
+
+    def add(self, ev):
+        if not self.starts or ev.start >= self.starts[-1]:
+            self.starts.append(ev.start)
+            self.append(ev)
+        else:
+            i = bisect.bisect_right(self.starts, ev.start)
+            self.starts.insert(i, ev.start)
+            self.insert(i, ev)
+        self.max_len = max(self.max_len, ev.stop - ev.start)
+
+    def between_idx(self, lo_ts, hi_ts):
+        """Faixa [i, j) de eventos que comecam antes de hi_ts e podem terminar depois de lo_ts."""
+        return (bisect.bisect_left(self.starts, lo_ts - self.max_len),
+                bisect.bisect_left(self.starts, hi_ts))
+
+    def between(self, lo_ts, hi_ts):
+        """Eventos que intersectam [lo_ts, hi_ts) (epoch)."""
+        i, j = self.between_idx(lo_ts, hi_ts)
+        return [ev for ev in self[i:j] if ev.stop > lo_ts]
+
+
+def programme_from_element(prog, window=None, strings=None):
+    """
+    Converte um <programme> em (channel, Programme); None para blocos sem canal,
+    com datas invalidas ou, se window=(lo_ts, hi_ts), fora da janela.
+    strings: dict usado como tabela de strings (title/desc repetidos viram o mesmo objeto).
+    """
+    return make_programme(prog.get("channel"), prog.get("start"), prog.get("stop"),
+                          prog.findtext("title"), prog.findtext("desc"), window, strings)
+
+
+def make_programme(ch, start_raw, stop_raw, title, desc, window=None, strings=None, raw=None):
+    """Campos de um <programme> -> (channel, Programme) ou None (ver programme_from_element)."""
+    if not ch:
+        return None
+    # parse datas no formato XMLTV (YYYYMMDDHHMMSS±HHMM ou sem offset)
+    try:
+        start_ts, start_s = parse_xmltv_ts(start_raw or "")
+        stop_ts, stop_s = parse_xmltv_ts(stop_raw or "")
+    except Exception:
+        # pular blocos com datas invalidas
+        return None
+    if window and (stop_ts <= window[0] or start_ts >= window[1]):
+        return None
+    title = (title or "").strip()
+    desc = (desc or "").strip()
+    if strings is not None:
+        title = strings.setdefault(title, title)
+        desc = strings.setdefault(desc, desc)
+    return ch, Programme(start_ts, stop_ts, start_s, stop_s, title, desc, raw)
+
+
+def add_programme_event(events, prog, window=None, strings=None):
+    """Adiciona um <programme> em events[channel] (Schedule de Programme), ver programme_from_element."""
+    item = programme_from_element(prog, window, strings)
+    if item is None:
+        return
+    ch, ev = item
+    sched = events.get(ch)
+    if sched is None:
+        sched = events[ch] = Schedule()
+    sched.add(ev)
+
+
+def event_window(past_hours=None, future_hours=None, canonical=False):
+    """
+    (lo_ts, hi_ts) em epoch a partir de agora, ou None se nenhum limite foi dado.
+    canonical: conta a partir de canonical_now(), com hi estendido por um bloco
+    para continuar cobrindo future_hours ate o fim do bloco.
+    """
+    if past_hours is None and future_hours is None:
+        return None
+    now = (canonical_now() if canonical else now_tz()).timestamp()
+    ahead = future_hours + CANONICAL_ALIGN_HOURS if canonical and future_hours is not None else future_hours
+    lo = now - past_hours * 3600 if past_hours is not None else float("-inf")
+    hi = now + ahead * 3600 if future_hours is not None else float("inf")
+    return lo, hi
+
+
+def window_hour(past_hours=None, future_hours=None, canonical=False):
+    """
+    Hora cheia (horas desde epoch) da origem de event_window, ou None se nenhum
+    limite foi dado. Muda quando a janela anda: a cada hora, ou a cada bloco de
+    CANONICAL_ALIGN_HOURS em modo canonico.
+    """
+    if past_hours is None and future_hours is None:
+        return None
+    return int((canonical_now() if canonical else now_tz()).timestamp() // 3600)
+
+
+class InvalidEPG(ValueError):
+    """Documento XML valido, mas que nao e um XMLTV (<tv>) utilizavel."""
+
+
+def iter_external_epg(source, window=None, passthrough=False, elements=False):
+    """
+    Le o XMLTV incrementalmente (ET.iterparse) e produz ("channel", {id, display})
+    e ("programme", (channel, Programme)) na ordem do documento. Cada elemento e
+    descartado logo apos ser consumido. Levanta ET.ParseError ou InvalidEPG.
+    passthrough: usa iter_external_epg_spans (Programme.raw preenchido).
+    elements: produz ("programme", (elemento, item ou None)) para todo <programme>,
+    inclusive os descartados (usado por iter_external_epg_spans).
+    """
+    if passthrough:
+        yield from iter_external_epg_spans(source, window)
+        return
+    strings = {}
+    root = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+                if root.tag != "tv":
+                    raise InvalidEPG(f"raiz <{root.tag}>, esperado <tv>")
             continue
-        start_raw = prog.get("start") or ""
-        stop_raw = prog.get("stop") or ""
-        title = (prog.findtext("title") or "").strip()
-        desc = (prog.findtext("desc") or "").strip()
-        # parse datas no formato XMLTV (YYYYMMDDHHMMSS±HHMM ou sem offset)
-        try:
-            start_dt = parse_xmltv_datetime(start_raw)
-            stop_dt = parse_xmltv_datetime(stop_raw)
-        except Exception:
-            # pular blocos com datas invalidas
+        if elem.tag == "channel":
+            yield "channel", channel_record(elem)
+        elif elem.tag == "programme":
+            item = programme_from_element(elem, window, strings)
+            if elements:
+                yield "programme", (elem, item)
+            elif item is not None:
+                yield "programme", item
+        else:
             continue
-        events.setdefault(ch, []).append({
-            "start": start_dt,
-            "stop": stop_dt,
-            "title": title,
-            "desc": desc
-        })
+        # liberar o elemento consumido (e a referencia mantida pela raiz)
+        elem.clear()
+        root.clear()
+    if root is None:
+        raise InvalidEPG("documento vazio")
+
+
+# tag de abertura completa de um <programme>; grupo 2 = "/" se o elemento e vazio
+_PROGRAMME_TAG_RE = re.compile(rb"""<programme((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*)\s*(/?)>""")
+# atributos reescritos pelo gerador (o resto da tag de abertura e copiado)
+_PROGRAMME_OWN_ATTR_RE = re.compile(rb"""\s+(?:start|stop|channel)\s*=\s*(?:"[^"]*"|'[^']*')""")
+_XML_ENCODING_RE = re.compile(rb"""\A\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+PASSTHROUGH_ENCODINGS = ("utf-8", "utf8", "us-ascii", "ascii")
+
+
+def passthrough_encoding_ok(head):
+    """False (com aviso) se o XML declara um encoding que nao e utf-8/ascii."""
+    m = _XML_ENCODING_RE.match(head)
+    if m and m.group(1).decode("ascii").lower() not in PASSTHROUGH_ENCODINGS:
+        print(f"Aviso: EPG em {m.group(1).decode('ascii')}; passthrough desativado para esta fonte")
+        return False
+    return True
+
+
+class _TeeReader:
+    """Repassa read() ao stream e acumula os bytes lidos em buf (a partir de base) ate stop()."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.buf = bytearray()
+        self.base = 0
+        self.active = True
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if self.active:
+            self.buf += data
+        return data
+
+    def stop(self):
+        """Passthrough desativado: libera o buffer e deixa de espelhar o que for lido."""
+        self.active = False
+        self.buf = bytearray()
+
+    def discard(self, upto):
+        """Libera o buffer ate a posicao absoluta upto."""
+        if upto > self.base:
+            del self.buf[:upto - self.base]
+            self.base = upto
+
+
+def iter_external_epg_spans(source, window=None):
+    """
+    Variante de iter_external_epg para --passthrough. Os campos continuam vindo do
+    ET.iterparse; em paralelo, cada <programme> e localizado nos bytes ja lidos
+    pelo parser e Programme.raw recebe o trecho original apos start/stop/channel:
+    demais atributos, filhos (category, icon, episode-num, rating, lang...) e o
+    fechamento, como texto. Na saida so start/stop/channel sao escritos pelo
+    gerador; o resto e copiado.
+    source: bytes/mmap ou objeto binario com .read(); streams sao espelhados num
+    buffer que so guarda os bytes ainda nao casados. Documentos que nao sao utf-8
+    e programas que nao batem com o elemento parseado (ex. '<programme' dentro de
+    comentario) desativam o raw dali em diante, e o espelho do stream e descartado.
+    Levanta ET.ParseError ou InvalidEPG.
+    """
+    if isinstance(source, (bytes, bytearray, mmap.mmap)):
+        # o proprio documento serve de buffer (sem copia)
+        tee, buf, reader = None, source, (source if isinstance(source, mmap.mmap) else io.BytesIO(source))
+        if isinstance(source, mmap.mmap):
+            source.seek(0)
+    else:
+        tee = reader = _TeeReader(source)
+    base = 0
+    pos = 0
+    raw_ok = None  # None: encoding ainda nao verificado
+    for kind, item in iter_external_epg(reader, window, elements=True):
+        if kind == "channel":
+            yield kind, item
+            continue
+        elem, parsed = item
+        if tee is not None:
+            buf, base = tee.buf, tee.base
+        if raw_ok is None:
+            raw_ok = passthrough_encoding_ok(bytes(buf[:200]) if base == 0 else b"")
+            if not raw_ok and tee is not None:
+                tee.stop()
+        if not raw_ok:
+            if parsed is not None:
+                yield "programme", parsed
+            continue
+        m = _PROGRAMME_TAG_RE.search(buf, pos - base)
+        end = -1
+        if m is not None:
+            if m.group(2):
+                end = m.end()
+            else:
+                close = buf.find(b"</programme", m.end())
+                end = buf.find(b">", close) + 1 if close >= 0 else -1
+        start_attr = (elem.get("start") or "").encode("utf-8")
+        if end <= 0 or start_attr not in m.group(1):
+            print("Aviso: marcacao de <programme> fora do esperado; passthrough desativado para o restante da fonte")
+            raw_ok = False
+            if tee is not None:
+                tee.stop()
+            if parsed is not None:
+                yield "programme", parsed
+            continue
+        if parsed is not None:
+            extra = _PROGRAMME_OWN_ATTR_RE.sub(b"", m.group(1))
+            body = b"/>" if m.group(2) else b">" + bytes(buf[m.end():end])
+            parsed[1].raw = (extra + body).decode("utf-8")
+        pos = base + end
+        if tee is not None:
+            tee.discard(pos)
+        if parsed is not None:
+            yield "programme", parsed
+
+
+def parse_external_epg_stream(source, window=None, passthrough=False):
+    """
+    Versao incremental de parse_external_epg_raw (iter_external_epg).
+    source: caminho de arquivo ou objeto binario com .read() (bytes/mmap com passthrough).
+    Cada <channel>/<programme> e descartado logo apos ser consumido, entao o
+    pico de memoria depende dos eventos retidos e nao do tamanho do documento.
+    Retorna (epg_channels, epg_events) ou (None, None) em caso de parse falho.
+    """
+    epg_channels = []
+    events = {}
+    try:
+        for kind, item in iter_external_epg(source, window, passthrough):
+            if kind == "channel":
+                epg_channels.append(item)
+                continue
+            ch, ev = item
+            sched = events.get(ch)
+            if sched is None:
+                sched = events[ch] = Schedule()
+            sched.add(ev)
+    except ET.ParseError as e:
+        print(f"Erro ao parsear EPG externo (stream): {e}")
+        return None, None
+    except InvalidEPG as e:
+        print(f"Conteudo do EPG parece invalido ({e})")
+        return None, None
 
-    # ordenar eventos por inicio
-    for k in events:
-        events[k].sort(key=lambda e: e["start"])
     return epg_channels, events
 
 
-def parse_xmltv_datetime(s):
-    """Parse simplificado de XMLTV datetime YYYYMMDDHHMMSS±HHMM."""
+_TS_CACHE = {}
+_FMT_CACHE = {}
+_SHIFT_CACHE = {}
+CODEC_CACHE_MAX = 200_000
+EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+
+def split_xmltv_datetime(s):
+    """YYYYMMDDHHMMSS[±HHMM] -> ((ano, mes, dia, hora, min, seg), offset em minutos ou None)."""
     s = (s or "").strip()
     if len(s) < 14:
         raise ValueError("datetime invalido")
     dt_part = s[:14]
     year = int(dt_part[0:4]); month = int(dt_part[4:6]); day = int(dt_part[6:8])
     hour = int(dt_part[8:10]); minute = int(dt_part[10:12]); second = int(dt_part[12:14])
+    fields = (year, month, day, hour, minute, second)
     rest = s[14:].strip()
     if rest == "":
-        return dt.datetime(year, month, day, hour, minute, second, tzinfo=TZ)
+        return fields, None
     # rest like +HHMM or -HHMM or +HH:MM
     r = rest.replace(":", "")
     sign = r[0]
@@ -212,8 +688,74 @@ def parse_xmltv_datetime(s):
     offset_minutes = hh * 60 + mm
     if sign == "-":
         offset_minutes = -offset_minutes
-    tz = dt.timezone(dt.timedelta(minutes=offset_minutes))
-    return dt.datetime(year, month, day, hour, minute, second, tzinfo=tz)
+    return fields, offset_minutes
+
+
+def format_xmltv_ts(ts, offset_seconds):
+    """Formata epoch + offset como format_xmltv_datetime ('YYYYMMDDHHMMSS ±HHMM'), com memo."""
+    key = (ts, offset_seconds)
+    out = _FMT_CACHE.get(key)
+    if out is None:
+        t = time.gmtime(ts + offset_seconds)
+        sign = "-" if offset_seconds < 0 else "+"
+        hh, mm = divmod(abs(offset_seconds) // 60, 60)
+        out = sys.intern(f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}{t.tm_hour:02d}{t.tm_min:02d}"
+                         f"{t.tm_sec:02d} {sign}{hh:02d}{mm:02d}")
+        if len(_FMT_CACHE) >= CODEC_CACHE_MAX:
+            _FMT_CACHE.clear()
+        _FMT_CACHE[key] = out
+    return out
+
+
+def parse_xmltv_ts(s):
+    """
+    Codec rapido: XMLTV datetime -> (epoch em segundos, string canonica internada).
+    A string original e reaproveitada quando ja esta no formato de saida
+    ('YYYYMMDDHHMMSS ±HHMM'), entao eventos sem deslocamento nao sao reformatados.
+    Sem offset, o horario e interpretado em TZ (America/Recife).
+    """
+    hit = _TS_CACHE.get(s)
+    if hit is not None:
+        return hit
+    fields, offset_minutes = split_xmltv_datetime(s)
+    year, month, day, hour, minute, second = fields
+    if offset_minutes is None:
+        d = dt.datetime(*fields, tzinfo=TZ)
+        ts = int(d.timestamp())
+        offset_seconds = int(d.utcoffset().total_seconds())
+    else:
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError("datetime invalido")
+        days = dt.date(year, month, day).toordinal() - EPOCH_ORDINAL
+        offset_seconds = offset_minutes * 60
+        ts = days * 86400 + hour * 3600 + minute * 60 + second - offset_seconds
+    if len(s) == 20 and s[14] == " " and s[15] in "+-" and s[16:].isdigit() and s[15:] != "-0000":
+        canonical = sys.intern(s)
+    else:
+        canonical = format_xmltv_ts(ts, offset_seconds)
+    hit = (ts, canonical)
+    if len(_TS_CACHE) >= CODEC_CACHE_MAX:
+        _TS_CACHE.clear()
+    _TS_CACHE[s] = hit
+    return hit
+
+
+def shift_xmltv_ts(s, ts, shift):
+    """
+    Timestamp canonico s (epoch ts) deslocado de shift segundos, mantendo o offset
+    de s: so aritmetica inteira + format_xmltv_ts, com memo por (s, shift).
+    """
+    key = (s, shift)
+    out = _SHIFT_CACHE.get(key)
+    if out is None:
+        offset_seconds = int(s[-4:-2]) * 3600 + int(s[-2:]) * 60
+        if s[-5] == "-":
+            offset_seconds = -offset_seconds
+        out = format_xmltv_ts(ts + shift, offset_seconds)
+        if len(_SHIFT_CACHE) >= CODEC_CACHE_MAX:
+            _SHIFT_CACHE.clear()
+        _SHIFT_CACHE[key] = out
+    return out
 
 
 # ---------- fuzzy matching logic ----------
@@ -229,33 +771,23 @@ def normalize_name(s):
     return s
 
 
-def build_mapping(m3u_channels, epg_channels, min_ratio=0.6):
-    """
-    Faz fuzzy match entre canais da M3U e canais do EPG externo.
-    Retorna:
-      mapping: dict m3u_tvg_id -> (matched_epg_id or None, score)
-      unmatched lists printed to log
-    """
-    # construir lista de candidates: use both epg id and display name
+def epg_candidates(epg_channels):
+    """Lista de (epg_id, nome normalizado): prefere display name, fallback para id."""
     candidates = []
     for ec in epg_channels:
-        # candidate string: prefer display name, fallback to id
         cand_name = ec["display"] or ec["id"] or ""
-        candidates.append((ec["id"], cand_name, normalize_name(cand_name)))
-
-    mapping = {}
-    epg_norm_map = {ec_id: norm for (ec_id, _, norm) in candidates}
-
-    # for fast matching use list of normalized strings
-    candidate_norms = [norm for (_, _, norm) in candidates]
+        candidates.append((ec["id"], normalize_name(cand_name)))
+    return candidates
 
-    # also build mapping index -> epg_id
-    idx_to_epg = [ec_id for (ec_id, _, _) in candidates]
 
-    for ch in m3u_channels:
-        mname = ch.get("name") or ch.get("tvg_id")
-        tvg = ch["tvg_id"]
-        norm = normalize_name(mname)
+def match_difflib(queries, epg_channels, min_ratio):
+    """
+    Matcher original: varredura completa com SequenceMatcher (O(M x N)).
+    queries: lista de (tvg_id, nome normalizado). Retorna lista de (epg_id, score).
+    """
+    candidates = epg_candidates(epg_channels)
+    results = []
+    for tvg, norm in queries:
         best_score = 0.0
         best_epg_id = None
 
@@ -268,14 +800,442 @@ def build_mapping(m3u_channels, epg_channels, min_ratio=0.6):
 
         if best_score < 1.0:
             # compare with display names using SequenceMatcher ratio
-            for i, cand_norm in enumerate(candidate_norms):
+            for ec_id, cand_norm in candidates:
                 if not cand_norm:
                     continue
                 score = difflib.SequenceMatcher(None, norm, cand_norm).ratio()
                 if score > best_score:
                     best_score = score
-                    best_epg_id = idx_to_epg[i]
+                    best_epg_id = ec_id
+        results.append((best_epg_id, best_score))
+    return results
+
+
+SHORTLIST_K = 24          # candidatos pontuados com SequenceMatcher por consulta
+SHORTLIST_POOL = 4        # pre-selecao pelos n-gramas raros: SHORTLIST_POOL * SHORTLIST_K candidatos
+STOP_GRAM_FRACTION = 0.05  # n-gramas presentes em mais que esta fracao dos candidatos nao geram candidatos
+NGRAM = 3
+
+
+def char_ngrams(s, n=NGRAM):
+    """n-gramas de caractere com borda: 'sbt' -> ' sb', 'sbt', 'bt '."""
+    s = f" {s} "
+    return [s[i:i + n] for i in range(max(1, len(s) - n + 1))]
+
+
+def char_features(s):
+    """Multiconjunto de caracteres como conjunto de pares (caractere, k-esima ocorrencia)."""
+    return [(c, k) for c, n in collections.Counter(s).items() for k in range(1, n + 1)]
+
+
+def bitmap(positions):
+    """int com os bits das posicoes dadas ligados."""
+    bits = bytearray(max(positions) // 8 + 1)
+    for j in positions:
+        bits[j >> 3] |= 1 << (j & 7)
+    return int.from_bytes(bits, "little")
+
+
+class CandidateIndex:
+    """
+    Indice dos canais do EPG externo para build_mapping.
+
+    - ids: hash id.lower() -> epg_id (substitui a varredura do match exato por id)
+    - aliases: hash nome normalizado -> primeiro candidato identico (ratio 1.0)
+    - postings: indice invertido de trigramas de caractere -> candidatos
+    - by_len: por tamanho do nome, bitmaps (int) "candidato tem >= k vezes o
+      caractere c", usados para achar todos os candidatos cujo quick_ratio()
+      (limite superior do ratio()) alcanca um corte
+
+    Cada consulta gera candidatos so pelos trigramas raros (os que aparecem em
+    ate STOP_GRAM_FRACTION do catalogo: 'tv ', ' hd', 'glo'... nao puxam metade
+    dos canais), somando o IDF dos trigramas em comum. Os SHORTLIST_POOL *
+    SHORTLIST_K melhores sao reordenados pelo coeficiente de Dice sobre todos os
+    trigramas (proximo do ratio() do SequenceMatcher) e os SHORTLIST_K primeiros
+    sao pontuados com SequenceMatcher. A shortlist so da um piso: depois todos
+    os candidatos com quick_ratio() >= max(piso, min_ratio) sao pontuados, em
+    ordem de indice (empates ficam com o primeiro candidato). Assim todo match
+    aceito (score >= min_ratio) e o mesmo da varredura completa (--matcher
+    difflib); abaixo de min_ratio o score devolvido pode ser menor que o da
+    varredura, mas o canal fica sem match nos dois.
+    """
+
+    def __init__(self, epg_channels):
+        self.ids = {}
+        for ec in epg_channels:
+            if ec["id"]:
+                self.ids.setdefault(ec["id"].lower(), ec["id"])
+        self.idx_to_epg = []
+        self.matchers = []
+        self.grams = []
+        self.aliases = {}
+        self.postings = {}
+        by_len = {}
+        for i, (ec_id, norm) in enumerate(epg_candidates(epg_channels)):
+            self.idx_to_epg.append(ec_id)
+            if not norm:
+                self.matchers.append(None)
+                self.grams.append(frozenset())
+                continue
+            # seq2 fixo por candidato: b2j/fullbcount sao calculados uma unica vez
+            self.matchers.append(difflib.SequenceMatcher(None, "", norm))
+            self.aliases.setdefault(norm, i)
+            grams = frozenset(char_ngrams(norm))
+            self.grams.append(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+            members, features = by_len.setdefault(len(norm), ([], {}))
+            for feature in char_features(norm):
+                features.setdefault(feature, []).append(len(members))
+            members.append(i)
+        self.by_len = {n: (members, {f: bitmap(local) for f, local in features.items()})
+                       for n, (members, features) in by_len.items()}
+        self.size = sum(1 for m in self.matchers if m is not None)
+        self.stop_len = max(SHORTLIST_K, int(self.size * STOP_GRAM_FRACTION))
+
+    def shortlist(self, norm):
+        """Indices (ordenados) dos ate SHORTLIST_K candidatos mais parecidos com norm."""
+        grams = frozenset(char_ngrams(norm))
+        lists = sorted((self.postings[g] for g in grams if g in self.postings), key=len)
+        if not lists:
+            return []
+        # so n-gramas comuns: a lista mais curta ainda gera candidatos
+        rare = [p for p in lists if len(p) <= self.stop_len] or lists[:1]
+        weights = {}
+        get = weights.get
+        for posting in rare:
+            w = math.log(1.0 + self.size / len(posting))
+            for i in posting:
+                weights[i] = get(i, 0.0) + w
+        pool = weights
+        if len(pool) > SHORTLIST_POOL * SHORTLIST_K:
+            pool = heapq.nlargest(SHORTLIST_POOL * SHORTLIST_K, weights, key=weights.__getitem__)
+        cand_grams, n = self.grams, len(grams)
+        return sorted(heapq.nlargest(SHORTLIST_K, pool,
+                                     key=lambda i: (len(grams & cand_grams[i]) / (n + len(cand_grams[i])), -i)))
+
+    def reaching(self, norm, cut):
+        """
+        Indices dos candidatos com quick_ratio() >= cut contra norm.
+
+        quick_ratio() = 2 * (caracteres em comum, com repeticao) / (soma dos
+        tamanhos). Por tamanho de nome, o numero de caracteres em comum de
+        todos os candidatos e somado de uma vez sobre os bitmaps, com contadores
+        binarios em fatias de bits (um int por bit do contador).
+        """
+        features = char_features(norm)
+        found = []
+        for n, (members, bitmaps) in self.by_len.items():
+            total = len(norm) + n
+            # menor numero de caracteres em comum com 2 * c / total >= cut (mesma conta em float do difflib)
+            need = max(0, math.ceil(cut * total / 2))
+            while need and 2.0 * (need - 1) / total >= cut:
+                need -= 1
+            while 2.0 * need / total < cut:
+                need += 1
+            if need > min(len(norm), n):
+                continue
+            present = [bitmaps[f] for f in features if f in bitmaps]
+            if len(present) < need:
+                continue
+            planes = []
+            for carry in present:
+                for j, plane in enumerate(planes):
+                    if not carry:
+                        break
+                    planes[j], carry = plane ^ carry, plane & carry
+                if carry:
+                    planes.append(carry)
+            if need.bit_length() > len(planes):
+                continue
+            # contador >= need, comparando do bit mais alto para o mais baixo
+            above, equal = 0, (1 << len(members)) - 1
+            for j in range(len(planes) - 1, -1, -1):
+                if need >> j & 1:
+                    equal &= planes[j]
+                else:
+                    above |= equal & planes[j]
+                    equal &= ~planes[j]
+            mask = above | equal
+            while mask:
+                low = mask & -mask
+                found.append(members[low.bit_length() - 1])
+                mask ^= low
+        return found
+
+    def best_match(self, tvg, norm, min_ratio=0.0):
+        """
+        Retorna (epg_id, score) com score = SequenceMatcher.ratio(); igual a
+        varredura completa sempre que o melhor score e >= min_ratio.
+        """
+        epg_id = self.ids.get(tvg.lower())
+        if epg_id:
+            return epg_id, 1.0
+        if not norm:
+            return None, 0.0
+        i = self.aliases.get(norm)
+        if i is not None:
+            return self.idx_to_epg[i], 1.0
+
+        # piso pela shortlist; um candidato podado aqui que empate com o piso volta pelo reaching()
+        scores = {}
+        floor = 0.0
+        for i in self.shortlist(norm):
+            score = self._score(i, norm, floor)
+            if score is not None:
+                scores[i] = score
+                floor = max(floor, score)
+        best_score = 0.0
+        best_epg_id = None
+        for i in sorted(scores.keys() | self.reaching(norm, max(floor, min_ratio))):
+            score = scores[i] if i in scores else self._score(i, norm, best_score)
+            if score is not None and score > best_score:
+                best_score = score
+                best_epg_id = self.idx_to_epg[i]
+        return best_epg_id, best_score
+
+    def _score(self, i, norm, best_score):
+        """ratio() do candidato i, ou None se um limite superior barato ja e <= best_score."""
+        m = self.matchers[i]
+        m.set_seq1(norm)
+        if m.real_quick_ratio() <= best_score or m.quick_ratio() <= best_score:
+            return None
+        return m.ratio()
+
+
+def match_indexed(queries, epg_channels, min_ratio):
+    """
+    Matcher indexado (CandidateIndex); nomes repetidos sao pontuados uma vez.
+    min_ratio limita a verificacao: so candidatos que podem alcanca-lo sao pontuados
+    alem da shortlist (o corte em si continua em build_mapping).
+    """
+    index = CandidateIndex(epg_channels)
+    memo = {}
+    results = []
+    for tvg, norm in queries:
+        key = (tvg.lower(), norm)
+        if key not in memo:
+            memo[key] = index.best_match(tvg, norm, min_ratio)
+        results.append(memo[key])
+    return results
+
+
+def match_tfidf(queries, epg_channels, min_ratio):
+    """
+    Matcher TF-IDF (numpy): nomes normalizados viram vetores TF-IDF de trigramas
+    de caractere (IDF do lado EPG, vetores normalizados L2) e cada consulta fica
+    com o candidato de maior cosseno (o primeiro, em empate).
+    O lado EPG fica em listas invertidas (trigrama -> linhas e pesos, em ordem de
+    linha); o produto escalar de uma consulta e acumulado so sobre as listas dos
+    seus trigramas, num vetor de scores reaproveitado entre consultas. Nomes
+    repetidos no EPG viram uma linha so (a primeira), mas contam no IDF.
+    Score = cosseno (0..1), comparado com min_ratio como os demais matchers.
+    """
+    if np is None:
+        print("Aviso: numpy nao instalado; usando matcher indexed.")
+        return match_indexed(queries, epg_channels, min_ratio)
+
+    ids = {}
+    for ec in epg_channels:
+        if ec["id"]:
+            ids.setdefault(ec["id"].lower(), ec["id"])
+
+    # consultas unicas que ainda precisam de fuzzy match
+    uniq = {}
+    for tvg, norm in queries:
+        if norm and tvg.lower() not in ids:
+            uniq.setdefault(norm, len(uniq))
+
+    # lado EPG em COO: (linha, n-grama, contagem) por nome nao vazio distinto
+    vocab = {}
+    rows_of = {}
+    row_epg = []
+    row_copies = []
+    coo_row, coo_col, coo_val = [], [], []
+    for ec_id, norm in epg_candidates(epg_channels):
+        if not norm:
+            continue
+        r = rows_of.get(norm)
+        if r is not None:
+            row_copies[r] += 1
+            continue
+        counts = {}
+        for gram in char_ngrams(norm):
+            col = vocab.setdefault(gram, len(vocab))
+            counts[col] = counts.get(col, 0) + 1
+        r = rows_of[norm] = len(row_epg)
+        row_epg.append(ec_id)
+        row_copies.append(1)
+        coo_row.extend([r] * len(counts))
+        coo_col.extend(counts.keys())
+        coo_val.extend(counts.values())
+
+    best = {}
+    if row_epg and uniq:
+        n_rows = len(row_epg)
+        n_docs = sum(row_copies)
+        coo_row = np.asarray(coo_row, dtype=np.int64)
+        coo_col = np.asarray(coo_col, dtype=np.int64)
+        df = np.bincount(coo_col, weights=np.asarray(row_copies, dtype=np.float64)[coo_row], minlength=len(vocab))
+        idf = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+        idf_unseen = math.log(1.0 + n_docs) + 1.0
+        vals = np.asarray(coo_val, dtype=np.float64) * idf[coo_col]
+        vals /= np.sqrt(np.bincount(coo_row, weights=vals * vals, minlength=n_rows))[coo_row]
+
+        # listas invertidas (CSC): postings[indptr[c]:indptr[c + 1]] sao as linhas do n-grama c
+        order = np.argsort(coo_col, kind="stable")
+        postings, weights = coo_row[order], vals[order]
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(coo_col, minlength=len(vocab)), out=indptr[1:])
+        indptr = indptr.tolist()
+        idf = idf.tolist()
+
+        scores = np.zeros(n_rows)
+        for norm in uniq:
+            counts = {}
+            for gram in char_ngrams(norm):
+                counts[gram] = counts.get(gram, 0) + 1
+            terms = []
+            norm2 = 0.0
+            for gram, c in counts.items():
+                col = vocab.get(gram)
+                w = c * (idf[col] if col is not None else idf_unseen)
+                norm2 += w * w
+                if col is not None:
+                    terms.append((col, w))
+            if not terms:
+                continue
+            scale = 1.0 / math.sqrt(norm2)
+            for col, w in terms:
+                lo, hi = indptr[col], indptr[col + 1]
+                # linhas distintas dentro de uma lista: += com indice nao acumula duplicatas
+                scores[postings[lo:hi]] += weights[lo:hi] * (w * scale)
+            r = int(scores.argmax())
+            top = float(scores[r])
+            if top > 0:
+                best[norm] = (row_epg[r], min(1.0, top))
+            scores.fill(0.0)
+
+    results = []
+    for tvg, norm in queries:
+        epg_id = ids.get(tvg.lower())
+        if epg_id:
+            results.append((epg_id, 1.0))
+        else:
+            results.append(best.get(norm, (None, 0.0)))
+    return results
+
+
+MATCHERS = {
+    "indexed": match_indexed,
+    "difflib": match_difflib,
+    "tfidf": match_tfidf,
+}
+
+
+# ---------- mapping cache ----------
+
+MAP_CACHE_FIELDS = ["tvg-id", "name", "matched-epg-id", "score", "source", "fingerprint"]
+
+
+# revisao do algoritmo de cada matcher: ao mudar, as entradas automaticas do --map-cache sao recalculadas
+MATCHER_REVISIONS = {"indexed": 3}
+
+
+def epg_fingerprint(epg_channels, matcher, min_ratio):
+    """Hash do conjunto de canais do EPG (id + display) e dos parametros do matcher."""
+    if matcher in MATCHER_REVISIONS:
+        matcher = f"{matcher}.{MATCHER_REVISIONS[matcher]}"
+    h = hashlib.sha1(f"{matcher}|{min_ratio}\n".encode("utf-8"))
+    for cid, display in sorted((ec["id"] or "", ec["display"] or "") for ec in epg_channels):
+        h.update(f"{cid}\t{display}\n".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def load_map_cache(path):
+    """
+    Le o cache de mapeamento (CSV com MAP_CACHE_FIELDS).
+    Retorna (auto, manual):
+      auto: dict (tvg_id, nome normalizado) -> (epg_id or None, score, fingerprint)
+      manual: dict tvg_id -> epg_id or None (linhas com source=manual; epg vazio = sem match)
+    """
+    auto, manual = {}, {}
+    if not path or not os.path.exists(path):
+        return auto, manual
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                tvg = (row.get("tvg-id") or "").strip()
+                if not tvg:
+                    continue
+                epg_id = (row.get("matched-epg-id") or "").strip() or None
+                if (row.get("source") or "").strip().lower() == "manual":
+                    manual[tvg] = epg_id
+                    continue
+                try:
+                    score = float(row.get("score") or 0.0)
+                except ValueError:
+                    continue
+                auto[(tvg, row.get("name") or "")] = (epg_id, score, row.get("fingerprint") or "")
+    except (OSError, csv.Error) as e:
+        print(f"Aviso: falha ao ler map cache {path}: {e}")
+    return auto, manual
+
 
+def save_map_cache(path, entries, manual, fingerprint):
+    """Grava o cache: overrides manuais primeiro, depois os matches automaticos atuais."""
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(MAP_CACHE_FIELDS)
+            for tvg, epg_id in manual.items():
+                writer.writerow([tvg, "", epg_id or "", "1.000", "manual", ""])
+            for (tvg, norm), (epg_id, score) in entries.items():
+                writer.writerow([tvg, norm, epg_id or "", repr(score), "auto", fingerprint])
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Aviso: falha ao gravar map cache {path}: {e}")
+
+
+def build_mapping(m3u_channels, epg_channels, min_ratio=0.6, matcher="indexed", map_cache=None):
+    """
+    Faz fuzzy match entre canais da M3U e canais do EPG externo.
+    matcher: nome do motor em MATCHERS ("indexed" por padrao, "difflib" = varredura completa,
+             "tfidf" = cosseno TF-IDF vetorizado com numpy).
+    map_cache: opcional, CSV persistente entre execucoes. Entradas automaticas com a
+               mesma chave (tvg-id, nome normalizado) e o mesmo fingerprint do EPG sao
+               reutilizadas; so canais novos/alterados passam pelo matcher. Linhas com
+               source=manual sempre vencem.
+    Retorna:
+      mapping: dict m3u_tvg_id -> (matched_epg_id or None, score)
+      unmatched lists printed to log
+    """
+    queries = [(ch.tvg_id, normalize_name(ch.name or ch.tvg_id)) for ch in m3u_channels]
+
+    cached, manual = load_map_cache(map_cache)
+    fingerprint = epg_fingerprint(epg_channels, matcher, min_ratio) if map_cache else ""
+    known = {}
+    for key in queries:
+        hit = cached.get(key)
+        if hit and hit[2] == fingerprint:
+            known[key] = hit[:2]
+    pending = [key for key in dict.fromkeys(queries) if key not in known and key[0] not in manual]
+    reused = len(known)
+    if pending:
+        known.update(zip(pending, MATCHERS[matcher](pending, epg_channels, min_ratio)))
+    if map_cache:
+        print(f"Map cache: {reused} reutilizados, {len(pending)} recalculados, "
+              f"{len(manual)} overrides manuais")
+        save_map_cache(map_cache, {key: known[key] for key in dict.fromkeys(queries) if key in known},
+                       manual, fingerprint)
+
+    mapping = {}
+    for tvg, norm in queries:
+        if tvg in manual:
+            mapping[tvg] = (manual[tvg], 1.0 if manual[tvg] else 0.0)
+            continue
+        best_epg_id, best_score = known[(tvg, norm)]
         if best_score >= min_ratio:
             mapping[tvg] = (best_epg_id, best_score)
         else:
@@ -300,49 +1260,766 @@ def build_mapping(m3u_channels, epg_channels, min_ratio=0.6):
 
 # ---------- build final epg ----------
 
-def build_final_epg(m3u_channels, epg_events, mapping, hours=48, out_path="epg.xml"):
+def unique_channels(m3u_channels):
+    """
+    Agrupa entradas da M3U pelo tvg_id resolvido (entradas sem tvg-id ja usam o
+    nome como id). Retorna lista de (tvg_id, name) na ordem da primeira
+    ocorrencia; o display name e o da primeira entrada do grupo.
+    """
+    seen = {}
+    for ch in m3u_channels:
+        seen.setdefault(ch.tvg_id, ch.name)
+    return list(seen.items())
+
+
+def parse_shift_hours(value):
+    """Deslocamento em horas no formato do tvg-shift ('1', '-2', '+0.5') -> segundos (int)."""
+    hours = float(value)
+    if not math.isfinite(hours):
+        raise ValueError(f"deslocamento invalido: {value!r}")
+    return round(hours * 3600)
+
+
+def channel_shifts(m3u_channels, overrides=None, tvg_shift=False):
+    """
+    tvg_id -> deslocamento em segundos dos canais com timeshift gravado no EPG:
+    overrides (--shift TVG=HORAS, sempre vence; 0 desliga) e, so com tvg_shift
+    (--apply-tvg-shift), o atributo tvg-shift da M3U (horas; vale o da primeira
+    entrada do tvg_id, como o nome). Por padrao o tvg-shift fica para o player,
+    que ja o aplica sobre o EPG; somar aqui tambem deslocaria a grade duas vezes.
+    So deslocamentos != 0 entram. Afiliadas/regionais com a mesma grade atrasada
+    sao mapeadas para o mesmo epg_id e renderizadas dos mesmos eventos, so com os
+    horarios somados.
+    """
+    shifts = {}
+    seen = set()
+    for ch in m3u_channels if tvg_shift else ():
+        if ch.tvg_id in seen:
+            continue
+        seen.add(ch.tvg_id)
+        value = ch.attr("tvg-shift")
+        if not value:
+            continue
+        try:
+            shift = parse_shift_hours(value)
+        except ValueError:
+            print(f"Aviso: tvg-shift invalido em {ch.tvg_id}: {value!r}; ignorado")
+            continue
+        if shift:
+            shifts[ch.tvg_id] = shift
+    for tvg, shift in (overrides or {}).items():
+        if shift:
+            shifts[tvg] = shift
+        else:
+            shifts.pop(tvg, None)
+    return shifts
+
+
+PLACEHOLDER_TITLE = "Program {n} - {name}"
+PLACEHOLDER_DESC = "Programa gerado automaticamente - {name} - Bloco {n}"
+_PLACEHOLDER_TEMPLATES = {}
+
+
+def placeholder_blocks(hours, block_minutes=60):
+    """Numero de blocos de placeholder que cobrem hours horas."""
+    return max(1, math.ceil(hours * 60 / block_minutes))
+
+
+def placeholder_template(start_base, hours, block_minutes=60, indent="  "):
+    """
+    Grade de placeholders compartilhada por todos os canais sem EPG: os horarios
+    (start/stop) e o XML fixo de cada bloco sao calculados uma vez por execucao
+    (ProgrammeTemplate); cada canal so insere id e nome.
+    """
+    key = (start_base, hours, block_minutes, indent)
+    tpl = _PLACEHOLDER_TEMPLATES.get(key)
+    if tpl is None:
+        step = dt.timedelta(minutes=block_minutes)
+        timeline = []
+        for i in range(placeholder_blocks(hours, block_minutes)):
+            s = start_base + step * i
+            timeline.append((format_xmltv_datetime(s), format_xmltv_datetime(s + step)))
+        _PLACEHOLDER_TEMPLATES.clear()
+        tpl = _PLACEHOLDER_TEMPLATES[key] = ProgrammeTemplate(timeline, PLACEHOLDER_TITLE, PLACEHOLDER_DESC,
+                                                              indent)
+    return tpl
+
+
+def render_channel(w, tvg, name, events, placeholders, shift=0):
+    """
+    Grava <channel> e programas de um canal: events (lista) ou placeholders (ProgrammeTemplate) se None.
+    shift: segundos somados aos horarios dos eventos (timeshift, ver channel_shifts).
+    """
+    w.write_channel(tvg, name)
+    if events is not None:
+        for ev in events:
+            start_s, stop_s = ev.start_s, ev.stop_s
+            if shift:
+                start_s = shift_xmltv_ts(start_s, ev.start, shift)
+                stop_s = shift_xmltv_ts(stop_s, ev.stop, shift)
+            if ev.raw is not None:
+                w.write_programme_raw(start_s, stop_s, tvg, ev.raw)
+            else:
+                w.write_programme(start_s, stop_s, tvg, ev.title, ev.desc)
+    else:
+        # fallback placeholders
+        w.write_template(placeholders, tvg, name)
+
+
+class FragmentCache:
     """
-    Para cada canal da M3U:
-      - se mapping[tvg] aponta para um epg_id com eventos, usa esses eventos (mas escreve channel attr = tvg)
-      - senao gera placeholders
+    Cache entre execucoes dos fragmentos XML (<channel> + <programme>s) de cada
+    canal de saida (--fragment-cache PREFIX):
+      PREFIX.idx.json : tvg_id -> [digest, offset, tamanho]
+      PREFIX.bin      : fragmentos concatenados
+    O digest cobre tudo que muda o fragmento (nome, eventos mapeados ou janela
+    de placeholders, indentacao). Canais com o mesmo digest sao copiados como
+    bytes do .bin anterior; os demais sao renderizados de novo.
     """
-    tv = ET.Element("tv", {"source-info-name": "epg-generator", "generator-info-name": "epg_generator.py"})
-    start_base = now_tz().replace(minute=0, second=0, microsecond=0)
 
+    def __init__(self, prefix):
+        self.idx_path = prefix + ".idx.json"
+        self.bin_path = prefix + ".bin"
+        self.index = {}
+        self._old = None
+        try:
+            with open(self.idx_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+            with open(self.bin_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    self._old = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.index = {}
+        self.new_index = {}
+        self._new = open(self.bin_path + ".tmp", "wb")
+        self.reused = 0
+        self.rendered = 0
+
+    def get(self, tvg, digest):
+        entry = self.index.get(tvg)
+        if self._old is None or not entry or entry[0] != digest:
+            return None
+        _, offset, size = entry
+        return self._old[offset:offset + size]
+
+    def put(self, tvg, digest, fragment):
+        self.new_index[tvg] = [digest, self._new.tell(), len(fragment)]
+        self._new.write(fragment)
+
+    def commit(self):
+        self._new.close()
+        if self._old is not None:
+            self._old.close()
+        os.replace(self.bin_path + ".tmp", self.bin_path)
+        with open(self.idx_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.new_index, f)
+        os.replace(self.idx_path + ".tmp", self.idx_path)
+
+    def abort(self):
+        self._new.close()
+        if self._old is not None:
+            self._old.close()
+        os.remove(self.bin_path + ".tmp")
+
+
+RENDER_CHUNK = 200
+_RENDER_STATE = {}
+
+
+def _render_worker_init(epg_events, placeholders, indent):
+    # com fork os dados sao herdados do processo pai (sem pickle por lote)
+    _RENDER_STATE.update(events=epg_events, placeholders=placeholders, indent=indent)
+
+
+def _render_chunk(specs):
+    """Worker do --jobs: [(tvg, name, epg_id ou None, shift)] -> [(fragmento, programas do EPG)]."""
+    epg_events = _RENDER_STATE["events"]
+    placeholders = _RENDER_STATE["placeholders"]
+    out = []
+    for tvg, name, mapped, shift in specs:
+        events = epg_events[mapped] if mapped is not None else None
+        fragment = render_fragment(lambda fw: render_channel(fw, tvg, name, events, placeholders, shift),
+                                   _RENDER_STATE["indent"])
+        out.append((fragment, len(events) if events is not None else 0))
+    return out
+
+
+class ParallelRenderer:
+    """
+    --jobs N: renderiza canais (render_channel) em N processos, em lotes de
+    RENDER_CHUNK canais, e grava os fragmentos no writer na ordem de submissao,
+    entao a saida e identica a da renderizacao sequencial. Fragmentos ja prontos
+    (FragmentCache) entram na mesma fila e contam no tamanho do lote, entao so ~2
+    lotes por worker (de ate RENDER_CHUNK itens) ficam em memoria.
+    """
+
+    def __init__(self, w, epg_events, placeholders, indent, jobs, mp_context=None):
+        self.w = w
+        self.jobs = jobs
+        self.pool = ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, initializer=_render_worker_init,
+                                        initargs=(epg_events, placeholders, indent))
+        self._items = []   # lote aberto: (spec, callback) ou (None, bytes prontos)
+        self._specs = []
+        self._queue = collections.deque()
+        self.programmes = 0
+
+    def submit(self, spec, done=None):
+        """Agenda spec (tvg, name, epg_id ou None, shift); done(fragmento) roda quando ele for gravado."""
+        self._items.append((spec, done))
+        self._specs.append(spec)
+        if len(self._items) >= RENDER_CHUNK:
+            self._flush()
+
+    def write_bytes(self, data):
+        if not self._queue and not self._items:
+            self.w.write_bytes(data)
+            return
+        self._items.append((None, data))
+        if len(self._items) >= RENDER_CHUNK:
+            self._flush()
+
+    def close(self):
+        """Espera os lotes pendentes e grava tudo."""
+        self._flush()
+        self._drain(0)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def _flush(self):
+        if not self._items:
+            return
+        future = self.pool.submit(_render_chunk, self._specs) if self._specs else None
+        self._queue.append((self._items, future))
+        self._items, self._specs = [], []
+        self._drain(self.jobs * 2)
+
+    def _drain(self, max_pending):
+        """Grava lotes concluidos em ordem; bloqueia enquanto houver mais de max_pending na fila."""
+        while self._queue:
+            items, future = self._queue[0]
+            if future is not None and not future.done() and len(self._queue) <= max_pending:
+                return
+            self._queue.popleft()
+            results = iter(future.result() if future is not None else ())
+            for spec, extra in items:
+                if spec is None:
+                    self.w.write_bytes(extra)
+                    continue
+                fragment, n = next(results)
+                self.w.write_bytes(fragment)
+                self.programmes += n
+                if extra is not None:
+                    extra(fragment)
+
+
+def channel_digest(name, events_digest, start_base, hours, indent, block_minutes=60, shift=0):
+    """Digest do fragmento de um canal (o tvg_id e a chave do cache)."""
+    if events_digest is None:
+        key = f"P|{name}|{start_base.isoformat()}|{hours}|{block_minutes}|{indent!r}"
+    else:
+        key = f"E|{name}|{events_digest}|{indent!r}"
+        if shift:
+            key += f"|{shift}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def build_final_epg(m3u_channels, epg_events, mapping, hours=48, out_path="epg.xml", indent="  ",
+                    fragment_cache=None, metrics=None, block_minutes=60, shifts=None, jobs=1, canonical=False,
+                    tvg_shift=False, mp_context=None):
+    """
+    Para cada tvg_id unico da M3U (unique_channels):
+      - se mapping[tvg] aponta para um epg_id com eventos, usa esses eventos (mas escreve channel attr = tvg),
+        deslocados pelo timeshift do canal (channel_shifts; shifts = overrides tvg_id -> segundos,
+        tvg_shift = aplicar tambem o tvg-shift da M3U)
+      - senao gera placeholders (blocos de block_minutes cobrindo hours, ver placeholder_template)
+    Channels e programmes sao gravados incrementalmente em out_path (xmltv_writer).
+    fragment_cache: opcional, prefixo do FragmentCache; so canais cujo conteudo mudou
+    desde a execucao anterior sao renderizados, os demais sao copiados do cache.
+    metrics: opcional (RunMetrics); contadores de saida e tempo de escrita ("write").
+    jobs: > 1 renderiza os canais em processos (ParallelRenderer), com saida identica;
+    mp_context: contexto multiprocessing desses processos (None = padrao da plataforma).
+    canonical: saida deterministica (canais ordenados por tvg_id, placeholders a partir de
+    canonical_now() cobrindo hours + CANONICAL_ALIGN_HOURS) e out_path so e regravado se
+    o conteudo mudou (open_xmltv only_if_changed).
+    """
+    root_attrs = {"source-info-name": "epg-generator", "generator-info-name": "epg_generator.py"}
+    if canonical:
+        start_base = canonical_now()
+        hours += CANONICAL_ALIGN_HOURS
+    else:
+        start_base = now_tz().replace(minute=0, second=0, microsecond=0)
+    placeholders = placeholder_template(start_base, hours, block_minutes, indent)
+    channels = unique_channels(m3u_channels)
+    if canonical:
+        channels.sort()
+    shifts = channel_shifts(m3u_channels, shifts, tvg_shift)
+    cache = FragmentCache(fragment_cache) if fragment_cache else None
+    events_digests = {}
+    wrap = (lambda f: TimedWriter(f, metrics)) if metrics is not None else None
+    placeholder_channels = programmes = shifted_channels = 0
+
+    try:
+        with open_xmltv(out_path, root_attrs, indent=indent, wrap=wrap, only_if_changed=canonical) as w:
+            pool = ParallelRenderer(w, epg_events, placeholders, indent, jobs, mp_context) if jobs > 1 else None
+            try:
+                for tvg, name in channels:
+                    mapped = mapping.get(tvg, (None, 0.0))[0]
+                    if not (mapped and epg_events and mapped in epg_events):
+                        mapped = None
+                    shift = shifts.get(tvg, 0) if mapped is not None else 0
+                    if mapped is None:
+                        placeholder_channels += 1
+                        programmes += placeholders.count
+                    else:
+                        shifted_channels += bool(shift)
+                    if cache is None and pool is not None:
+                        # eventos lidos e contados no worker
+                        pool.submit((tvg, name, mapped, shift))
+                        continue
+                    events = epg_events[mapped] if mapped is not None else None
+                    if events is not None:
+                        programmes += len(events)
+                    if cache is None:
+                        render_channel(w, tvg, name, events, placeholders, shift)
+                        continue
+
+                    events_digest = None
+                    if events is not None:
+                        if mapped not in events_digests:
+                            events_digests[mapped] = hashlib.blake2b(pickle.dumps(events, protocol=4),
+                                                                     digest_size=16).hexdigest()
+                        events_digest = events_digests[mapped]
+                    digest = channel_digest(name, events_digest, start_base, hours, indent, block_minutes, shift)
+                    fragment = cache.get(tvg, digest)
+                    if fragment is not None:
+                        cache.reused += 1
+                        cache.put(tvg, digest, fragment)
+                        (pool or w).write_bytes(fragment)
+                        continue
+                    cache.rendered += 1
+                    if pool is not None:
+                        pool.submit((tvg, name, mapped, shift),
+                                    lambda frag, tvg=tvg, digest=digest: cache.put(tvg, digest, frag))
+                        continue
+                    fragment = render_fragment(
+                        lambda fw: render_channel(fw, tvg, name, events, placeholders, shift), indent)
+                    cache.put(tvg, digest, fragment)
+                    w.write_bytes(fragment)
+                if pool is not None:
+                    pool.close()
+                    if cache is None:
+                        programmes += pool.programmes
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+    except BaseException:
+        if cache is not None:
+            cache.abort()
+        raise
+    if cache is not None:
+        cache.commit()
+        print(f"Fragmentos: {cache.reused} reaproveitados, {cache.rendered} renderizados")
+    if metrics is not None:
+        # count (e nao set): com --shard-by build_final_epg roda uma vez por shard
+        metrics.count("channels_out", len(channels))
+        metrics.count("programmes_out", programmes)
+        metrics.count("placeholder_channels", placeholder_channels)
+        metrics.count("placeholder_blocks", placeholder_channels * placeholders.count)
+        metrics.count("shifted_channels", shifted_channels)
+        if cache is not None:
+            metrics.count("fragments_reused", cache.reused)
+            metrics.count("fragments_rendered", cache.rendered)
+        metrics.count("bytes_out", w.bytes_out)
+        metrics.count("outputs_unchanged", not w.changed)
+
+    if not w.changed:
+        print(f"EPG final inalterado: {out_path} mantido (canais: {len(channels)} unicos)")
+        return
+    print(f"✅ EPG final gravado: {out_path} (canais: {len(channels)} unicos de {len(m3u_channels)} entradas)")
+
+
+# ---------- saida em shards (--shard-by) ----------
+
+MANIFEST_FILE = "manifest.json"
+
+
+def shard_slug(label):
+    """Nome de arquivo estavel para um group-title ('REDE GLOBO - REGIONAIS' -> 'rede-globo-regionais')."""
+    slug = re.sub(r"[^a-z0-9]+", "-", normalize_name(label)).strip("-")
+    return slug or "sem-grupo"
+
+
+def plan_shards(m3u_channels, shard_by):
+    """
+    Divide as entradas da M3U em shards, na ordem da playlist.
+    shard_by: "group" (um shard por group-title) ou int (blocos de N canais unicos).
+    Cada tvg_id fica no shard da sua primeira entrada (como em unique_channels).
+    Rotulos distintos com o mesmo slug ('sem grupo' e um rotulo so com acentos) recebem
+    sufixo numerico na ordem da playlist ('sem-grupo', 'sem-grupo-2'), para que um shard
+    nao sobrescreva o outro.
+    Retorna lista de (nome_arquivo, rotulo, entradas).
+    """
+    shard_of = {}
+    labels = {}
+    slug_of = {}
     for ch in m3u_channels:
-        tvg = ch["tvg_id"]
-        name = ch["name"]
-        ch_el = ET.SubElement(tv, "channel", {"id": tvg})
-        ET.SubElement(ch_el, "display-name").text = name
-
-        mapped = mapping.get(tvg, (None, 0.0))[0]
-        if mapped and epg_events and mapped in epg_events:
-            events = epg_events[mapped]
-            for ev in events:
-                prog = ET.SubElement(tv, "programme", {
-                    "start": format_xmltv_datetime(ev["start"]),
-                    "stop": format_xmltv_datetime(ev["stop"]),
-                    "channel": tvg
-                })
-                ET.SubElement(prog, "title").text = ev["title"]
-                ET.SubElement(prog, "desc").text = ev["desc"]
+        tvg = ch.tvg_id
+        if tvg in shard_of:
+            continue
+        if shard_by == "group":
+            label = ch.group
+            key = slug_of.get(label)
+            if key is None:
+                base = key = shard_slug(label)
+                n = 1
+                while key in labels:
+                    n += 1
+                    key = f"{base}-{n}"
+                slug_of[label] = key
         else:
-            # fallback placeholders
-            for i in range(hours):
-                s = start_base + dt.timedelta(hours=i)
-                e = s + dt.timedelta(hours=1)
-                prog = ET.SubElement(tv, "programme", {
-                    "start": format_xmltv_datetime(s),
-                    "stop": format_xmltv_datetime(e),
-                    "channel": tvg
-                })
-                ET.SubElement(prog, "title").text = f"Program {i+1} - {name}"
-                ET.SubElement(prog, "desc").text = f"Programa gerado automaticamente - {name} - Bloco {i+1}"
-
-    xml_bytes = pretty_xml_bytes(tv)
-    with open(out_path, "wb") as f:
-        f.write(xml_bytes)
-    print(f"✅ EPG final gravado: {out_path} (canais: {len(m3u_channels)})")
+            n = len(shard_of) // shard_by
+            label, key = f"canais {n * shard_by + 1}-{(n + 1) * shard_by}", f"part-{n + 1:04d}"
+        shard_of[tvg] = key
+        labels.setdefault(key, label)
+    entries = {}
+    for ch in m3u_channels:
+        entries.setdefault(shard_of[ch.tvg_id], []).append(ch)
+    return [(key + ".xml", labels[key], chans) for key, chans in entries.items()]
+
+
+def remove_stale_fragment_caches(fragment_cache, live_slugs):
+    """Remove <fragment_cache>.<slug>.idx.json/.bin de shards fora de live_slugs."""
+    suffix = ".idx.json"
+    for idx in glob.glob(glob.escape(fragment_cache) + ".*" + suffix):
+        prefix = idx[:-len(suffix)]
+        if prefix[len(fragment_cache) + 1:] in live_slugs:
+            continue
+        for path in (idx, prefix + ".bin"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def build_sharded_epg(m3u_channels, epg_events, mapping, shard_dir, shard_by, hours=48, indent="  ",
+                      fragment_cache=None, metrics=None, block_minutes=60, shifts=None, jobs=1,
+                      canonical=False, tvg_shift=False, mp_context=None):
+    """
+    Grava um XMLTV completo por shard em shard_dir e um manifest.json com o
+    sha256, tamanho e numero de canais de cada shard, para que clientes (e o git)
+    so busquem os shards cujo hash mudou. Shards de execucoes anteriores que nao
+    existem mais sao removidos, junto com seus fragment caches. Retorna o caminho do manifest.
+    canonical: ver build_final_epg; o manifest fica sem generated_at e, como os
+    shards, so e regravado se mudou. "hours" no manifest e a janela de fato gravada
+    (hours + CANONICAL_ALIGN_HOURS em modo canonico).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_path = os.path.join(shard_dir, MANIFEST_FILE)
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            old_files = {s["file"] for s in json.load(f).get("shards", [])}
+    except (OSError, ValueError, KeyError, TypeError):
+        old_files = set()
+
+    shards = []
+    for filename, label, entries in plan_shards(m3u_channels, shard_by):
+        path = os.path.join(shard_dir, filename)
+        cache_prefix = f"{fragment_cache}.{filename[:-4]}" if fragment_cache else None
+        build_final_epg(entries, epg_events, mapping, hours=hours, out_path=path, indent=indent,
+                        fragment_cache=cache_prefix, metrics=metrics, block_minutes=block_minutes, shifts=shifts,
+                        jobs=jobs, canonical=canonical, tvg_shift=tvg_shift, mp_context=mp_context)
+        shards.append({
+            "file": filename,
+            "name": label,
+            "channels": len(unique_channels(entries)),
+            "bytes": os.path.getsize(path),
+            "sha256": file_sha256(path),
+        })
+
+    manifest = {
+        "generated_at": now_tz().isoformat(timespec="seconds"),
+        "shard_by": shard_by,
+        "hours": hours + CANONICAL_ALIGN_HOURS if canonical else hours,
+        "shards": shards,
+    }
+    if canonical:
+        del manifest["generated_at"]
+    data = json.dumps(manifest, indent=1, ensure_ascii=False).encode("utf-8")
+    try:
+        with open(manifest_path, "rb") as f:
+            unchanged = canonical and f.read() == data
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        with open(manifest_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    for stale in old_files - {s["file"] for s in shards}:
+        try:
+            os.remove(os.path.join(shard_dir, stale))
+        except OSError:
+            pass
+    if fragment_cache:
+        remove_stale_fragment_caches(fragment_cache, {s["file"][:-4] for s in shards})
+    if metrics is not None:
+        metrics.set("shards", len(shards))
+    print(f"Manifest {'inalterado' if unchanged else 'gravado'}: {manifest_path} ({len(shards)} shards)")
+    return manifest_path
+
+
+def shard_by_arg(value):
+    """--shard-by: 'group' ou N (> 0) canais por shard."""
+    if value == "group":
+        return value
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError("use 'group' ou um numero de canais por shard (> 0)")
+    return n
+
+
+def shift_arg(value):
+    """--shift: 'TVG_ID=HORAS' -> (tvg_id, segundos)."""
+    tvg, sep, hours = value.rpartition("=")
+    try:
+        if not sep or not tvg:
+            raise ValueError(value)
+        return tvg, parse_shift_hours(hours)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"use TVG_ID=HORAS (ex. globo.rj=-1), recebido {value!r}")
+
+
+def output_target(args):
+    """Arquivo cuja existencia/idade representa a saida da execucao (--out ou o manifest dos shards)."""
+    if args.shard_by:
+        return os.path.join(args.shard_dir, MANIFEST_FILE)
+    return args.out
+
+
+# ---------- run state (skip quando nada mudou) ----------
+
+def ingest_epg_source(epg_source, stream=False, window=None, passthrough=False):
+    """
+    Carrega e parseia uma fonte de EPG (URL ou arquivo). Roda em processo
+    separado quando ha varias fontes, por isso recebe/retorna so dados picklaveis.
+    Retorna (epg_channels, epg_events, bytes XML lidos) ou (None, None, bytes lidos) se a
+    fonte falhar, inclusive no meio da leitura (gzip/xz truncado, conexao interrompida).
+    """
+    print(f"Carregando EPG externo de: {epg_source}")
+    counted = None
+    try:
+        raw = open_external_stream(epg_source) if stream else load_external_raw(epg_source)
+        if raw is None:
+            return None, None, 0
+        if stream:
+            counted = CountingReader(raw)
+            with counted:
+                return parse_external_epg_stream(counted, window, passthrough) + (counted.bytes,)
+        try:
+            return parse_external_epg_raw(raw, window, passthrough) + (len(raw),)
+        finally:
+            if isinstance(raw, mmap.mmap):
+                raw.close()
+    except READ_ERRORS as e:
+        print(f"Erro ao ler EPG externo {epg_source}: {e}")
+        return None, None, counted.bytes if counted is not None else 0
+
+
+def ingest_epg_sources(sources, stream=False, window=None, passthrough=False, mp_context=None):
+    """
+    Parseia varias fontes em paralelo (um processo por fonte, limitado a cpu_count,
+    criados com mp_context; None = padrao da plataforma).
+    Retorna lista [(source, epg_channels, epg_events, bytes lidos)] na ordem de sources;
+    uma fonte cujo worker falhou (excecao ou processo morto) volta como (source, None, None, 0)
+    e as demais seguem. So se o pool nao puder ser criado as fontes sao lidas em sequencia.
+    """
+    if len(sources) == 1:
+        return [(sources[0],) + ingest_epg_source(sources[0], stream, window, passthrough)]
+    try:
+        pool = ProcessPoolExecutor(max_workers=min(len(sources), os.cpu_count() or 1), mp_context=mp_context)
+    except (OSError, NotImplementedError) as e:
+        print(f"Aviso: parse paralelo indisponivel ({e}); parseando fontes em sequencia")
+        return [(src,) + ingest_epg_source(src, stream, window, passthrough) for src in sources]
+    results = []
+    with pool:
+        futures = [pool.submit(ingest_epg_source, src, stream, window, passthrough) for src in sources]
+        for src, fut in zip(sources, futures):
+            try:
+                results.append((src,) + fut.result())
+            except Exception as e:
+                print(f"Erro ao parsear EPG externo {src}: {e!r}")
+                results.append((src, None, None, 0))
+    return results
+
+
+def merge_epg_sources(results):
+    """
+    Une os EPGs parseados (results na ordem de prioridade, a primeira fonte vence).
+    Canais: uniao por id (display-name da fonte de maior prioridade).
+    Eventos: por canal, a grade da fonte mais prioritaria e mantida inteira; eventos
+    de fontes seguintes so entram onde nao se sobrepoem a nenhum evento ja aceito
+    (preenchem buracos da grade).
+    Retorna (epg_channels, epg_events) ou (None, None) se nenhuma fonte foi parseada.
+    """
+    ok = [(chans, evs) for _, chans, evs, _ in results if chans is not None]
+    if not ok:
+        return None, None
+    if len(ok) == 1:
+        return ok[0]
+    epg_channels = []
+    seen = set()
+    epg_events = {}
+    for chans, evs in ok:
+        for ch in chans:
+            if ch["id"] not in seen:
+                seen.add(ch["id"])
+                epg_channels.append(ch)
+        for cid, sched in (evs or {}).items():
+            merged = epg_events.get(cid)
+            if merged is None:
+                epg_events[cid] = sched
+                continue
+            for ev in sched:
+                if not merged.between(ev.start, max(ev.stop, ev.start + 1)):
+                    merged.add(ev)
+    return epg_channels, epg_events
+
+
+# sem --past-hours, programas ja encerrados de execucoes anteriores ficam no store por no maximo este tempo
+STORE_RETENTION_HOURS = 24
+
+
+class StoreEvents:
+    """
+    Visao somente-leitura, no formato de epg_events (epg_id -> lista de Programme
+    ordenada), sobre um ProgrammeStore: cada canal e lido do SQLite quando
+    renderizado, entao so a grade do canal atual fica em memoria.
+    Cada processo (ex. workers do --jobs) usa a propria conexao SQLite.
+    """
+
+    def __init__(self, store, window=None):
+        self.path = store.path
+        self._store, self._pid = store, os.getpid()
+        self.lo, self.hi = window or (None, None)
+        self._ids = store.channel_ids(self.lo, self.hi)
+
+    @property
+    def store(self):
+        # conexoes SQLite nao atravessam fork/pickle: reabre no processo atual
+        if self._pid != os.getpid():
+            self._store, self._pid = ProgrammeStore(self.path), os.getpid()
+        return self._store
+
+    def __getstate__(self):
+        return self.path, self.lo, self.hi, self._ids
+
+    def __setstate__(self, state):
+        self.path, self.lo, self.hi, self._ids = state
+        self._store = self._pid = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, cid):
+        return cid in self._ids
+
+    def __getitem__(self, cid):
+        if cid not in self._ids:
+            raise KeyError(cid)
+        return [Programme(*row) for row in self.store.programmes(cid, self.lo, self.hi)]
+
+    def count(self):
+        return self.store.count(self.lo, self.hi)
+
+
+def ingest_into_store(store, sources, window=None, passthrough=False):
+    """
+    Grava as fontes no ProgrammeStore em sequencia (o SQLite tem um unico escritor),
+    na ordem de prioridade. Retorna lista [(source, canais ou None se falhou, bytes lidos)].
+    """
+    store.begin_run()
+    results = []
+    for src in sources:
+        print(f"Carregando EPG externo de: {src}")
+        n_chans = None
+        counted = None
+        try:
+            raw = open_external_stream(src)
+            if raw is not None:
+                counted = CountingReader(raw)
+                with counted:
+                    n_chans, n_progs, accepted = store.ingest(iter_external_epg(counted, window, passthrough))
+        except ET.ParseError as e:
+            print(f"Erro ao parsear EPG externo (stream): {e}")
+        except InvalidEPG as e:
+            print(f"Conteudo do EPG parece invalido ({e})")
+        except READ_ERRORS as e:
+            # store.ingest ja descartou o que a fonte tinha gravado
+            print(f"Erro ao ler EPG externo {src}: {e}")
+        if n_chans is not None:
+            print(f"EPG externo {src}: {n_progs} eventos lidos, {accepted} gravados no store")
+        results.append((src, n_chans, counted.bytes if counted is not None else 0))
+    if window and window[0] != float("-inf"):
+        cutoff = window[0]
+    else:
+        cutoff = now_tz().timestamp() - STORE_RETENTION_HOURS * 3600
+    pruned = store.prune(cutoff)
+    if pruned:
+        print(f"Store: {pruned} eventos encerrados removidos")
+    return results
+
+
+RUN_STATE_FILE = "run_state.json"
+
+
+def run_fingerprint(args, fetched):
+    """Hash das opcoes da execucao e do sha256 de cada fonte obtida via fetch_cache."""
+    h = hashlib.sha1(json.dumps(vars(args), sort_keys=True, default=str).encode("utf-8"))
+    for res in fetched:
+        h.update(f"{res.source}\t{res.sha256}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_run_state(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, RUN_STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_run_state(cache_dir, state):
+    path = os.path.join(cache_dir, RUN_STATE_FILE)
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Aviso: falha ao gravar {path}: {e}")
+
+
+def output_is_current(cache_dir, out_path, fingerprint, hours):
+    """
+    True se out_path foi gerado com as mesmas fontes e opcoes e os placeholders
+    ainda cobrem pelo menos metade da janela (--hours).
+    """
+    entry = load_run_state(cache_dir).get(os.path.abspath(out_path))
+    if not entry or entry.get("fingerprint") != fingerprint or not os.path.exists(out_path):
+        return False
+    try:
+        generated_at = dt.datetime.fromisoformat(entry["generated_at"])
+    except (KeyError, ValueError):
+        return False
+    return now_tz() - generated_at < dt.timedelta(hours=hours / 2)
+
+
+def record_run_state(cache_dir, out_path, fingerprint):
+    state = load_run_state(cache_dir)
+    state[os.path.abspath(out_path)] = {"fingerprint": fingerprint, "generated_at": now_tz().isoformat()}
+    save_run_state(cache_dir, state)
 
 
 # -------------- main ----------------
@@ -350,51 +2027,209 @@ def build_final_epg(m3u_channels, epg_events, mapping, hours=48, out_path="epg.x
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("m3u", help="Caminho ou URL da playlist .m3u (preferencial local)")
-    p.add_argument("--epg-source", help="URL ou arquivo local com EPG XML externo (opcional)", default=None)
+    p.add_argument("--epg-source", action="append", default=None,
+                   help="URL ou arquivo local com EPG XML externo (opcional; repetivel, "
+                        "a primeira fonte tem prioridade em sobreposicoes)")
     p.add_argument("--hours", type=int, default=48, help="Horas para placeholders (padrao 48)")
+    p.add_argument("--placeholder-block-minutes", type=int, default=60,
+                   help="Duracao de cada bloco de placeholder em minutos (padrao 60; maior = saida menor)")
+    p.add_argument("--shift", action="append", type=shift_arg, metavar="TVG_ID=HORAS",
+                   help="Timeshift do canal em horas aplicado no EPG (repetivel); vence o tvg-shift, 0 desliga")
+    p.add_argument("--apply-tvg-shift", action="store_true",
+                   help="Aplica o tvg-shift da M3U no EPG (so para players que ignoram tvg-shift; "
+                        "os demais deslocariam a grade duas vezes)")
     p.add_argument("--min-ratio", type=float, default=0.6, help="Ratio minimo para aceitar fuzzy match (0..1)")
+    p.add_argument("--matcher", choices=sorted(MATCHERS), default="indexed",
+                   help="Motor de fuzzy match: indexed (padrao), difflib (varredura completa) ou tfidf (numpy)")
+    p.add_argument("--map-cache", help="Opcional: CSV de cache do mapeamento reutilizado entre execucoes "
+                                         "(linhas com source=manual sao overrides)")
     p.add_argument("--out", default="epg.xml", help="Arquivo de saida")
     p.add_argument("--write-map", help="Opcional: grava CSV sugerido com mapeamento (tvg-id,epg-id,score)")
+    p.add_argument("--past-hours", type=float, default=None,
+                   help="Descarta no parse eventos que terminaram ha mais de N horas")
+    p.add_argument("--future-hours", type=float, default=None,
+                   help="Descarta no parse eventos que comecam daqui a mais de N horas")
+    p.add_argument("--compact", action="store_true", help="Grava XML sem indentacao (menor e mais rapido)")
+    p.add_argument("--stream", action="store_true",
+                   help="Parse incremental do EPG externo (iterparse), sem carregar o documento inteiro em memoria")
+    p.add_argument("--passthrough", action="store_true",
+                   help="Copia a marcacao original de cada <programme> (category, icon, episode-num, rating, lang...) "
+                        "reescrevendo so start/stop/channel")
+    p.add_argument("--jobs", type=int, default=1,
+                   help="Processos para renderizar os canais (padrao 1; 0 = numero de CPUs); saida identica")
+    p.add_argument("--canonical", action="store_true",
+                   help="Saida deterministica (canais por tvg-id, janelas alinhadas ao dia, sem conteudo volatil); "
+                        "--out so e regravado se o conteudo mudou")
+    p.add_argument("--fragment-cache", help="Opcional: prefixo do cache de fragmentos por canal "
+                                              "(regenera so canais alterados desde a execucao anterior)")
+    p.add_argument("--cache-dir", help="Opcional: diretorio de cache de downloads (ETag/Last-Modified); "
+                                         "fontes remotas passam a usar requisicoes condicionais")
+    p.add_argument("--skip-unchanged", action="store_true",
+                   help="Com --cache-dir: nao reprocessa se M3U, EPG e opcoes nao mudaram desde a ultima geracao")
+    p.add_argument("--require-epg", action="store_true",
+                   help="Falha (codigo 2, saida anterior mantida) se nenhuma fonte de EPG produzir eventos")
+    p.add_argument("--store", metavar="PATH",
+                   help="Opcional: banco SQLite de canais/programas; parse em streaming com memoria constante "
+                        "e reaproveitamento de programas de execucoes anteriores")
+    p.add_argument("--metrics-json", help="Opcional: grava tempos/memoria/contadores por estagio em JSON")
+    p.add_argument("--serve", metavar="[HOST:]PORT", type=parse_listen,
+                   help="Modo servidor: mantem EPG e mapping em memoria e serve /epg.xml (gzip, ETag, Range)")
+    p.add_argument("--refresh-minutes", type=float, default=30,
+                   help="Com --serve: intervalo entre atualizacoes das fontes (padrao 30)")
+    p.add_argument("--shard-by", type=shard_by_arg, metavar="group|N",
+                   help="Grava um XMLTV por group-title (group) ou por blocos de N canais, mais manifest.json, "
+                        "em --shard-dir (em vez de --out)")
+    p.add_argument("--shard-dir", default="epg_shards", help="Diretorio dos shards (padrao epg_shards)")
     args = p.parse_args()
 
+    if args.placeholder_block_minutes <= 0:
+        p.error("--placeholder-block-minutes deve ser > 0")
+    if args.jobs < 0:
+        p.error("--jobs deve ser >= 0")
+    args.jobs = args.jobs or os.cpu_count() or 1
+    if args.serve and args.shard_by:
+        p.error("--serve nao suporta --shard-by")
+    if args.serve:
+        # downloads condicionais sao o que torna as atualizacoes periodicas baratas
+        args.cache_dir = args.cache_dir or ".epg_cache"
+        host, port = args.serve
+        serve(host, port, LiveEPG(args).refresh, args.refresh_minutes * 60)
+        return
+
+    metrics = RunMetrics("epg_generator.py")
+    try:
+        run(args, metrics)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            metrics.status = "error"
+        raise
+    finally:
+        if args.metrics_json:
+            metrics.write(args.metrics_json)
+
+
+def fetch_sources(args, metrics):
+    """
+    Baixa M3U e fontes de EPG em paralelo pelo cache de downloads (--cache-dir).
+    Retorna (m3u_source, epg_sources, fetched) com caminhos locais e os FetchResult.
+    Levanta FetchError se a M3U nao puder ser obtida; fontes de EPG com falha sao omitidas.
+    """
+    epg_sources = list(args.epg_source or [])
+    with metrics.stage("download"), ThreadPoolExecutor(max_workers=1 + len(epg_sources)) as pool:
+        m3u_fut = pool.submit(fetch, args.m3u, args.cache_dir)
+        epg_futs = [pool.submit(fetch, src, args.cache_dir) for src in epg_sources]
+        m3u_res = m3u_fut.result()
+        fetched = [m3u_res]
+        paths = []
+        for src, fut in zip(epg_sources, epg_futs):
+            try:
+                epg_res = fut.result()
+            except FetchError as e:
+                print(f"Erro ao obter EPG externo {src}: {e}")
+                continue
+            fetched.append(epg_res)
+            paths.append(epg_res.path)
+            print(f"EPG externo {src}: {epg_res.status} ({'alterado' if epg_res.changed else 'inalterado'})")
+    return m3u_res.path, paths, fetched
+
+
+def load_playlist(m3u_source, metrics):
+    """Carrega e parseia a M3U; retorna a lista de canais (vazia se nada foi detectado)."""
     print("Carregando M3U...")
-    m3u_text = load_m3u(args.m3u)
-    m3u_channels = parse_m3u_text(m3u_text)
-    if not m3u_channels:
-        print("Nenhum canal detectado na M3U.")
-        sys.exit(2)
-    print(f"Canais detectados na M3U: {len(m3u_channels)}")
+    with metrics.stage("parse_m3u"), open_m3u(m3u_source) as raw:
+        counted = CountingReader(raw)
+        m3u_channels = list(iter_m3u(iter_m3u_lines(counted)))
+    metrics.count("bytes_in", counted.bytes)
+    metrics.set("m3u_entries", len(m3u_channels))
+    if m3u_channels:
+        print(f"Canais detectados na M3U: {len(m3u_channels)}")
+    return m3u_channels
 
-    epg_channels = []
-    epg_events = None
-    if args.epg_source:
-        print(f"Carregando EPG externo de: {args.epg_source}")
-        raw = load_external_raw(args.epg_source)
-        if raw is None:
-            print("Nao foi possivel obter EPG externo; sera gerado EPG com placeholders.")
+
+def load_epg(args, epg_sources, metrics, mp_context=None):
+    """
+    Parseia e une as fontes de EPG; retorna (epg_channels, epg_events) ou ([], None).
+    mp_context: ver ingest_epg_sources.
+    """
+    if not epg_sources:
+        if not args.epg_source:
+            print("Nenhum EPG externo informado; gerando placeholders unicamente.")
         else:
-            epg_channels, epg_events = parse_external_epg_raw(raw)
-            if epg_channels is None:
-                print("Falha ao parsear EPG externo; sera gerado EPG com placeholders.")
-                epg_channels = []
-                epg_events = None
-            else:
-                print(f"Canais no EPG externo: {len(epg_channels)}; eventos: {sum(len(v) for v in (epg_events or {}).values())}")
-    else:
-        print("Nenhum EPG externo informado; gerando placeholders unicamente.")
+            print("Nao foi possivel obter EPG externo; sera gerado EPG com placeholders.")
+        return [], None
+    window = event_window(args.past_hours, args.future_hours, args.canonical)
+    if args.store:
+        return load_epg_store(args, epg_sources, window, metrics)
+    with metrics.stage("parse_epg"):
+        results = ingest_epg_sources(epg_sources, args.stream, window, args.passthrough, mp_context)
+    for src, chans, _, nbytes in results:
+        metrics.count("bytes_in", nbytes)
+        if chans is None:
+            print(f"Falha ao obter/parsear EPG externo {src}; fonte ignorada.")
+    metrics.set("epg_sources", len(results))
+    metrics.set("epg_sources_failed", sum(1 for r in results if r[1] is None))
+    with metrics.stage("merge"):
+        epg_channels, epg_events = merge_epg_sources(results)
+    if epg_channels is None:
+        print("Nenhum EPG externo utilizavel; sera gerado EPG com placeholders.")
+        return [], None
+    n_events = count_events(epg_events)
+    metrics.set("epg_channels", len(epg_channels))
+    metrics.set("programmes_in", n_events)
+    print(f"Canais no EPG externo: {len(epg_channels)}; eventos: {n_events}")
+    return epg_channels, epg_events
 
-    # build mapping between m3u tvg_id and epg id
-    mapping = {}
+
+def count_events(epg_events):
+    """Total de programas em epg_events (dict de Schedule ou StoreEvents); 0 se None."""
+    if epg_events is None:
+        return 0
+    if isinstance(epg_events, StoreEvents):
+        return epg_events.count()
+    return sum(len(v) for v in epg_events.values())
+
+
+def load_epg_store(args, epg_sources, window, metrics):
+    """load_epg com --store: grava as fontes no SQLite e retorna (epg_channels, StoreEvents)."""
+    store = ProgrammeStore(args.store)
+    with metrics.stage("parse_epg"):
+        results = ingest_into_store(store, epg_sources, window, args.passthrough)
+    for src, chans, nbytes in results:
+        metrics.count("bytes_in", nbytes)
+        if chans is None:
+            print(f"Falha ao obter/parsear EPG externo {src}; fonte ignorada.")
+    metrics.set("epg_sources", len(results))
+    metrics.set("epg_sources_failed", sum(1 for r in results if r[1] is None))
+    with metrics.stage("merge"):
+        epg_channels = store.channels()
+        epg_events = StoreEvents(store, window)
+        n_events = epg_events.count()
+    if not epg_channels:
+        print("Nenhum EPG externo utilizavel; sera gerado EPG com placeholders.")
+        return [], None
+    metrics.set("epg_channels", len(epg_channels))
+    metrics.set("programmes_in", n_events)
+    print(f"Canais no EPG externo (store {args.store}): {len(epg_channels)}; eventos: {n_events}")
+    return epg_channels, epg_events
+
+
+def map_channels(args, m3u_channels, epg_channels, metrics):
+    """build_mapping (ou tudo None sem EPG) e, com --write-map, grava o CSV sugerido."""
     if epg_channels:
-        mapping = build_mapping(m3u_channels, epg_channels, min_ratio=args.min_ratio)
+        with metrics.stage("match"):
+            mapping = build_mapping(m3u_channels, epg_channels, min_ratio=args.min_ratio, matcher=args.matcher,
+                                    map_cache=args.map_cache)
     else:
         # tudo None
-        mapping = {ch["tvg_id"]: (None, 0.0) for ch in m3u_channels}
+        mapping = {ch.tvg_id: (None, 0.0) for ch in m3u_channels}
+    matched = sum(1 for mid, _ in mapping.values() if mid)
+    metrics.set("matched", matched)
+    metrics.set("unmatched", len(mapping) - matched)
 
     # opcional: gravar CSV com mapping sugerido
     if args.write_map:
         try:
-            with open(args.write_map, "w", newline="", encoding="utf-8") as f:
+            with metrics.stage("write_map"), open(args.write_map, "w", newline="", encoding="utf-8") as f:
                 writer = csv.writer(f)
                 writer.writerow(["tvg-id", "matched-epg-id", "score"])
                 for tvg, (mid, score) in mapping.items():
@@ -402,9 +2237,118 @@ def main():
             print(f"Map CSV gravado em: {args.write_map}")
         except Exception as e:
             print(f"Falha ao gravar map CSV: {e}")
+    return mapping
+
+
+def write_epg(args, m3u_channels, epg_events, mapping, metrics, mp_context=None):
+    # serialize inclui o tempo de escrita, medido a parte em "write"
+    with metrics.stage("serialize"):
+        if args.shard_by:
+            build_sharded_epg(m3u_channels, epg_events, mapping, args.shard_dir, args.shard_by, hours=args.hours,
+                              indent=None if args.compact else "  ", fragment_cache=args.fragment_cache,
+                              metrics=metrics, block_minutes=args.placeholder_block_minutes,
+                              shifts=dict(args.shift or ()), jobs=args.jobs, canonical=args.canonical,
+                              tvg_shift=args.apply_tvg_shift, mp_context=mp_context)
+            return
+        build_final_epg(m3u_channels, epg_events, mapping, hours=args.hours, out_path=args.out,
+                        indent=None if args.compact else "  ", fragment_cache=args.fragment_cache,
+                        metrics=metrics, block_minutes=args.placeholder_block_minutes,
+                        shifts=dict(args.shift or ()), jobs=args.jobs, canonical=args.canonical,
+                        tvg_shift=args.apply_tvg_shift, mp_context=mp_context)
+
+
+def run(args, metrics):
+    m3u_source, epg_sources = args.m3u, list(args.epg_source or [])
+    fingerprint = None
+    if args.cache_dir:
+        try:
+            m3u_source, epg_sources, fetched = fetch_sources(args, metrics)
+        except FetchError as e:
+            print(f"Erro ao obter M3U: {e}")
+            sys.exit(2)
+        fingerprint = run_fingerprint(args, fetched)
+        if args.skip_unchanged and output_is_current(args.cache_dir, output_target(args), fingerprint, args.hours):
+            print(f"Fontes inalteradas desde a ultima geracao; mantendo {output_target(args)}")
+            metrics.status = "skipped"
+            return
+
+    m3u_channels = load_playlist(m3u_source, metrics)
+    if not m3u_channels:
+        print("Nenhum canal detectado na M3U.")
+        sys.exit(2)
+    epg_channels, epg_events = load_epg(args, epg_sources, metrics)
+    if args.require_epg and not count_events(epg_events):
+        # ex. primeira execucao/cache vazio e fonte fora do ar: nao publicar uma grade so de placeholders
+        print(f"Erro: nenhum evento obtido do EPG externo (--require-epg); {output_target(args)} mantido")
+        sys.exit(2)
+    mapping = map_channels(args, m3u_channels, epg_channels, metrics)
 
     # finalmente, montar epg final
-    build_final_epg(m3u_channels, epg_events, mapping, hours=args.hours, out_path=args.out)
+    write_epg(args, m3u_channels, epg_events, mapping, metrics)
+    if fingerprint and (epg_events is not None or not args.epg_source):
+        record_run_state(args.cache_dir, output_target(args), fingerprint)
+
+
+# -------------- serve ----------------
+
+class LiveEPG:
+    """
+    Estado do modo --serve: M3U, EPG parseado e mapping ficam em memoria entre
+    atualizacoes. Cada refresh() faz as buscas condicionais (--cache-dir) e so
+    re-parseia a M3U / as fontes de EPG cujo sha256 mudou, ou o EPG quando a
+    janela de --past-hours/--future-hours anda (window_hour), so refaz o mapping
+    se alguma entrada mudou, e sempre re-renderiza (a grade de placeholders anda
+    com o relogio). Retorna os bytes do XMLTV gerado em --out.
+
+    refresh() roda no thread de atualizacao enquanto os threads do servidor
+    atendem: os processos de parse/--jobs sao criados com spawn, porque fork com
+    outros threads ativos pode herdar locks presos no processo filho.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.m3u_sha = None
+        self.epg_shas = None
+        self.window_hour = None
+        self.m3u_channels = None
+        self.epg_channels = []
+        self.epg_events = None
+        self.mapping = None
+        self.mp_context = multiprocessing.get_context("spawn")
+
+    def refresh(self):
+        args = self.args
+        metrics = RunMetrics("epg_generator.py --serve")
+        m3u_source, epg_sources, fetched = fetch_sources(args, metrics)
+        changed = False
+        if fetched[0].sha256 != self.m3u_sha:
+            m3u_channels = load_playlist(m3u_source, metrics)
+            if not m3u_channels:
+                raise RuntimeError("Nenhum canal detectado na M3U")
+            self.m3u_channels, self.m3u_sha = m3u_channels, fetched[0].sha256
+            changed = True
+        epg_shas = tuple((res.source, res.sha256) for res in fetched[1:])
+        hour = window_hour(args.past_hours, args.future_hours, args.canonical)
+        if epg_shas != self.epg_shas or hour != self.window_hour:
+            self.epg_channels, self.epg_events = load_epg(args, epg_sources, metrics, self.mp_context)
+            self.epg_shas, self.window_hour = epg_shas, hour
+            changed = True
+        if changed or self.mapping is None:
+            self.mapping = map_channels(args, self.m3u_channels, self.epg_channels, metrics)
+        write_epg(args, self.m3u_channels, self.epg_events, self.mapping, metrics, self.mp_context)
+        if args.metrics_json:
+            metrics.write(args.metrics_json)
+        with open(args.out, "rb") as f:
+            return f.read()
+
+
+def parse_listen(value):
+    """'[HOST:]PORT' -> (host, port); host padrao 127.0.0.1."""
+    host, _, port = value.rpartition(":")
+    try:
+        return host or "127.0.0.1", int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"endereco invalido: {value!r} (use [HOST:]PORT)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+epg_server.py
+
+Servidor HTTP do modo --serve do epg_generator.py.
+
+O XMLTV mais recente fica em memoria como um Snapshot imutavel: corpo, versao
+gzip pre-computada (compactada uma vez por atualizacao, nao por requisicao),
+ETag e Last-Modified. Um thread de fundo chama refresh() a cada intervalo e
+troca o snapshot atomicamente; se a atualizacao falhar, o anterior continua
+sendo servido. Cada requisicao so escolhe a representacao e fatia bytes.
+
+Rotas:
+  /epg.xml     : XMLTV (Content-Encoding gzip se o cliente aceitar)
+  /epg.xml.gz  : arquivo gzip (application/gzip)
+  /healthz     : 200 com idade do snapshot, 503 antes da primeira geracao
+
+Suporta GET/HEAD, If-None-Match / If-Modified-Since (304), Range de um
+intervalo (206/416) e If-Range.
+
+Uso:
+  serve("0.0.0.0", 8080, refresh, interval=1800)   # refresh() -> bytes do XMLTV
+"""
+
+import email.utils
+import gzip
+import hashlib
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GZIP_LEVEL = 6
+CACHE_CONTROL = "public, max-age=60"
+
+
+class Snapshot:
+    """Corpo XMLTV publicado + versao gzip e validadores."""
+
+    __slots__ = ("body", "gz", "etag", "last_modified", "mtime")
+
+    def __init__(self, body, mtime=None):
+        self.body = body
+        self.gz = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.mtime = int(mtime if mtime is not None else time.time())
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+
+
+def parse_range(header, size):
+    """
+    'bytes=a-b' / 'bytes=a-' / 'bytes=-n' -> (inicio, fim inclusivo); None se o
+    cabecalho nao for um intervalo unico valido, inclusive b < a (RFC 9110: o
+    Range e ignorado e o corpo inteiro e servido), e False se for insatisfazivel (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            n = int(last)
+            if n <= 0:
+                return False
+            return max(0, size - n), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        return False
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+class EPGServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, handler=None):
+        super().__init__(addr, handler or EPGRequestHandler)
+        self.snapshot = None
+        self.refreshed_at = None
+
+    def publish(self, body):
+        """Troca o snapshot; mantem o atual (e Last-Modified) se o corpo nao mudou."""
+        current = self.snapshot
+        self.refreshed_at = time.time()
+        if current is not None and len(current.body) == len(body) and current.body == body:
+            return False
+        self.snapshot = Snapshot(body)
+        return True
+
+
+class EPGRequestHandler(BaseHTTPRequestHandler):
+    server_version = "epg_generator"
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def do_GET(self):
+        self._respond(head=False)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _respond(self, head):
+        path = self.path.split("?", 1)[0]
+        snap = self.server.snapshot
+        if path == "/healthz":
+            if snap is None:
+                return self._simple(503, "gerando\n", head)
+            age = int(time.time() - self.server.refreshed_at)
+            return self._simple(200, f"ok {len(snap.body)} bytes, atualizado ha {age}s\n", head)
+        if path not in ("/", "/epg.xml", "/epg.xml.gz"):
+            return self._simple(404, "not found\n", head)
+        if snap is None:
+            return self._simple(503, "EPG ainda nao gerado\n", head, {"Retry-After": "30"})
+
+        if path == "/epg.xml.gz":
+            body, etag, ctype, encoding = snap.gz, snap.etag[:-1] + '-gz"', "application/gzip", None
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            body, etag, ctype, encoding = snap.gz, snap.etag[:-1] + '-gz"', "application/xml; charset=utf-8", "gzip"
+        else:
+            body, etag, ctype, encoding = snap.body, snap.etag, "application/xml; charset=utf-8", None
+
+        headers = {
+            "ETag": etag,
+            "Last-Modified": snap.last_modified,
+            "Cache-Control": CACHE_CONTROL,
+            "Accept-Ranges": "bytes",
+            "Vary": "Accept-Encoding",
+            "Content-Type": ctype,
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            if inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]:
+                return self._send(304, headers, b"", True)
+        elif self.headers.get("If-Modified-Since") == snap.last_modified:
+            return self._send(304, headers, b"", True)
+
+        rng = parse_range(self.headers.get("Range"), len(body))
+        if_range = self.headers.get("If-Range")
+        if rng is not None and if_range and if_range not in (etag, snap.last_modified):
+            rng = None
+        if rng is False:
+            headers["Content-Range"] = f"bytes */{len(body)}"
+            return self._send(416, headers, b"", head)
+        if rng is not None:
+            start, end = rng
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            return self._send(206, headers, memoryview(body)[start:end + 1], head)
+        return self._send(200, headers, body, head)
+
+    def _simple(self, code, text, head, extra=None):
+        headers = {"Content-Type": "text/plain; charset=utf-8", "Cache-Control": "no-store"}
+        headers.update(extra or {})
+        self._send(code, headers, text.encode("utf-8"), head)
+
+    def _send(self, code, headers, body, head):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if code != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head and code != 304:
+            self.wfile.write(body)
+
+
+def refresh_loop(server, refresh, interval, stop):
+    """Chama refresh() a cada interval segundos ate stop ser sinalizado."""
+    while not stop.wait(interval):
+        run_refresh(server, refresh)
+
+
+def run_refresh(server, refresh):
+    try:
+        t0 = time.perf_counter()
+        changed = server.publish(refresh())
+        snap = server.snapshot
+        print(f"[serve] EPG {'atualizado' if changed else 'inalterado'} em {time.perf_counter() - t0:.1f}s "
+              f"({len(snap.body)} bytes, gzip {len(snap.gz)} bytes, ETag {snap.etag})")
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        print(f"[serve] Falha ao atualizar EPG ({e}); mantendo versao anterior")
+        traceback.print_exc()
+
+
+def serve(host, port, refresh, interval):
+    """
+    Gera o primeiro snapshot, inicia o thread de atualizacao e atende ate Ctrl+C.
+    refresh: funcao sem argumentos que retorna os bytes do XMLTV.
+    """
+    server = EPGServer((host, port))
+    print(f"[serve] Escutando em http://{host}:{port}/epg.xml (atualizacao a cada {interval / 60:g} min)")
+    run_refresh(server, refresh)
+    stop = threading.Event()
+    worker = threading.Thread(target=refresh_loop, args=(server, refresh, interval, stop), daemon=True)
+    worker.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
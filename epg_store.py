@@ -0,0 +1,196 @@
+"""
+epg_store.py
+
+Armazenamento opcional (SQLite) de canais e programas do EPG externo, usado
+pelo epg_generator.py com --store PATH.
+
+Em vez de manter todos os eventos em memoria, cada fonte e lida em streaming
+e gravada em lotes (executemany em transacoes) numa tabela temporaria; no fim
+da fonte os programas sao mesclados na tabela principal, indexada por
+(channel, start) (o rowid preserva a ordem de chegada entre inicios iguais).
+A renderizacao le um canal por vez, entao a memoria nao depende do tamanho
+do feed.
+
+Mescla entre fontes e entre execucoes (cada execucao tem um run id):
+  - programas de execucoes anteriores que se sobrepoem ao intervalo coberto
+    pela fonte atual naquele canal sao substituidos pelos novos;
+  - fora desse intervalo eles sao mantidos, entao se o provedor deixar de
+    publicar alguns dias, a grade ja conhecida continua sendo usada;
+  - dentro da mesma execucao a primeira fonte tem prioridade: fontes seguintes
+    so preenchem buracos (nao entram programas que se sobrepoem aos ja aceitos).
+Programas antigos que terminaram antes do limite de retencao sao removidos (prune).
+
+Uso:
+  store = ProgrammeStore("epg.sqlite")
+  store.begin_run()
+  store.ingest(items)            # ("channel", {id, display}) / ("programme", (channel, ev))
+  rows = store.programmes("globo.sp", lo_ts, hi_ts)
+"""
+
+import datetime as dt
+import sqlite3
+
+BATCH_SIZE = 5000
+# limites usados quando nao ha janela (SQLite nao tem infinito para INTEGER)
+TS_MIN = -(1 << 62)
+TS_MAX = 1 << 62
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    id TEXT PRIMARY KEY,
+    display TEXT NOT NULL,
+    run INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS programmes (
+    channel TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    start_s TEXT NOT NULL,
+    stop_s TEXT NOT NULL,
+    title TEXT NOT NULL,
+    desc TEXT NOT NULL,
+    raw TEXT,
+    run INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS programmes_channel_start ON programmes (channel, start);
+"""
+
+
+class ProgrammeStore:
+    """Canais e programas do EPG externo num arquivo SQLite (ver docstring do modulo)."""
+
+    def __init__(self, path):
+        self.path = path
+        # check_same_thread=False: no --serve o refresh roda no thread de atualizacao
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        if "raw" not in {row[1] for row in self.db.execute("PRAGMA table_info(programmes)")}:
+            # stores criados antes do --passthrough
+            self.db.execute("ALTER TABLE programmes ADD COLUMN raw TEXT")
+        self.run = None
+        self._max_len = None
+
+    def close(self):
+        self.db.close()
+
+    def begin_run(self):
+        """Abre uma nova execucao; programas gravados a partir daqui pertencem a ela."""
+        with self.db:
+            cur = self.db.execute("INSERT INTO runs (started_at) VALUES (?)",
+                                  (dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),))
+        self.run = cur.lastrowid
+        self._max_len = None
+        return self.run
+
+    def ingest(self, items):
+        """
+        Grava os itens de uma fonte (iter_external_epg) e mescla na tabela principal.
+        Se a leitura falhar no meio, nada da fonte e aplicado e a excecao e repassada.
+        Retorna (canais lidos, programas lidos, programas aceitos).
+        """
+        db = self.db
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS incoming ("
+                   "channel TEXT, start INTEGER, stop INTEGER, start_s TEXT, stop_s TEXT, title TEXT, desc TEXT, "
+                   "raw TEXT)")
+        db.execute("DELETE FROM temp.incoming")
+        channels = []
+        batch = []
+        n_prog = 0
+        try:
+            for kind, item in items:
+                if kind == "channel":
+                    channels.append((item["id"], item["display"], self.run))
+                    continue
+                ch, ev = item
+                batch.append((ch, ev.start, ev.stop, ev.start_s, ev.stop_s, ev.title, ev.desc, ev.raw))
+                if len(batch) >= BATCH_SIZE:
+                    with db:
+                        db.executemany("INSERT INTO temp.incoming VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                    n_prog += len(batch)
+                    batch = []
+            with db:
+                db.executemany("INSERT INTO temp.incoming VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            n_prog += len(batch)
+        except BaseException:
+            db.execute("DELETE FROM temp.incoming")
+            raise
+
+        with db:
+            # primeira fonte da execucao define o display-name (mesma regra de merge_epg_sources)
+            db.executemany("INSERT INTO channels (id, display, run) VALUES (?, ?, ?) "
+                           "ON CONFLICT(id) DO UPDATE SET display = excluded.display, run = excluded.run "
+                           "WHERE channels.run < excluded.run", [c for c in channels if c[0]])
+            db.execute("DROP TABLE IF EXISTS temp.ranges")
+            db.execute("CREATE TEMP TABLE ranges (channel TEXT PRIMARY KEY, lo INTEGER, hi INTEGER)")
+            db.execute("INSERT INTO temp.ranges SELECT channel, MIN(start), MAX(stop) FROM temp.incoming "
+                       "GROUP BY channel")
+            # dados de execucoes anteriores cobertos pela fonte atual saem
+            db.execute("DELETE FROM programmes WHERE run < ? AND EXISTS ("
+                       "SELECT 1 FROM temp.ranges r WHERE r.channel = programmes.channel "
+                       "AND programmes.start < r.hi AND programmes.stop > r.lo)", (self.run,))
+            # na mesma execucao, so entra o que nao se sobrepoe a programas ja aceitos
+            # (programas de duracao zero contam como [start, start + 1), como em merge_epg_sources)
+            max_len = db.execute("SELECT COALESCE(MAX(stop - start), 0) FROM programmes WHERE run = ?",
+                                 (self.run,)).fetchone()[0]
+            before = db.total_changes
+            db.execute("INSERT INTO programmes (channel, start, stop, start_s, stop_s, title, desc, raw, run) "
+                       "SELECT i.channel, i.start, i.stop, i.start_s, i.stop_s, i.title, i.desc, i.raw, ? "
+                       "FROM temp.incoming i WHERE NOT EXISTS ("
+                       "SELECT 1 FROM programmes p WHERE p.channel = i.channel AND p.run = ? "
+                       "AND p.start < MAX(i.stop, i.start + 1) AND p.start > i.start - ? AND p.stop > i.start) "
+                       "ORDER BY i.channel, i.start, i.rowid", (self.run, self.run, max_len))
+            accepted = db.total_changes - before
+            db.execute("DELETE FROM temp.incoming")
+        self._max_len = None
+        return len(channels), n_prog, accepted
+
+    def prune(self, before_ts):
+        """
+        Remove programas de execucoes anteriores que terminaram antes de before_ts
+        (os da execucao atual ja passaram pela janela do parse); retorna quantos.
+        """
+        with self.db:
+            cur = self.db.execute("DELETE FROM programmes WHERE stop <= ? AND run < ?",
+                                  (int(before_ts), self.run or 0))
+        self._max_len = None
+        return cur.rowcount
+
+    def channels(self):
+        """Canais conhecidos [{id, display}] na ordem em que apareceram pela primeira vez."""
+        return [{"id": cid, "display": display}
+                for cid, display in self.db.execute("SELECT id, display FROM channels ORDER BY rowid")]
+
+    def channel_ids(self, lo=None, hi=None):
+        """Ids de canais com pelo menos um programa que intersecta [lo, hi)."""
+        return {row[0] for row in self.db.execute(
+            "SELECT DISTINCT channel FROM programmes WHERE stop > ? AND start < ?", self._bounds(lo, hi))}
+
+    def count(self, lo=None, hi=None):
+        return self.db.execute("SELECT COUNT(*) FROM programmes WHERE stop > ? AND start < ?",
+                               self._bounds(lo, hi)).fetchone()[0]
+
+    def programmes(self, channel, lo=None, hi=None):
+        """
+        Programas de channel que intersectam [lo, hi), ordenados por inicio:
+        tuplas (start, stop, start_s, stop_s, title, desc, raw). Usa o indice
+        (channel, start), limitado para tras pela maior duracao conhecida.
+        """
+        lo, hi = self._bounds(lo, hi)
+        if self._max_len is None:
+            self._max_len = self.db.execute("SELECT COALESCE(MAX(stop - start), 0) FROM programmes").fetchone()[0]
+        return self.db.execute(
+            "SELECT start, stop, start_s, stop_s, title, desc, raw FROM programmes "
+            "WHERE channel = ? AND start < ? AND start >= ? AND stop > ? ORDER BY start, rowid",
+            (channel, hi, max(lo - self._max_len, TS_MIN), lo)).fetchall()
+
+    @staticmethod
+    def _bounds(lo, hi):
+        lo = TS_MIN if lo is None or lo == float("-inf") else int(lo)
+        hi = TS_MAX if hi is None or hi == float("inf") else int(hi) + 1
+        return lo, hi
@@ -0,0 +1,270 @@
+"""
+fetch_cache.py
+
+Camada de download compartilhada por epg_generator.py e build_epg_br.py, com
+cache em disco e requisicoes condicionais.
+
+Para URLs o corpo fica em <cache_dir>/<sha1(url)>.body e os validadores
+(ETag / Last-Modified / sha256) em <sha1(url)>.json; a proxima busca envia
+If-None-Match / If-Modified-Since e reaproveita o corpo em cache quando o
+servidor responde 304. Para caminhos locais so o sha256 e registrado.
+Em ambos os casos FetchResult.changed indica se o conteudo mudou desde a
+ultima busca, permitindo pular parse e regravacao quando nada mudou.
+
+Leitura: open_bytes/read_bytes/decompressing entregam bytes ao parser sem
+passar por str (mmap para arquivos locais simples; gzip/xz detectados pelos
+magic bytes e descompactados em streaming, seja .gz/.xz local, corpo em cache
+ou resposta HTTP com Content-Type/Content-Encoding gzip).
+
+Uso:
+  res = fetch("https://epg.brtwo.fyi/epg.xml.gz", ".epg_cache")
+  if res.changed:
+      with open_bytes(res.path) as f:
+          parse(f)
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+from urllib.parse import urlparse
+import urllib.error
+import urllib.request
+import zlib
+
+try:
+    import requests
+    from urllib3.exceptions import HTTPError as Urllib3Error
+except ImportError:
+    requests = None
+    Urllib3Error = None
+
+DEFAULT_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0"
+CHUNK_SIZE = 1 << 20
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# falhas ao ler o corpo de uma fonte ja aberta: gzip/xz truncado ou corrompido,
+# arquivo ilegivel ou conexao interrompida no meio da resposta (ProtocolError...)
+READ_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError)
+if requests is not None:
+    READ_ERRORS += (requests.RequestException, Urllib3Error)
+
+
+class FetchError(RuntimeError):
+    """Falha ao obter a fonte (e nao ha copia em cache utilizavel)."""
+
+
+class FetchResult:
+    """path: arquivo local com o conteudo; changed: conteudo difere da busca anterior;
+    status: 200, 304, "local" ou "stale" (erro de rede, usando copia em cache)."""
+
+    __slots__ = ("source", "path", "changed", "status", "sha256")
+
+    def __init__(self, source, path, changed, status, sha256):
+        self.source = source
+        self.path = path
+        self.changed = changed
+        self.status = status
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return f"FetchResult({self.source!r}, changed={self.changed}, status={self.status})"
+
+
+def is_url(source):
+    return urlparse(source).scheme in ("http", "https")
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compression_of(head):
+    """'gz', 'xz' ou None a partir dos primeiros bytes."""
+    if head.startswith(GZIP_MAGIC):
+        return "gz"
+    if head.startswith(XZ_MAGIC):
+        return "xz"
+    return None
+
+
+def decompressing(stream):
+    """Envolve um stream binario; se for gzip/xz, descompacta on the fly."""
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream, CHUNK_SIZE)
+    kind = compression_of(stream.peek(len(XZ_MAGIC))[:len(XZ_MAGIC)])
+    if kind == "gz":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if kind == "xz":
+        return lzma.LZMAFile(stream)
+    return stream
+
+
+def response_stream(response):
+    """
+    Corpo de uma resposta requests (stream=True) como stream binario para o
+    parser: Content-Encoding decodificado pelo urllib3, gzip/xz do proprio
+    arquivo por decompressing. auto_close=False impede o urllib3 de fechar o
+    corpo sozinho no EOF (o BufferedReader de decompressing leria um arquivo
+    fechado); o chamador fecha o stream ou a resposta.
+    """
+    raw = response.raw
+    raw.decode_content = True
+    raw.auto_close = False
+    return decompressing(raw)
+
+
+def decompress_bytes(data):
+    """Descompacta data (bytes) se for gzip/xz; caso contrario devolve como esta."""
+    kind = compression_of(data[:len(XZ_MAGIC)])
+    if kind == "gz":
+        return gzip.decompress(data)
+    if kind == "xz":
+        return lzma.decompress(data)
+    return data
+
+
+def open_bytes(path):
+    """
+    Abre arquivo local para leitura binaria em streaming: .gz/.xz (pelos magic
+    bytes) sao descompactados; arquivos simples sao mapeados em memoria (mmap).
+    """
+    with open(path, "rb") as f:
+        kind = compression_of(f.read(len(XZ_MAGIC)))
+    if kind == "gz":
+        return gzip.open(path, "rb")
+    if kind == "xz":
+        return lzma.open(path, "rb")
+    f = open(path, "rb")
+    if os.fstat(f.fileno()).st_size == 0:
+        return f
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    return mm
+
+
+def read_bytes(path):
+    """Conteudo completo de um arquivo local como buffer (mmap se simples, bytes se compactado)."""
+    reader = open_bytes(path)
+    if isinstance(reader, mmap.mmap):
+        return reader
+    with reader:
+        return reader.read()
+
+
+def cache_paths(source, cache_dir):
+    key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    base = os.path.join(cache_dir, key)
+    return base + ".body", base + ".json"
+
+
+def load_meta(meta_path):
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_meta(meta_path, meta):
+    tmp = meta_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.replace(tmp, meta_path)
+
+
+def http_get(url, headers, timeout):
+    """
+    GET em streaming. Retorna (status, headers_resposta, fileobj ou None em 304).
+    Content-Encoding gzip nao e decodificado aqui: o corpo gzip fica no cache.
+    """
+    if requests is not None:
+        r = requests.get(url, headers=headers, timeout=timeout, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return 304, r.headers, None
+        r.raise_for_status()
+        # corpo gravado como veio (gzip fica compactado no cache; open_bytes descompacta)
+        encoding = r.headers.get("Content-Encoding", "").lower()
+        r.raw.decode_content = encoding not in ("", "identity", "gzip", "x-gzip")
+        return r.status_code, r.headers, r.raw
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, e.headers, None
+        raise
+    return resp.status, resp.headers, resp
+
+
+def fetch(source, cache_dir, timeout=60, ua=None):
+    """
+    Obtem source (URL ou caminho local) usando o cache em cache_dir.
+    Retorna FetchResult; levanta FetchError se nao houver conteudo disponivel.
+    Em erro de rede com corpo em cache, devolve a copia antiga (status "stale").
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path, meta_path = cache_paths(source, cache_dir)
+    meta = load_meta(meta_path)
+
+    if not is_url(source):
+        path = urlparse(source).path if source.startswith("file:") else source
+        if not os.path.exists(path):
+            raise FetchError(f"Arquivo local nao encontrado: {path}")
+        digest = file_sha256(path)
+        changed = digest != meta.get("sha256")
+        if changed:
+            save_meta(meta_path, {"source": source, "sha256": digest})
+        return FetchResult(source, path, changed, "local", digest)
+
+    headers = {"User-Agent": ua or DEFAULT_UA, "Accept-Encoding": "gzip"}
+    have_body = os.path.exists(body_path) and meta.get("sha256")
+    if have_body:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        status, resp_headers, body = http_get(source, headers, timeout)
+        if status == 304:
+            if not have_body:
+                raise FetchError(f"304 sem corpo em cache para {source}")
+            return FetchResult(source, body_path, False, 304, meta["sha256"])
+        tmp = body_path + ".tmp"
+        h = hashlib.sha256()
+        try:
+            with body, open(tmp, "wb") as out:
+                for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+                    h.update(chunk)
+                    out.write(chunk)
+            os.replace(tmp, body_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except FetchError:
+        raise
+    except Exception as e:
+        if have_body:
+            print(f"Aviso: falha ao baixar {source} ({e}); usando copia em cache")
+            return FetchResult(source, body_path, False, "stale", meta["sha256"])
+        raise FetchError(f"download falhou: {e}")
+
+    digest = h.hexdigest()
+    save_meta(meta_path, {
+        "source": source,
+        "sha256": digest,
+        "etag": resp_headers.get("ETag"),
+        "last_modified": resp_headers.get("Last-Modified"),
+    })
+    return FetchResult(source, body_path, digest != meta.get("sha256"), status, digest)
+
@@ -0,0 +1,182 @@
+"""
+run_metrics.py
+
+Instrumentacao por estagio compartilhada por epg_generator.py e build_epg_br.py
+(--metrics-json PATH).
+
+Cada estagio (download, parse, match, serialize...) registra tempo de parede,
+tempo de CPU do processo e o pico de memoria residente (ru_maxrss) ao final,
+junto com quanto esse pico cresceu durante o estagio. Etapas intercaladas num
+mesmo passe de streaming (ex. classificar/serializar/gravar em build_epg_br)
+acumulam so tempo de parede via add_time, sem custo de CPU-time por elemento.
+Contadores (canais, programas, bytes...) ficam em counters.
+
+O relatorio JSON tem uma linha por execucao, pronto para ser anexado/plotado:
+  {"script", "started_at", "status", "wall_s", "cpu_s", "max_rss_mb",
+   "stages": {nome: {wall_s, cpu_s, calls, max_rss_mb, rss_growth_mb}}, "counters": {...}}
+
+Uso:
+  metrics = RunMetrics("epg_generator.py")
+  with metrics.stage("parse"):
+      ...
+  metrics.count("programmes", n)
+  metrics.write("metrics.json")
+"""
+
+import datetime as dt
+import io
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def max_rss_mb(who=None):
+    """Pico de memoria residente do processo (ou dos filhos) em MB; None sem resource."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # ru_maxrss: KB no Linux, bytes no macOS
+    return round(rss / (1e6 if sys.platform == "darwin" else 1e3), 1)
+
+
+class RunMetrics:
+    """Coleta tempos por estagio e contadores de uma execucao."""
+
+    def __init__(self, script):
+        self.script = script
+        self.started_at = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+        self.stages = {}
+        self.counters = {}
+        self.status = "ok"
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    def _entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {"wall_s": 0.0, "cpu_s": None, "calls": 0}
+        return entry
+
+    @contextmanager
+    def stage(self, name):
+        """Mede o bloco como estagio name (chamadas repetidas acumulam)."""
+        rss_before = max_rss_mb()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            entry = self._entry(name)
+            entry["wall_s"] += time.perf_counter() - wall0
+            entry["cpu_s"] = (entry["cpu_s"] or 0.0) + time.process_time() - cpu0
+            entry["calls"] += 1
+            rss_after = max_rss_mb()
+            if rss_after is not None:
+                entry["max_rss_mb"] = rss_after
+                entry["rss_growth_mb"] = round(entry.get("rss_growth_mb", 0.0) + rss_after - rss_before, 1)
+
+    def add_time(self, name, seconds, calls=1):
+        """Acumula tempo de parede de uma etapa intercalada (sem CPU/memoria)."""
+        entry = self._entry(name)
+        entry["wall_s"] += seconds
+        entry["calls"] += calls
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def report(self):
+        stages = {}
+        for name, entry in self.stages.items():
+            entry = dict(entry)
+            entry["wall_s"] = round(entry["wall_s"], 4)
+            if entry["cpu_s"] is not None:
+                entry["cpu_s"] = round(entry["cpu_s"], 4)
+            stages[name] = entry
+        out = {
+            "script": self.script,
+            "started_at": self.started_at,
+            "status": self.status,
+            "wall_s": round(time.perf_counter() - self._wall0, 4),
+            "cpu_s": round(time.process_time() - self._cpu0, 4),
+            "max_rss_mb": max_rss_mb(),
+            "stages": stages,
+            "counters": self.counters,
+        }
+        if resource is not None:
+            children = max_rss_mb(resource.RUSAGE_CHILDREN)
+            if children:
+                out["children_max_rss_mb"] = children
+        return out
+
+    def write(self, path):
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, indent=1)
+            os.replace(tmp, path)
+            print(f"Metricas gravadas em: {path}")
+        except OSError as e:
+            print(f"Aviso: falha ao gravar metricas em {path}: {e}")
+
+
+class CountingReader:
+    """Envolve um stream binario de leitura contando os bytes entregues ao parser."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self):
+        line = self._stream.readline()
+        self.bytes += len(line)
+        return line
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TimedWriter(io.BufferedIOBase):
+    """
+    Envolve o arquivo de saida (binario) acumulando o tempo de parede gasto nas
+    escritas em metrics[stage]. Como o XMLTVWriter escreve em blocos pelo buffer
+    do TextIOWrapper, o custo da medicao e por bloco, nao por no. Bytes gravados
+    sao contados por quem abre a saida (open_xmltv: w.bytes_out), nao aqui.
+    """
+
+    def __init__(self, raw, metrics, stage="write"):
+        super().__init__()
+        self._raw = raw
+        self._metrics = metrics
+        self._stage = stage
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        t0 = time.perf_counter()
+        n = self._raw.write(data)
+        self._metrics.add_time(self._stage, time.perf_counter() - t0)
+        return n
+
+    def flush(self):
+        self._raw.flush()
@@ -0,0 +1,82 @@
+"""Fixtures compartilhadas pelos testes: raiz do repositorio no sys.path e servidor HTTP local."""
+
+import hashlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LocalServer:
+    """
+    Servidor HTTP de teste: files (caminho -> bytes) servidos com ETag (sha1 do
+    corpo) e 304 para If-None-Match igual; extra (caminho -> cabecalhos) e
+    acrescentado a resposta 200; fail=True responde 500 a tudo; cut (caminho ->
+    n) anuncia o Content-Length inteiro mas fecha a conexao apos n bytes do corpo.
+    requests guarda (caminho, cabecalhos; busca sem diferenciar maiusculas) de
+    cada GET recebido.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.extra = {}
+        self.cut = {}
+        self.fail = False
+        self.requests = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.local = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/{path}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        local = self.server.local
+        path = self.path.lstrip("/")
+        local.requests.append((path, self.headers))
+        if local.fail:
+            return self._send(500, b"erro\n")
+        body = local.files.get(path)
+        if body is None:
+            return self._send(404, b"not found\n")
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", {"ETag": etag})
+        headers = {"ETag": etag}
+        headers.update(local.extra.get(path, {}))
+        self._send(200, body, headers, local.cut.get(path))
+
+    def _send(self, code, body, headers=None, cut=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if code != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if code != 304:
+            self.wfile.write(body if cut is None else body[:cut])
+        if cut is not None:
+            self.wfile.flush()
+            self.close_connection = True
+
+
+@pytest.fixture
+def http_server():
+    server = LocalServer()
+    server.thread.start()
+    try:
+        yield server
+    finally:
+        server.httpd.shutdown()
+        server.httpd.server_close()
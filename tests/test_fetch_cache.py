@@ -0,0 +1,245 @@
+import gzip
+import lzma
+import os
+import subprocess
+import sys
+
+import pytest
+
+import build_epg_br
+import epg_generator as eg
+import fetch_cache
+
+needs_requests = pytest.mark.skipif(fetch_cache.requests is None, reason="requests nao instalado")
+
+EPG = (b'<?xml version="1.0" encoding="utf-8"?>\n<tv>\n'
+       b'  <channel id="globo.sp"><display-name>Globo SP</display-name></channel>\n'
+       b'  <programme start="20260101000000 -0300" stop="20260101010000 -0300" channel="globo.sp">'
+       b'<title>Jornal</title><category>News</category></programme>\n'
+       b'</tv>\n')
+
+
+def serve_epg(server, kind):
+    """Publica EPG em server como arquivo simples, arquivo .gz ou com Content-Encoding gzip."""
+    if kind == "plain":
+        server.files["epg.xml"] = EPG
+        return server.url("epg.xml")
+    if kind == "gz":
+        server.files["epg.xml.gz"] = gzip.compress(EPG)
+        return server.url("epg.xml.gz")
+    server.files["epg.xml"] = gzip.compress(EPG)
+    server.extra["epg.xml"] = {"Content-Encoding": "gzip"}
+    return server.url("epg.xml")
+
+
+@needs_requests
+@pytest.mark.parametrize("kind", ["plain", "gz", "content-encoding"])
+def test_open_external_stream_http(http_server, kind):
+    url = serve_epg(http_server, kind)
+    channels, events = eg.parse_external_epg_stream(eg.open_external_stream(url))
+    assert channels == [{"id": "globo.sp", "display": "Globo SP"}]
+    assert [ev.title for ev in events["globo.sp"]] == ["Jornal"]
+
+
+@needs_requests
+def test_ingest_http_passthrough(http_server):
+    url = serve_epg(http_server, "gz")
+    channels, events, nbytes = eg.ingest_epg_source(url, stream=True, passthrough=True)
+    assert nbytes == len(EPG)
+    assert "<category>News</category>" in events["globo.sp"][0].raw
+
+
+@needs_requests
+@pytest.mark.parametrize("kind", ["plain", "gz"])
+def test_build_epg_br_open_source_http(http_server, kind):
+    url = serve_epg(http_server, kind)
+    classifier = build_epg_br.KeywordClassifier(["globo"])
+    with build_epg_br.open_source(url) as raw:
+        kinds = [k for k, _ in build_epg_br.iter_brazilian(raw, classifier)]
+    assert kinds == ["channel", "programme"]
+
+
+@needs_requests
+@pytest.mark.parametrize("gz", [False, True])
+def test_open_m3u_http(http_server, gz):
+    playlist = ('#EXTM3U\n#EXTINF:-1 tvg-id="globo.sp" group-title="Abertos",Globo SP\nhttp://x/1\n'
+                '#EXTINF:-1,Canal Sem Id\nhttp://x/2\n').encode("utf-8")
+    http_server.files["lista.m3u"] = gzip.compress(playlist) if gz else playlist
+    with eg.open_m3u(http_server.url("lista.m3u")) as raw:
+        entries = list(eg.iter_m3u(eg.iter_m3u_lines(raw)))
+    assert [(e.tvg_id, e.group, e.url) for e in entries] == [("globo.sp", "Abertos", "http://x/1"),
+                                                            ("Canal Sem Id", "", "http://x/2")]
+
+
+@pytest.fixture(params=["requests", "urllib"])
+def http_backend(request, monkeypatch):
+    """Roda o teste com requests e com o fallback urllib de http_get."""
+    if request.param == "requests":
+        if fetch_cache.requests is None:
+            pytest.skip("requests nao instalado")
+    else:
+        monkeypatch.setattr(fetch_cache, "requests", None)
+    return request.param
+
+
+def read_path(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_fetch_200_then_304_reuses_etag(http_server, http_backend, tmp_path):
+    http_server.files["epg.xml"] = EPG
+    url = http_server.url("epg.xml")
+    first = fetch_cache.fetch(url, str(tmp_path))
+    assert (first.status, first.changed) == (200, True)
+    assert read_path(first.path) == EPG
+
+    second = fetch_cache.fetch(url, str(tmp_path))
+    assert (second.status, second.changed) == (304, False)
+    assert second.path == first.path and second.sha256 == first.sha256
+    sent = http_server.requests[-1][1]
+    assert sent["If-None-Match"] == fetch_cache.load_meta(fetch_cache.cache_paths(url, str(tmp_path))[1])["etag"]
+    assert "If-None-Match" not in http_server.requests[0][1]
+
+
+def test_fetch_new_content_replaces_cache(http_server, http_backend, tmp_path):
+    http_server.files["epg.xml"] = EPG
+    url = http_server.url("epg.xml")
+    fetch_cache.fetch(url, str(tmp_path))
+    http_server.files["epg.xml"] = EPG.replace(b"Jornal", b"Novela")
+    res = fetch_cache.fetch(url, str(tmp_path))
+    assert (res.status, res.changed) == (200, True)
+    assert b"Novela" in read_path(res.path)
+
+
+def test_fetch_keeps_gzip_body_compressed(http_server, http_backend, tmp_path):
+    http_server.files["epg.xml"] = gzip.compress(EPG)
+    http_server.extra["epg.xml"] = {"Content-Encoding": "gzip"}
+    res = fetch_cache.fetch(http_server.url("epg.xml"), str(tmp_path))
+    with fetch_cache.open_bytes(res.path) as f:
+        assert f.read() == EPG
+
+
+def test_fetch_failure_without_cache_raises(http_server, http_backend, tmp_path):
+    http_server.fail = True
+    with pytest.raises(fetch_cache.FetchError):
+        fetch_cache.fetch(http_server.url("epg.xml"), str(tmp_path))
+
+
+def test_fetch_failure_with_cache_is_stale(http_server, http_backend, tmp_path):
+    http_server.files["epg.xml"] = EPG
+    url = http_server.url("epg.xml")
+    first = fetch_cache.fetch(url, str(tmp_path))
+    http_server.fail = True
+    res = fetch_cache.fetch(url, str(tmp_path))
+    assert (res.status, res.changed, res.path) == ("stale", False, first.path)
+    assert read_path(res.path) == EPG
+
+
+def test_fetch_local_file_tracks_changes(tmp_path):
+    src = tmp_path / "epg.xml"
+    src.write_bytes(EPG)
+    cache = str(tmp_path / "cache")
+    assert fetch_cache.fetch(str(src), cache).changed
+    assert not fetch_cache.fetch(str(src), cache).changed
+    src.write_bytes(EPG + b"\n")
+    assert fetch_cache.fetch(str(src), cache).changed
+
+
+GENERATOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "epg_generator.py")
+
+
+def run_generator(tmp_path, *args):
+    (tmp_path / "lista.m3u").write_text('#EXTM3U\n#EXTINF:-1 tvg-id="globo.sp",Globo SP\nhttp://x/1\n')
+    return subprocess.run([sys.executable, GENERATOR, "lista.m3u", "--out", "epg.xml", *args],
+                          cwd=tmp_path, capture_output=True, text=True)
+
+
+def test_require_epg_fails_without_usable_source(http_server, tmp_path):
+    http_server.fail = True
+    proc = run_generator(tmp_path, "--epg-source", http_server.url("epg.xml"), "--cache-dir", "cache",
+                         "--require-epg")
+    assert proc.returncode == 2, proc.stdout
+    assert not (tmp_path / "epg.xml").exists()
+
+
+def test_require_epg_passes_with_events(tmp_path):
+    (tmp_path / "epg_src.xml").write_bytes(EPG)
+    proc = run_generator(tmp_path, "--epg-source", "epg_src.xml", "--require-epg")
+    assert proc.returncode == 0, proc.stdout
+    assert b"Jornal" in (tmp_path / "epg.xml").read_bytes()
+
+
+@needs_requests
+def test_ingest_http_leaves_no_copy_in_cwd(http_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    url = serve_epg(http_server, "gz")
+    channels, events, nbytes = eg.ingest_epg_source(url)
+    assert [ev.title for ev in events["globo.sp"]] == ["Jornal"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ingest_local_closes_mmap(tmp_path, monkeypatch):
+    src = tmp_path / "epg.xml"
+    src.write_bytes(EPG)
+    opened = []
+
+    def read_bytes(path):
+        opened.append(fetch_cache.read_bytes(path))
+        return opened[-1]
+
+    monkeypatch.setattr(eg, "read_bytes", read_bytes)
+    channels, events, nbytes = eg.ingest_epg_source(str(src))
+    assert nbytes == len(EPG) and len(events["globo.sp"]) == 1
+    assert opened[0].closed
+
+
+def big_epg(n=2000):
+    progs = b"".join(b'  <programme start="20260101%02d0000 -0300" stop="20260101%02d3000 -0300" channel="globo.sp">'
+                     b'<title>Programa %d</title></programme>\n' % (i % 24, i % 24, i) for i in range(n))
+    return EPG.replace(b"</tv>", progs + b"</tv>")
+
+
+def broken_sources(server):
+    """URLs de fontes que falham no meio da leitura: .gz/.xz truncados, .gz corrompido e conexao cortada."""
+    gz, xz = gzip.compress(big_epg()), lzma.compress(big_epg())
+    server.files["trunc.xml.gz"] = gz[:len(gz) // 2]
+    server.files["trunc.xml.xz"] = xz[:len(xz) // 2]
+    server.files["bad.xml.gz"] = gz[:len(gz) // 2] + bytes(b ^ 0x55 for b in gz[len(gz) // 2:])
+    server.files["cut.xml"] = big_epg()
+    server.cut["cut.xml"] = len(big_epg()) // 2
+    return [server.url(p) for p in ("trunc.xml.gz", "trunc.xml.xz", "bad.xml.gz", "cut.xml")]
+
+
+@needs_requests
+@pytest.mark.parametrize("stream, passthrough", [(False, False), (True, False), (True, True), (False, True)])
+def test_broken_source_is_skipped(http_server, stream, passthrough):
+    for url in broken_sources(http_server):
+        channels, events, _ = eg.ingest_epg_source(url, stream=stream, passthrough=passthrough)
+        assert (channels, events) == (None, None), url
+
+
+@needs_requests
+def test_broken_source_is_skipped_in_store(http_server, tmp_path):
+    store = eg.ProgrammeStore(str(tmp_path / "epg.sqlite"))
+    good = serve_epg(http_server, "gz")
+    results = eg.ingest_into_store(store, broken_sources(http_server) + [good])
+    assert [chans for _, chans, _ in results] == [None, None, None, None, 1]
+    assert [row[4] for row in store.programmes("globo.sp")] == ["Jornal"]
+
+
+@needs_requests
+def test_broken_source_beside_good_one(http_server):
+    good = serve_epg(http_server, "gz")
+    results = eg.ingest_epg_sources(broken_sources(http_server)[:2] + [good], stream=True)
+    assert [r[1] is None for r in results] == [True, True, False]
+    channels, events = eg.merge_epg_sources(results)
+    assert [ev.title for ev in events["globo.sp"]] == ["Jornal"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_truncated_local_gz_is_skipped(tmp_path, stream):
+    path = tmp_path / "epg.xml.gz"
+    data = gzip.compress(big_epg())
+    path.write_bytes(data[:len(data) // 2])
+    assert eg.ingest_epg_source(str(path), stream=stream)[:2] == (None, None)
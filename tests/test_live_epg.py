@@ -0,0 +1,80 @@
+import argparse
+import datetime as dt
+
+import epg_generator as eg
+
+T0 = dt.datetime(2024, 3, 10, 12, 30, tzinfo=eg.TZ)
+
+
+def xmltv_time(t):
+    return t.astimezone(dt.timezone.utc).strftime("%Y%m%d%H%M%S +0000")
+
+
+def live_args(tmp_path, **kw):
+    m3u = tmp_path / "lista.m3u"
+    m3u.write_text('#EXTM3U\n#EXTINF:-1 tvg-id="news" tvg-name="News",News\nhttp://x/1\n', encoding="utf-8")
+    base = T0.replace(minute=0) - dt.timedelta(hours=6)
+    epg = tmp_path / "epg.xml"
+    epg.write_text('<tv><channel id="news"><display-name>News</display-name></channel>' + "".join(
+        f'<programme start="{xmltv_time(base + dt.timedelta(hours=i))}" '
+        f'stop="{xmltv_time(base + dt.timedelta(hours=i + 1))}" channel="news"><title>P{i}</title></programme>'
+        for i in range(24)) + "</tv>", encoding="utf-8")
+    args = dict(m3u=str(m3u), epg_source=[str(epg)], hours=4, placeholder_block_minutes=60, shift=None,
+                min_ratio=0.6, matcher="indexed", map_cache=None, out=str(tmp_path / "out.xml"), write_map=None,
+                past_hours=1, future_hours=2, compact=False, stream=False, passthrough=False, jobs=1,
+                canonical=False, fragment_cache=None, cache_dir=str(tmp_path / "cache"), skip_unchanged=False,
+                require_epg=False, store=None, metrics_json=None, serve=("127.0.0.1", 0), refresh_minutes=30,
+                shard_by=None, shard_dir=str(tmp_path / "shards"), apply_tvg_shift=False)
+    args.update(kw)
+    return argparse.Namespace(**args)
+
+
+def titles(data):
+    return [t.split("<", 1)[0] for t in data.decode("utf-8").split("<title>")[1:] if t.startswith("P")]
+
+
+def test_refresh_moves_window_with_the_clock(tmp_path, monkeypatch):
+    clock = [T0]
+    monkeypatch.setattr(eg, "now_tz", lambda: clock[0])
+    calls = []
+    load_epg = eg.load_epg
+    monkeypatch.setattr(eg, "load_epg", lambda *a: calls.append(1) or load_epg(*a))
+    live = eg.LiveEPG(live_args(tmp_path))
+
+    first = titles(live.refresh())
+    assert first == ["P5", "P6", "P7", "P8"]
+    clock[0] = T0 + dt.timedelta(minutes=20)
+    assert titles(live.refresh()) == first and len(calls) == 1
+    clock[0] = T0 + dt.timedelta(hours=3)
+    assert titles(live.refresh()) == ["P8", "P9", "P10", "P11"] and len(calls) == 2
+
+
+def test_refresh_without_window_parses_once(tmp_path, monkeypatch):
+    clock = [T0]
+    monkeypatch.setattr(eg, "now_tz", lambda: clock[0])
+    calls = []
+    load_epg = eg.load_epg
+    monkeypatch.setattr(eg, "load_epg", lambda *a: calls.append(1) or load_epg(*a))
+    live = eg.LiveEPG(live_args(tmp_path, past_hours=None, future_hours=None))
+    live.refresh()
+    clock[0] = T0 + dt.timedelta(hours=5)
+    live.refresh()
+    assert len(calls) == 1
+
+
+def test_refresh_uses_spawn_pools(tmp_path, monkeypatch):
+    monkeypatch.setattr(eg, "now_tz", lambda: T0)
+    contexts = []
+    pool = eg.ProcessPoolExecutor
+
+    def recording(*args, mp_context=None, **kw):
+        contexts.append(mp_context.get_start_method() if mp_context else None)
+        return pool(*args, mp_context=mp_context, **kw)
+
+    monkeypatch.setattr(eg, "ProcessPoolExecutor", recording)
+    args = live_args(tmp_path, jobs=2)
+    args.epg_source *= 2
+    # o refresh roda ao lado dos threads do servidor: nada de fork
+    parallel = eg.LiveEPG(args).refresh()
+    assert contexts == ["spawn", "spawn"]
+    assert parallel == eg.LiveEPG(live_args(tmp_path, out=str(tmp_path / "seq.xml"))).refresh()
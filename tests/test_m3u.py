@@ -0,0 +1,61 @@
+import io
+
+import pytest
+
+import epg_generator as eg
+
+PLAYLIST = """#EXTM3U x-tvg-url="http://epg/x.xml"
+#EXTINF:-1 tvg-id="globo.sp" tvg-name="Globo, SP" group-title="Abertos, SP" tvg-logo="http://l/1.png",Globo SP, HD
+#EXTVLCOPT:http-user-agent=Mozilla/5.0
+#EXTVLCOPT:http-referrer=http://x/
+#KODIPROP:inputstream=inputstream.adaptive
+
+http://x/1
+#EXTINF:-1 tvg-id="sbt.sp",SBT SP
+#EXTGRP:Abertos
+http://x/2
+#EXTINF:-1 tvg-id="band.sp" group-title="Noticias",Band SP
+#EXTGRP:Outro
+http://x/3
+#EXTINF:-1 tvg-id="" tvg-logo="l.png" texto solto tvg-shift="-1",Record, Recife
+http://x/4
+#EXTINF:-1,
+http://x/5
+#EXTINF:-1 tvg-id="sem.url",Sem URL
+"""
+
+EXPECTED = [
+    ("globo.sp", "Globo SP, HD", "Abertos, SP", "http://x/1"),
+    ("sbt.sp", "SBT SP", "Abertos", "http://x/2"),
+    ("band.sp", "Band SP", "Noticias", "http://x/3"),
+    ("Record, Recife", "Record, Recife", "", "http://x/4"),
+    ("chan5", "chan5", "", "http://x/5"),
+    ("sem.url", "Sem URL", "", ""),
+]
+
+
+def parse(data):
+    return [(e.tvg_id, e.name, e.group, e.url) for e in eg.iter_m3u(eg.iter_m3u_lines(io.BytesIO(data)))]
+
+
+@pytest.mark.parametrize("encode", [
+    lambda s: s.encode("utf-8"),
+    lambda s: s.replace("\n", "\r\n").encode("utf-8"),
+    lambda s: b"\xef\xbb\xbf" + s.replace("\n", "\r\n").encode("utf-8"),
+    lambda s: b"\xef\xbb\xbf" + s.split("\n", 1)[1].encode("utf-8"),  # BOM seguido direto do #EXTINF
+], ids=["lf", "crlf", "bom-crlf", "bom-no-header"])
+def test_playlist_edge_cases(encode):
+    assert parse(encode(PLAYLIST)) == EXPECTED
+
+
+def test_quoted_attributes_keep_commas_and_all_pairs():
+    entry = next(eg.iter_m3u([PLAYLIST.splitlines()[1]]))
+    assert entry.attr("tvg-name") == "Globo, SP" and entry.attr("tvg-logo") == "http://l/1.png"
+    fallback = list(eg.iter_m3u(PLAYLIST.splitlines()))[3]
+    assert fallback.attr("tvg-shift") == "-1" and fallback.attr("tvg-logo") == "l.png"
+
+
+def test_text_lines_and_invalid_utf8():
+    assert [e.tvg_id for e in eg.iter_m3u(io.StringIO(PLAYLIST))] == [e[0] for e in EXPECTED]
+    data = '#EXTINF:-1 tvg-id="a",Caf\xe9\nhttp://x/1\n'.encode("latin-1")
+    assert parse(data) == [("a", "Caf�", "", "http://x/1")]
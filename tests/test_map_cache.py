@@ -0,0 +1,66 @@
+import csv
+
+import pytest
+
+import epg_generator as eg
+
+EPG_CHANNELS = [{"id": "globo.sp", "display": "Globo SP"}, {"id": "sbt.sp", "display": "SBT SP"},
+                {"id": "band.sp", "display": "Band SP"}]
+
+
+@pytest.fixture
+def matcher_calls(monkeypatch):
+    """Consultas (tvg_id, nome normalizado) enviadas ao matcher em cada build_mapping."""
+    calls = []
+    indexed = eg.MATCHERS["indexed"]
+
+    def recording(queries, epg_channels, min_ratio):
+        calls.append(sorted(queries))
+        return indexed(queries, epg_channels, min_ratio)
+
+    monkeypatch.setitem(eg.MATCHERS, "indexed", recording)
+    return calls
+
+
+def m3u(*names):
+    return [eg.M3UEntry(name.lower().replace(" ", "."), name) for name in names]
+
+
+def test_cache_reused_and_recomputed_for_changed_m3u(tmp_path, matcher_calls):
+    cache = str(tmp_path / "map.csv")
+    first = eg.build_mapping(m3u("Globo SP", "SBT SP HD"), EPG_CHANNELS, map_cache=cache)
+    assert first["globo.sp"] == ("globo.sp", 1.0) and first["sbt.sp.hd"][0] == "sbt.sp"
+    assert eg.build_mapping(m3u("Globo SP", "SBT SP HD"), EPG_CHANNELS, map_cache=cache) == first
+    # canal novo e canal renomeado (mesmo tvg-id, outro nome) passam pelo matcher; o resto vem do cache
+    channels = m3u("Globo SP", "Band SP") + [eg.M3UEntry("sbt.sp.hd", "SBT Sao Paulo")]
+    eg.build_mapping(channels, EPG_CHANNELS, map_cache=cache)
+    assert matcher_calls == [[("globo.sp", "globo sp"), ("sbt.sp.hd", "sbt sp hd")],
+                             [("band.sp", "band sp"), ("sbt.sp.hd", "sbt sao paulo")]]
+
+
+def test_cache_invalidated_by_epg_channel_set_and_options(tmp_path, matcher_calls):
+    cache = str(tmp_path / "map.csv")
+    channels = m3u("Globo SP", "SBT SP")
+    eg.build_mapping(channels, EPG_CHANNELS, map_cache=cache)
+    eg.build_mapping(channels, EPG_CHANNELS + [{"id": "record.sp", "display": "Record SP"}], map_cache=cache)
+    eg.build_mapping(channels, [dict(ch, display=ch["display"] + " HD") for ch in EPG_CHANNELS], map_cache=cache)
+    eg.build_mapping(channels, [dict(ch, display=ch["display"] + " HD") for ch in EPG_CHANNELS], min_ratio=0.7,
+                     map_cache=cache)
+    assert len(matcher_calls) == 4 and all(len(queries) == 2 for queries in matcher_calls)
+
+
+def test_manual_overrides_win_and_survive_rewrites(tmp_path, matcher_calls):
+    cache = tmp_path / "map.csv"
+    with open(cache, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(eg.MAP_CACHE_FIELDS)
+        writer.writerow(["globo.sp", "", "band.sp", "", "manual", ""])
+        writer.writerow(["sbt.sp", "", "", "", "manual", ""])
+    channels = m3u("Globo SP", "SBT SP", "Band SP")
+    for _ in range(2):
+        mapping = eg.build_mapping(channels, EPG_CHANNELS, map_cache=str(cache))
+        assert mapping == {"globo.sp": ("band.sp", 1.0), "sbt.sp": (None, 0.0), "band.sp": ("band.sp", 1.0)}
+    # manuais nunca vao ao matcher e continuam no arquivo regravado
+    assert matcher_calls == [[("band.sp", "band sp")]]
+    auto, manual = eg.load_map_cache(str(cache))
+    assert manual == {"globo.sp": "band.sp", "sbt.sp": None} and list(auto) == [("band.sp", "band sp")]
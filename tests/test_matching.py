@@ -0,0 +1,124 @@
+import collections
+import difflib
+import os
+import random
+import sys
+
+import pytest
+
+import epg_generator as eg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import bench_epg  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def catalogue():
+    """Canais sinteticos do benchmark, consultas com variantes (HD/ALT...) e nomes sem par no EPG."""
+    rng = random.Random(5)
+    channels = bench_epg.synthetic_channels(200, seed=7)
+    queries = [(f"q{i}", eg.normalize_name(name + rng.choice(["", " HD", " FHD", " (ALT)"])))
+               for i, (_, name) in enumerate(rng.sample(channels, 80))]
+    queries += [(f"z{i}", eg.normalize_name(f"{rng.choice(bench_epg.BRANDS)} {rng.choice(bench_epg.TITLE_WORDS)}"))
+                for i in range(20)]
+    epg_channels = [{"id": cid, "display": name} for cid, name in channels]
+    return epg_channels, queries, eg.match_difflib(queries, epg_channels, 0.6)
+
+
+def agreement(reference, results, min_ratio=0.6):
+    """(matches claros iguais, matches claros, aceitos iguais) em relacao a varredura completa."""
+    clear = [k for k, (_, score) in enumerate(reference) if score >= 0.8]
+    same_clear = sum(reference[k][0] == results[k][0] for k in clear)
+    accepted = [(e if s >= min_ratio else None, f if t >= min_ratio else None)
+                for (e, s), (f, t) in zip(reference, results)]
+    return same_clear, len(clear), sum(a == b for a, b in accepted)
+
+
+@pytest.mark.parametrize("min_ratio", [0.4, 0.6, 0.8])
+def test_indexed_matches_difflib(catalogue, min_ratio):
+    epg_channels, queries, reference = catalogue
+    results = eg.match_indexed(queries, epg_channels, min_ratio)
+    # todo match aceito e o da varredura completa, com o mesmo score; abaixo do corte os dois ficam sem match
+    for query, (e, s), (f, t) in zip(queries, reference, results):
+        if s >= min_ratio:
+            assert (f, t) == (e, s), query
+        else:
+            assert t < min_ratio, query
+    assert sum(s >= min_ratio for _, s in reference) > 50
+
+
+def test_shortlist_is_bounded(catalogue):
+    epg_channels, queries, _ = catalogue
+    index = eg.CandidateIndex(epg_channels * 20)
+    assert all(len(index.shortlist(norm)) <= eg.SHORTLIST_K for _, norm in queries)
+
+
+def test_reaching_is_quick_ratio_cut(catalogue):
+    epg_channels, queries, _ = catalogue
+    index = eg.CandidateIndex(epg_channels)
+    for _, norm in queries[::7]:
+        for cut in (0.0, 0.5, 0.75):
+            expected = [i for i, m in enumerate(index.matchers)
+                        if m is not None and difflib.SequenceMatcher(None, norm, m.b).quick_ratio() >= cut]
+            assert sorted(index.reaching(norm, cut)) == expected
+
+
+def test_indexed_exact_id_and_alias():
+    epg_channels = [{"id": "globo.sp", "display": "Globo SP"}, {"id": "sbt.sp", "display": "SBT Sao Paulo"}]
+    index = eg.CandidateIndex(epg_channels)
+    assert index.best_match("GLOBO.SP", "qualquer") == ("globo.sp", 1.0)
+    assert index.best_match("x", "sbt sao paulo") == ("sbt.sp", 1.0)
+    assert index.best_match("x", "") == (None, 0.0)
+    assert index.best_match("x", "zzzz") == (None, 0.0)
+
+
+def dense_tfidf(queries, epg_channels):
+    """Referencia: cosseno TF-IDF contra todas as linhas do EPG (matriz densa, sem deduplicar)."""
+    np = pytest.importorskip("numpy")
+    cands = [(cid, norm) for cid, norm in eg.epg_candidates(epg_channels) if norm]
+    vocab = sorted({g for _, norm in cands for g in eg.char_ngrams(norm)})
+    col = {g: j for j, g in enumerate(vocab)}
+    docs = np.zeros((len(cands), len(vocab)))
+    for i, (_, norm) in enumerate(cands):
+        for g in eg.char_ngrams(norm):
+            docs[i, col[g]] += 1
+    idf = np.log((1.0 + len(cands)) / (1.0 + (docs > 0).sum(axis=0))) + 1.0
+    docs *= idf
+    docs /= np.linalg.norm(docs, axis=1, keepdims=True)
+    ids = {ec["id"].lower(): ec["id"] for ec in reversed(epg_channels) if ec["id"]}
+    results = []
+    for tvg, norm in queries:
+        if tvg.lower() in ids:
+            results.append((ids[tvg.lower()], 1.0))
+            continue
+        q = np.zeros(len(vocab))
+        unseen = []
+        for g in eg.char_ngrams(norm):
+            if g in col:
+                q[col[g]] += 1
+            else:
+                unseen.append(g)
+        q *= idf
+        extra = sum(c * c for c in collections.Counter(unseen).values()) * (np.log(1.0 + len(cands)) + 1.0) ** 2
+        sims = docs @ q / np.sqrt(q @ q + extra) if q.any() else np.zeros(len(cands))
+        i = int(sims.argmax())
+        results.append((cands[i][0], float(sims[i])) if sims[i] > 0 else (None, 0.0))
+    return results
+
+
+def test_tfidf_matches_dense_cosine(catalogue):
+    epg_channels, queries, _ = catalogue
+    # nomes repetidos no EPG: a primeira linha vence e as copias contam no IDF
+    epg_channels = epg_channels + [{"id": f"dup{i}", "display": ec["display"]}
+                                   for i, ec in enumerate(epg_channels[:50])]
+    expected = dense_tfidf(queries, epg_channels)
+    results = eg.match_tfidf(queries, epg_channels, 0.6)
+    assert [e for e, _ in results] == [e for e, _ in expected]
+    assert [s for _, s in results] == pytest.approx([s for _, s in expected])
+
+
+def test_tfidf_agrees_with_difflib_on_clear_matches(catalogue):
+    pytest.importorskip("numpy")
+    epg_channels, queries, reference = catalogue
+    same_clear, n_clear, _ = agreement(reference, eg.match_tfidf(queries, epg_channels, 0.6))
+    assert same_clear == n_clear
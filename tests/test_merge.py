@@ -0,0 +1,97 @@
+import gzip
+import multiprocessing
+
+import pytest
+
+import epg_generator as eg
+
+
+def schedule(cid, *spans, tag=""):
+    """Grade com eventos [inicio, fim) em horas de 2024-01-01 UTC; titulo = tag + hora de inicio."""
+    sched = eg.Schedule()
+    for start, stop in spans:
+        _, ev = eg.make_programme(cid, f"20240101{start:02d}0000 +0000", f"20240101{stop:02d}0000 +0000",
+                                  f"{tag}{start}", "")
+        sched.add(ev)
+    return sched
+
+
+def source(name, channels, events):
+    return name, [{"id": cid, "display": display} for cid, display in channels], events, 0
+
+
+def titles(sched):
+    return [ev.title for ev in sched]
+
+
+def test_single_and_failed_sources():
+    only = source("a", [("x", "X")], {"x": schedule("x", (1, 2))})
+    assert eg.merge_epg_sources([]) == (None, None)
+    assert eg.merge_epg_sources([("bad", None, None, 0)]) == (None, None)
+    chans, events = eg.merge_epg_sources([("bad", None, None, 0), only])
+    assert chans == only[1] and events is only[2]
+
+
+def test_channels_union_first_display_wins():
+    chans, _ = eg.merge_epg_sources([
+        source("a", [("x", "X primario"), ("y", "Y")], {}),
+        source("b", [("z", "Z"), ("x", "X secundario")], {}),
+    ])
+    assert chans == [{"id": "x", "display": "X primario"}, {"id": "y", "display": "Y"}, {"id": "z", "display": "Z"}]
+
+
+def test_secondary_only_fills_gaps():
+    _, events = eg.merge_epg_sources([
+        source("a", [("x", "X")], {"x": schedule("x", (2, 4), (6, 8), tag="a")}),
+        # 0-2 e 4-6 encostam na grade primaria (entram); 3-5 e 7-9 sobrepoem (descartados)
+        source("b", [("x", "X")], {"x": schedule("x", (0, 2), (3, 5), (4, 6), (7, 9), (9, 10), tag="b")}),
+        source("c", [("x", "X")], {"x": schedule("x", (8, 9), (9, 11), (11, 12), tag="c")}),
+    ])
+    assert titles(events["x"]) == ["b0", "a2", "b4", "a6", "c8", "b9", "c11"]
+
+
+def test_secondary_channel_kept_whole_and_zero_length_events():
+    _, events = eg.merge_epg_sources([
+        source("a", [("x", "X")], {"x": schedule("x", (2, 4), tag="a")}),
+        source("b", [("x", "X"), ("y", "Y")], {"x": schedule("x", (3, 3), (5, 5), tag="b"),
+                                               "y": schedule("y", (1, 3), (2, 4), tag="b")}),
+    ])
+    assert titles(events["x"]) == ["a2", "b5"]
+    # canal que so existe na fonte secundaria: grade inteira, sem filtrar sobreposicoes internas
+    assert titles(events["y"]) == ["b1", "b2"]
+
+
+GOOD = (b'<tv><channel id="x"><display-name>X</display-name></channel>'
+        b'<programme start="20240101000000 +0000" stop="20240101010000 +0000" channel="x"><title>bom</title>'
+        b'</programme></tv>')
+
+
+def test_corrupt_source_does_not_drop_the_good_one(tmp_path):
+    good, corrupt = tmp_path / "good.xml", tmp_path / "corrupt.xml.gz"
+    good.write_bytes(GOOD)
+    corrupt.write_bytes(gzip.compress(GOOD * 50)[:60])
+    for stream in (False, True):
+        results = eg.ingest_epg_sources([str(corrupt), str(good)], stream=stream)
+        assert [r[1] is None for r in results] == [True, False]
+        _, events = eg.merge_epg_sources(results)
+        assert [ev.title for ev in events["x"]] == ["bom"]
+
+
+_ingest = eg.ingest_epg_source
+
+
+def _raise_for_bad(epg_source, *args):
+    if epg_source.endswith("bad.xml"):
+        raise RuntimeError("worker falhou")
+    return _ingest(epg_source, *args)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="worker precisa herdar o monkeypatch")
+def test_failing_worker_skips_only_its_source(tmp_path, monkeypatch):
+    good = tmp_path / "good.xml"
+    good.write_bytes(GOOD)
+    monkeypatch.setattr(eg, "ingest_epg_source", _raise_for_bad)
+    results = eg.ingest_epg_sources([str(tmp_path / "bad.xml"), str(good)])
+    assert results[0] == (str(tmp_path / "bad.xml"), None, None, 0)
+    _, events = eg.merge_epg_sources(results)
+    assert [ev.title for ev in events["x"]] == ["bom"]
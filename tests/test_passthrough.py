@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+import epg_generator as eg
+
+PROGRAMME = ('  <programme start="202401010{h}0000 +0000" stop="202401010{n}0000 +0000" channel="x" catchup-id="c{i}">'
+             '<title lang="pt">Programa {i} {accent}</title><category>Notícias</category>'
+             '<episode-num system="xmltv_ns">0.{i}.</episode-num></programme>\n')
+
+
+def document(n=2000, encoding="utf-8", accent="é", prelude=""):
+    progs = "".join(PROGRAMME.format(h=i % 9, n=i % 9 + 1, i=i, accent=accent) for i in range(n))
+    return (f'<?xml version="1.0" encoding="{encoding}"?>\n<tv>\n'
+            '  <channel id="x"><display-name>X</display-name></channel>\n'
+            f'{prelude}{progs}  <programme start="20240101090000 +0000" stop="20240101100000 +0000" channel="x"/>\n'
+            '</tv>\n').encode(encoding)
+
+
+@pytest.fixture
+def tee_peak(monkeypatch):
+    """Maior tamanho que o buffer do _TeeReader atingiu durante o parse."""
+    peak = [0]
+
+    class Recording(eg._TeeReader):
+        def read(self, size=-1):
+            data = super().read(size)
+            peak[0] = max(peak[0], len(self.buf))
+            return data
+
+    monkeypatch.setattr(eg, "_TeeReader", Recording)
+    return peak
+
+
+def programmes(source):
+    return [item for kind, item in eg.iter_external_epg_spans(source) if kind == "programme"]
+
+
+@pytest.mark.parametrize("as_stream", [False, True])
+def test_spans_keep_original_markup(as_stream):
+    data = document(3)
+    progs = programmes(io.BytesIO(data) if as_stream else data)
+    assert [ev.title for _, ev in progs] == ["Programa 0 é", "Programa 1 é", "Programa 2 é", ""]
+    assert progs[1][1].raw == (' catchup-id="c1"><title lang="pt">Programa 1 é</title><category>Notícias</category>'
+                               '<episode-num system="xmltv_ns">0.1.</episode-num></programme>')
+    assert progs[3][1].raw == "/>"
+
+
+def test_stream_buffer_stays_bounded(tee_peak):
+    data = document()
+    progs = programmes(io.BytesIO(data))
+    assert len(progs) == 2001 and all(ev.raw for _, ev in progs)
+    assert tee_peak[0] < len(data) // 10
+
+
+def test_latin1_source_falls_back_without_buffering(tee_peak, capsys):
+    data = document(encoding="iso-8859-1", accent="ção")
+    progs = programmes(io.BytesIO(data))
+    assert "passthrough desativado" in capsys.readouterr().out
+    assert len(progs) == 2001 and all(ev.raw is None for _, ev in progs)
+    assert progs[5][1].title == "Programa 5 ção"
+    assert tee_peak[0] < len(data) // 10
+
+
+def test_markup_mismatch_falls_back_without_buffering(tee_peak, capsys):
+    # '<programme' dentro de comentario nao bate com o elemento parseado
+    data = document(prelude='  <!-- <programme start="0" stop="0" channel="y"> -->\n')
+    progs = programmes(io.BytesIO(data))
+    assert "fora do esperado" in capsys.readouterr().out
+    assert len(progs) == 2001 and all(ev.raw is None for _, ev in progs)
+    assert tee_peak[0] < len(data) // 10
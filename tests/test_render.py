@@ -0,0 +1,109 @@
+import datetime as dt
+
+import pytest
+
+import epg_generator as eg
+
+NOW = dt.datetime(2024, 1, 1, 10, 0, tzinfo=eg.TZ)
+
+
+@pytest.fixture(autouse=True)
+def fixed_clock(monkeypatch):
+    monkeypatch.setattr(eg, "now_tz", lambda: NOW)
+
+
+def catalogue(n=60):
+    """M3U com n canais: pares com EPG proprio (alguns com tvg-shift), impares so placeholders."""
+    m3u, events, mapping = [], {}, {}
+    for i in range(n):
+        tvg = f"c{i:03d}"
+        attrs = (("tvg-shift", "-1"),) if i % 6 == 0 else ()
+        m3u.append(eg.M3UEntry(tvg, f"Canal {i}", group=f"g{i % 3}", attrs=attrs))
+        if i % 2:
+            continue
+        sched = events[f"epg{i}"] = eg.Schedule()
+        for h in range(i % 5 + 1):
+            _, ev = eg.make_programme(f"epg{i}", f"20240101{h:02d}0000 +0000", f"20240101{h + 1:02d}0000 +0000",
+                                      f"Programa {i}.{h} & <cia>", "desc")
+            sched.add(ev)
+        mapping[tvg] = (f"epg{i}", 1.0)
+    return m3u, events, mapping
+
+
+def render(tmp_path, name, jobs, fragment_cache=None, **kw):
+    m3u, events, mapping = catalogue()
+    path = tmp_path / name
+    eg.build_final_epg(m3u, events, mapping, hours=6, out_path=str(path), jobs=jobs,
+                       fragment_cache=fragment_cache, tvg_shift=True, **kw)
+    return path.read_bytes()
+
+
+@pytest.mark.parametrize("canonical", [False, True])
+def test_jobs_output_is_byte_identical(tmp_path, monkeypatch, canonical):
+    monkeypatch.setattr(eg, "RENDER_CHUNK", 4)
+    shifts = {"c002": 7200}
+    sequential = render(tmp_path, "seq.xml", 1, shifts=shifts, canonical=canonical)
+    assert b"Programa 0.0 &amp; &lt;cia&gt;" in sequential
+    assert render(tmp_path, "par.xml", 3, shifts=shifts, canonical=canonical) == sequential
+    # com fragment cache: primeira execucao renderiza tudo nos workers, a segunda intercala reaproveitados
+    cache = str(tmp_path / "frag")
+    assert render(tmp_path, "cache1.xml", 3, cache, shifts=shifts, canonical=canonical) == sequential
+    assert render(tmp_path, "cache2.xml", 3, cache, shifts={"c002": 3600}, canonical=canonical) == \
+        render(tmp_path, "seq2.xml", 1, shifts={"c002": 3600}, canonical=canonical)
+
+
+def test_cached_fragments_respect_batch_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(eg, "RENDER_CHUNK", 4)
+    cache = str(tmp_path / "frag")
+    render(tmp_path, "first.xml", 1, cache)
+    sizes = []
+    write_bytes = eg.ParallelRenderer.write_bytes
+
+    def recording(self, data):
+        write_bytes(self, data)
+        sizes.append(len(self._items) + sum(len(items) for items, _ in self._queue))
+
+    monkeypatch.setattr(eg.ParallelRenderer, "write_bytes", recording)
+    # todos reaproveitados menos um, cujo lote fica pendente enquanto os fragmentos prontos chegam
+    assert render(tmp_path, "second.xml", 2, cache, shifts={"c000": 0}) == render(tmp_path, "seq.xml", 1,
+                                                                                   shifts={"c000": 0})
+    assert len(sizes) > 20 and max(sizes) <= 4 * (2 * 2 + 1)
+
+
+def fragment_counts(tmp_path, name, cache, m3u=None, events=None, mapping=None, **kw):
+    base_m3u, base_events, base_mapping = catalogue()
+    metrics = eg.RunMetrics("test")
+    path = tmp_path / name
+    eg.build_final_epg(m3u or base_m3u, events or base_events, mapping or base_mapping, out_path=str(path),
+                       fragment_cache=cache, metrics=metrics, **{"hours": 6, **kw})
+    return metrics.counters["fragments_reused"], metrics.counters["fragments_rendered"], path.read_bytes()
+
+
+def test_fragment_cache_splices_cached_bytes_verbatim(tmp_path):
+    cache = str(tmp_path / "frag")
+    assert fragment_counts(tmp_path, "a.xml", cache)[:2] == (0, 60)
+    reused, rendered, out = fragment_counts(tmp_path, "b.xml", cache)
+    assert (reused, rendered) == (60, 0) and out == (tmp_path / "a.xml").read_bytes()
+    # um byte trocado no .bin (mesmo tamanho) aparece na saida: o fragmento e copiado, nao re-renderizado
+    bin_path = tmp_path / "frag.bin"
+    bin_path.write_bytes(bin_path.read_bytes().replace(b"Canal 7<", b"Canal X<"))
+    assert b"Canal X<" in fragment_counts(tmp_path, "c.xml", cache)[2]
+
+
+def test_fragment_cache_invalidated_by_inputs(tmp_path):
+    cache = str(tmp_path / "frag")
+    fragment_counts(tmp_path, "a.xml", cache)
+    m3u, events, mapping = catalogue()
+    m3u[1] = eg.M3UEntry("c001", "Canal Renomeado")
+    _, ev = eg.make_programme("epg2", "20240101050000 +0000", "20240101060000 +0000", "Novo", "")
+    events["epg2"].add(ev)
+    reused, rendered, out = fragment_counts(tmp_path, "b.xml", cache, m3u, events, mapping, shifts={"c004": 60})
+    # nome (c001), eventos (c002) e timeshift (c004) mudaram
+    assert (reused, rendered) == (57, 3)
+    assert b"Canal Renomeado" in out and b"Novo" in out
+    assert fragment_counts(tmp_path, "c.xml", cache, m3u, events, mapping, shifts={"c004": 60})[:2] == (60, 0)
+    # a janela de placeholders so muda os 30 canais sem EPG; a indentacao muda todos
+    assert fragment_counts(tmp_path, "d.xml", cache, m3u, events, mapping, shifts={"c004": 60}, hours=7)[:2] == \
+        (30, 30)
+    assert fragment_counts(tmp_path, "e.xml", cache, m3u, events, mapping, shifts={"c004": 60}, hours=7,
+                           indent=None)[:2] == (0, 60)
@@ -0,0 +1,51 @@
+import http.client
+import threading
+
+import pytest
+
+from epg_server import EPGServer, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=2-5", (2, 5)),
+    ("bytes=2-", (2, 9)),
+    ("bytes=-3", (7, 9)),
+    ("bytes=5-100", (5, 9)),
+    ("bytes=5-2", None),       # fim antes do inicio: Range ignorado (RFC 9110)
+    ("bytes=15-12", None),
+    ("bytes=1-2,4-5", None),
+    ("items=1-2", None),
+    ("bytes=x-2", None),
+    (None, None),
+    ("bytes=10-", False),
+    ("bytes=-0", False),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 10) == expected
+
+
+@pytest.fixture
+def epg_server():
+    server = EPGServer(("127.0.0.1", 0))
+    server.publish(b"<tv>0123456789</tv>")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, headers):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    try:
+        conn.request("GET", "/epg.xml", headers=headers)
+        resp = conn.getresponse()
+        return resp.status, resp.getheader("Content-Range"), resp.read()
+    finally:
+        conn.close()
+
+
+def test_range_requests(epg_server):
+    assert get(epg_server, {"Range": "bytes=4-7"}) == (206, "bytes 4-7/19", b"0123")
+    assert get(epg_server, {"Range": "bytes=7-4"}) == (200, None, b"<tv>0123456789</tv>")
+    assert get(epg_server, {"Range": "bytes=50-"}) == (416, "bytes */19", b"")
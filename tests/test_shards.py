@@ -0,0 +1,46 @@
+import json
+import os
+
+import epg_generator as eg
+
+
+def entries(*specs):
+    return [eg.M3UEntry(tvg, tvg.upper(), group=group) for tvg, group in specs]
+
+
+def test_colliding_group_slugs_get_suffix():
+    m3u = entries(("a", "SEM GRUPO"), ("b", "ÇÃÕ"), ("c", ""), ("d", "sem grupo"), ("e", "ÇÃÕ"))
+    plan = eg.plan_shards(m3u, "group")
+    assert [(f, label, [c.tvg_id for c in chans]) for f, label, chans in plan] == [
+        ("sem-grupo.xml", "SEM GRUPO", ["a"]),
+        ("sem-grupo-2.xml", "ÇÃÕ", ["b", "e"]),
+        ("sem-grupo-3.xml", "", ["c"]),
+        ("sem-grupo-4.xml", "sem grupo", ["d"]),
+    ]
+
+
+def test_suffix_does_not_steal_existing_slug():
+    plan = eg.plan_shards(entries(("a", "news"), ("b", "NEWS!"), ("c", "news 2")), "group")
+    assert [f for f, _, _ in plan] == ["news.xml", "news-2.xml", "news-2-2.xml"]
+
+
+def test_manifest_reports_rendered_window(tmp_path):
+    m3u = entries(("a", "g1"), ("b", "g2"))
+    for canonical, hours in ((False, 6), (True, 30)):
+        path = eg.build_sharded_epg(m3u, {}, {}, str(tmp_path), "group", hours=6, canonical=canonical)
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f)["hours"] == hours
+        with open(tmp_path / "g1.xml", encoding="utf-8") as f:
+            assert f.read().count("<programme ") == hours
+
+
+def test_stale_shards_and_fragment_caches_removed(tmp_path):
+    shard_dir, cache = tmp_path / "shards", str(tmp_path / "frag")
+    eg.build_sharded_epg(entries(("a", "g1"), ("b", "g2")), {}, {}, str(shard_dir), "group",
+                         hours=2, fragment_cache=cache)
+    assert os.path.exists(cache + ".g2.idx.json") and os.path.exists(cache + ".g2.bin")
+    with open(cache + ".idx.json", "w") as f:
+        f.write("{}")
+    eg.build_sharded_epg(entries(("a", "g1")), {}, {}, str(shard_dir), "group", hours=2, fragment_cache=cache)
+    assert sorted(os.listdir(shard_dir)) == ["g1.xml", "manifest.json"]
+    assert sorted(os.listdir(tmp_path)) == ["frag.g1.bin", "frag.g1.idx.json", "frag.idx.json", "shards"]
@@ -0,0 +1,65 @@
+import datetime as dt
+import random
+
+import pytest
+
+import epg_generator as eg
+
+
+def shifted(s, hours):
+    ts, canonical = eg.parse_xmltv_ts(s)
+    return eg.shift_xmltv_ts(canonical, ts, round(hours * 3600))
+
+
+@pytest.mark.parametrize("s, hours, expected", [
+    ("20240131233000 +0000", 1, "20240201003000 +0000"),     # virada de mes
+    ("20240228230000 +0000", 1, "20240229000000 +0000"),     # fevereiro bissexto
+    ("20230228230000 +0000", 1, "20230301000000 +0000"),
+    ("20231231230000 -0300", 2, "20240101010000 -0300"),     # virada de ano, offset negativo
+    ("20240301003000 +0530", -1, "20240229233000 +0530"),    # para tras, offset com minutos
+    ("20240101001500 +0545", -0.5, "20231231234500 +0545"),
+    ("20240615120000 -0930", 36, "20240617000000 -0930"),
+    ("20240615120000 +1400", 0.25, "20240615121500 +1400"),
+])
+def test_shift_keeps_offset_across_rollover(s, hours, expected):
+    assert shifted(s, hours) == expected
+    assert shifted(expected, -hours) == s
+
+
+def test_shift_matches_datetime_arithmetic():
+    rng = random.Random(3)
+    for _ in range(500):
+        offset = rng.choice([-720, -570, -180, 0, 330, 345, 600, 840])
+        tz = dt.timezone(dt.timedelta(minutes=offset))
+        d = dt.datetime(2024, 1, 1, tzinfo=tz) + dt.timedelta(minutes=rng.randrange(-600000, 600000))
+        s = d.strftime("%Y%m%d%H%M%S %z")
+        hours = rng.choice([-48, -25, -1, -0.5, 1, 2.5, 24, 49])
+        assert shifted(s, hours) == (d + dt.timedelta(hours=hours)).strftime("%Y%m%d%H%M%S %z"), (s, hours)
+
+
+def entries(*specs):
+    return [eg.M3UEntry(tvg, tvg, attrs=(("tvg-shift", value),) if value is not None else ()) for tvg, value in specs]
+
+
+def test_tvg_shift_is_opt_in():
+    m3u = entries(("a", "-1"), ("b", "2"), ("a", "5"), ("c", None), ("d", "0"))
+    assert eg.channel_shifts(m3u) == {}
+    assert eg.channel_shifts(m3u, {"c": 3600}) == {"c": 3600}
+    assert eg.channel_shifts(m3u, tvg_shift=True) == {"a": -3600, "b": 7200}
+    assert eg.channel_shifts(m3u, {"a": 0, "d": 1800}, tvg_shift=True) == {"b": 7200, "d": 1800}
+
+
+def test_invalid_tvg_shift_is_ignored(capsys):
+    assert eg.channel_shifts(entries(("a", "x"), ("b", "nan"), ("c", "1")), tvg_shift=True) == {"c": 3600}
+    assert capsys.readouterr().out.count("tvg-shift invalido") == 2
+
+
+@pytest.mark.parametrize("tvg_shift, start", [(False, "20240131230000 -0300"), (True, "20240131220000 -0300")])
+def test_build_final_epg_applies_tvg_shift_only_when_asked(tmp_path, tvg_shift, start):
+    _, ev = eg.make_programme("e", "20240131230000 -0300", "20240201000000 -0300", "Jornal", "")
+    sched = eg.Schedule()
+    sched.add(ev)
+    out = tmp_path / "epg.xml"
+    eg.build_final_epg(entries(("rec", "-1")), {"e": sched}, {"rec": ("e", 1.0)}, hours=1, out_path=str(out),
+                       tvg_shift=tvg_shift)
+    assert f'<programme start="{start}"' in out.read_text(encoding="utf-8")
@@ -0,0 +1,87 @@
+import pytest
+
+import epg_generator as eg
+from epg_store import ProgrammeStore
+
+H = 3600
+BASE = 1704067200  # 2024-01-01 00:00 UTC
+
+
+def items(channels, *progs, tag=""):
+    """Itens no formato de iter_external_epg; progs = (canal, hora inicio, hora fim)."""
+    out = [("channel", {"id": cid, "display": display}) for cid, display in channels]
+    for cid, start, stop in progs:
+        out.append(("programme", eg.make_programme(cid, f"20240101{start:02d}0000 +0000",
+                                                   f"20240101{stop:02d}0000 +0000", f"{tag}{start}", "")))
+    return out
+
+
+def grid(store, cid):
+    return [(row[4], (row[0] - BASE) // H, (row[1] - BASE) // H) for row in store.programmes(cid)]
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "epg.sqlite")
+
+
+def run(path, *sources):
+    """Uma execucao: abre o store, grava as fontes em ordem de prioridade e fecha."""
+    store = ProgrammeStore(path)
+    store.begin_run()
+    results = [store.ingest(src) for src in sources]
+    store.close()
+    return results
+
+
+def test_new_run_replaces_covered_range_and_keeps_the_rest(store_path):
+    assert run(store_path, items([("x", "X"), ("y", "Y")], ("x", 0, 2), ("x", 2, 4), ("x", 6, 8), ("y", 0, 4),
+                                 tag="r1-")) == [(2, 4, 4)]
+    # run 2 so publica x entre 3 e 5: o que sobrepoe [3, 5) e substituido, 0-2 e 6-8 ficam; y fica intacto
+    assert run(store_path, items([("x", "X")], ("x", 3, 4), ("x", 4, 5), tag="r2-")) == [(1, 2, 2)]
+    store = ProgrammeStore(store_path)
+    assert grid(store, "x") == [("r1-0", 0, 2), ("r2-3", 3, 4), ("r2-4", 4, 5), ("r1-6", 6, 8)]
+    assert grid(store, "y") == [("r1-0", 0, 4)]
+    assert store.count() == 5 and store.channel_ids() == {"x", "y"}
+
+
+def test_sources_of_the_same_run_only_fill_gaps(store_path):
+    run(store_path, items([("x", "X")], ("x", 0, 6), tag="old-"))
+    results = run(store_path,
+                  items([("x", "X")], ("x", 2, 4), tag="a"),
+                  items([("x", "X")], ("x", 0, 2), ("x", 3, 5), ("x", 4, 6), ("x", 3, 3), tag="b"))
+    assert results == [(1, 1, 1), (1, 4, 2)]
+    # a fonte b tambem cobre 0-6, mas o programa antigo ja tinha saido pela fonte a
+    assert grid(ProgrammeStore(store_path), "x") == [("b0", 0, 2), ("a2", 2, 4), ("b4", 4, 6)]
+
+
+def test_display_name_first_source_of_latest_run(store_path):
+    run(store_path, items([("x", "X antigo"), ("y", "Y")]), items([("x", "X outro")]))
+    assert ProgrammeStore(store_path).channels() == [{"id": "x", "display": "X antigo"}, {"id": "y", "display": "Y"}]
+    run(store_path, items([("x", "X novo")]), items([("x", "X outro")]))
+    assert ProgrammeStore(store_path).channels() == [{"id": "x", "display": "X novo"}, {"id": "y", "display": "Y"}]
+
+
+def test_failed_source_applies_nothing(store_path):
+    run(store_path, items([("x", "X")], ("x", 0, 2), tag="old-"))
+
+    def broken():
+        yield from items([("x", "X novo")], ("x", 0, 2), ("x", 2, 4), tag="new-")
+        raise ValueError("feed truncado")
+
+    store = ProgrammeStore(store_path)
+    store.begin_run()
+    with pytest.raises(ValueError):
+        store.ingest(broken())
+    assert grid(store, "x") == [("old-0", 0, 2)] and store.channels()[0]["display"] == "X"
+    assert store.ingest(items([("x", "X")], ("x", 2, 4), tag="ok-")) == (1, 1, 1)
+    assert grid(store, "x") == [("old-0", 0, 2), ("ok-2", 2, 4)]
+
+
+def test_prune_only_drops_previous_runs(store_path):
+    run(store_path, items([("x", "X")], ("x", 0, 2), ("x", 4, 6), tag="old-"))
+    store = ProgrammeStore(store_path)
+    store.begin_run()
+    store.ingest(items([("y", "Y")], ("y", 0, 1), tag="new-"))
+    assert store.prune(BASE + 3 * H) == 1
+    assert grid(store, "x") == [("old-4", 4, 6)] and grid(store, "y") == [("new-0", 0, 1)]
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import epg_generator as eg
+from run_metrics import RunMetrics, TimedWriter
+from xmltv_writer import WriteIfChanged, open_xmltv
+
+
+def write_doc(path, titles, only_if_changed=False, wrap=None):
+    with open_xmltv(str(path), {"generator-info-name": "test"}, wrap=wrap, only_if_changed=only_if_changed) as w:
+        for i, title in enumerate(titles):
+            w.write_programme(f"2024010100{i:02d}00 +0000", f"2024010100{i + 1:02d}00 +0000", "c", title, "")
+    return w
+
+
+def test_bytes_out_counts_what_reaches_disk(tmp_path):
+    path = tmp_path / "epg.xml"
+    metrics = RunMetrics("test")
+    w = write_doc(path, ["a", "b"], wrap=lambda f: TimedWriter(f, metrics))
+    assert w.changed and w.bytes_out == os.path.getsize(path) > 0
+    assert "bytes_out" not in metrics.counters and metrics.stages["write"]["calls"] >= 1
+    assert write_doc(path, ["a", "b"], only_if_changed=True).bytes_out == 0
+    w = write_doc(path, ["a", "c"], only_if_changed=True)
+    assert w.changed and w.bytes_out == os.path.getsize(path)
+
+
+def test_build_final_epg_reports_unchanged_output_as_zero_bytes(tmp_path):
+    path = str(tmp_path / "epg.xml")
+    m3u = [eg.M3UEntry("a", "A"), eg.M3UEntry("b", "B")]
+    counters = []
+    for _ in range(2):
+        metrics = RunMetrics("test")
+        eg.build_final_epg(m3u, {}, {}, hours=2, out_path=path, metrics=metrics, canonical=True)
+        counters.append(metrics.counters)
+    assert counters[0]["bytes_out"] == os.path.getsize(path) and counters[0]["outputs_unchanged"] == 0
+    assert counters[1]["bytes_out"] == 0 and counters[1]["outputs_unchanged"] == 1
+
+
+def write_if_changed(path, chunks):
+    f = WriteIfChanged(str(path), str(path) + ".tmp")
+    for chunk in chunks:
+        f.write(chunk)
+    changed = f.finish()
+    if changed:
+        os.replace(str(path) + ".tmp", str(path))
+    return changed
+
+
+@pytest.mark.parametrize("old, chunks, changed", [
+    (None, [b"abc", b"def"], True),                 # destino inexistente
+    (b"abcdef", [b"abc", b"def"], False),           # identico
+    (b"abcdef", [b"ab", b"", b"cdef"], False),      # identico, blocos diferentes
+    (b"abcdef", [b"abc"], True),                    # novo e prefixo do antigo
+    (b"abc", [b"abc", b"def"], True),               # antigo e prefixo do novo
+    (b"abcdef", [b"abc", b"dXf", b"ghi"], True),    # diverge no meio de um bloco
+    (b"abcdef", [b"Xbc", b"def"], True),            # diverge no primeiro byte
+    (b"", [b""], False),                            # ambos vazios
+])
+def test_write_if_changed(tmp_path, old, chunks, changed):
+    path = tmp_path / "out.xml"
+    if old is not None:
+        path.write_bytes(old)
+        os.utime(path, (1, 1))
+    assert write_if_changed(path, chunks) is changed
+    assert path.read_bytes() == b"".join(chunks)
+    assert (os.stat(path).st_mtime == 1) is (not changed)
+    assert os.listdir(tmp_path) == ["out.xml"]
+
+
+def test_unchanged_large_prefix_is_copied_on_divergence(tmp_path):
+    path = tmp_path / "out.xml"
+    old = bytes(range(256)) * 20000
+    path.write_bytes(old)
+    new = old[:-10] + b"tail"
+    assert write_if_changed(path, [new[i:i + 65536] for i in range(0, len(new), 65536)])
+    assert path.read_bytes() == new
+
+
+def test_open_xmltv_keeps_old_file_on_error(tmp_path):
+    path = tmp_path / "epg.xml"
+    write_doc(path, ["a"])
+    old = path.read_bytes()
+    with pytest.raises(RuntimeError):
+        with open_xmltv(str(path), only_if_changed=True) as w:
+            w.write_programme("20240101000000 +0000", "20240101010000 +0000", "c", "outro", "")
+            raise RuntimeError("falha no meio")
+    assert path.read_bytes() == old and os.listdir(tmp_path) == ["epg.xml"]
@@ -0,0 +1,292 @@
+"""
+xmltv_writer.py
+
+Escritor incremental de XMLTV usado por epg_generator.py e build_epg_br.py.
+
+Cada <channel>/<programme> e escapado e gravado direto no arquivo de saida
+(buffer de I/O), sem montar a arvore inteira nem re-parsear com minidom so para
+indentar. Memoria e tempo de serializacao ficam lineares no numero de nos.
+
+Uso:
+  with open_xmltv("epg.xml", {"generator-info-name": "x"}) as w:
+      w.write_channel("globo.sp", "Globo SP")
+      w.write_programme(start, stop, "globo.sp", "Titulo", "Descricao")
+
+Com open_xmltv(..., only_if_changed=True) o documento e comparado em
+streaming com o arquivo existente e, se for identico, nada e gravado em disco
+(o destino fica intocado, inclusive o mtime); w.changed informa o resultado.
+"""
+
+import io
+import os
+from contextlib import contextmanager
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+def escape_text(s):
+    """Escapa texto de elemento (&, <, >)."""
+    if not s:
+        return ""
+    if "&" in s:
+        s = s.replace("&", "&amp;")
+    if "<" in s:
+        s = s.replace("<", "&lt;")
+    if ">" in s:
+        s = s.replace(">", "&gt;")
+    return s
+
+
+def escape_attr(s):
+    """Escapa valor de atributo (texto + aspas e quebras de linha)."""
+    s = escape_text(s)
+    if '"' in s:
+        s = s.replace('"', "&quot;")
+    if "\n" in s or "\r" in s or "\t" in s:
+        s = s.replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    return s
+
+
+def format_attrs(attrs):
+    """Serializa dict de atributos como ' k="v" ...' (ordem preservada)."""
+    if not attrs:
+        return ""
+    return "".join(f' {k}="{escape_attr(v)}"' for k, v in attrs.items() if v is not None)
+
+
+class XMLTVWriter:
+    """
+    Grava um documento <tv> incrementalmente em um arquivo binario.
+    indent: string de indentacao por nivel (ex. "  ") ou None/"" para saida compacta.
+    """
+
+    def __init__(self, fileobj, root_attrs=None, indent="  "):
+        self._out = io.TextIOWrapper(fileobj, encoding="utf-8", errors="xmlcharrefreplace",
+                                     newline="\n", write_through=False)
+        self.root_attrs = root_attrs or {}
+        self.indent = indent or ""
+        self._nl = "\n" if self.indent else ""
+        self.channels = 0
+        self.programmes = 0
+        self.changed = True
+        self.bytes_out = 0
+
+    def start(self):
+        self._out.write(XML_DECLARATION)
+        self._out.write(f"<tv{format_attrs(self.root_attrs)}>{self._nl}")
+
+    def end(self):
+        self._out.write("</tv>\n")
+        self._out.flush()
+        self._out.detach()
+
+    def write_raw(self, s):
+        """Grava texto XML ja serializado (responsabilidade do chamador)."""
+        self._out.write(s)
+
+    def write_bytes(self, data):
+        """Grava bytes utf-8 ja serializados (ex. fragmento renderizado antes)."""
+        self._out.flush()
+        self._out.buffer.write(data)
+
+    def write_channel(self, cid, display_names, icons=()):
+        """display_names: str ou lista de str; icons: lista de dicts de atributos."""
+        if isinstance(display_names, str):
+            display_names = [display_names]
+        ind, nl = self.indent, self._nl
+        parts = [f'{ind}<channel id="{escape_attr(cid)}">{nl}']
+        for dn in display_names:
+            parts.append(self._leaf(2, "display-name", None, dn))
+        for icon in icons:
+            parts.append(f"{ind * 2}<icon{format_attrs(icon)}/>{nl}")
+        parts.append(f"{ind}</channel>{nl}")
+        self._out.write("".join(parts))
+        self.channels += 1
+
+    def write_programme(self, start, stop, channel, title, desc):
+        """Caminho rapido para o programme simples (title + desc) do gerador."""
+        ind, nl = self.indent, self._nl
+        self._out.write(
+            f'{ind}<programme start="{escape_attr(start)}" stop="{escape_attr(stop)}" '
+            f'channel="{escape_attr(channel)}">{nl}'
+            f"{self._leaf(2, 'title', None, title)}"
+            f"{self._leaf(2, 'desc', None, desc)}"
+            f"{ind}</programme>{nl}"
+        )
+        self.programmes += 1
+
+    def write_programme_raw(self, start, stop, channel, raw):
+        """
+        <programme> com start/stop/channel do gerador e o restante copiado de raw
+        (atributos extras, filhos e fechamento ja serializados, ex. do EPG de origem).
+        """
+        self._out.write(f'{self.indent}<programme start="{escape_attr(start)}" stop="{escape_attr(stop)}" '
+                        f'channel="{escape_attr(channel)}"{raw}{self._nl}')
+        self.programmes += 1
+
+    def write_template(self, template, channel, name):
+        """Grava um ProgrammeTemplate para channel/name (uma formatacao por canal)."""
+        self._out.write(template.render(channel, name))
+        self.programmes += template.count
+
+    def write_element(self, elem, level=1):
+        """Serializa um ET.Element (e filhos) no nivel indicado; ignora tails."""
+        self._out.write(self._element(elem, level))
+        if level == 1:
+            if elem.tag == "channel":
+                self.channels += 1
+            elif elem.tag == "programme":
+                self.programmes += 1
+
+    def _leaf(self, level, tag, attrs, text):
+        pad = self.indent * level
+        if text:
+            return f"{pad}<{tag}{format_attrs(attrs)}>{escape_text(text)}</{tag}>{self._nl}"
+        return f"{pad}<{tag}{format_attrs(attrs)}/>{self._nl}"
+
+    def _element(self, elem, level):
+        children = list(elem)
+        if not children:
+            return self._leaf(level, elem.tag, elem.attrib, elem.text)
+        pad = self.indent * level
+        parts = [f"{pad}<{elem.tag}{format_attrs(elem.attrib)}>"]
+        text = (elem.text or "").strip() if self.indent else elem.text
+        if text:
+            parts.append(escape_text(text))
+        parts.append(self._nl)
+        for child in children:
+            parts.append(self._element(child, level + 1))
+        parts.append(f"{pad}</{elem.tag}>{self._nl}")
+        return "".join(parts)
+
+
+class ProgrammeTemplate:
+    """
+    Grade de <programme> pre-serializada, identica para varios canais exceto
+    pelo id e pelo nome (ex. placeholders do gerador). Horarios, indentacao e
+    textos fixos sao montados uma vez; render() so insere channel (atributo) e
+    name (texto), ambos escapados, com um unico str.format.
+    timeline: [(start, stop)] ja formatados; title_fmt/desc_fmt: str.format com
+    {name} e {n} (numero do bloco, a partir de 1).
+    """
+
+    def __init__(self, timeline, title_fmt, desc_fmt, indent="  "):
+        ind = indent or ""
+        nl = "\n" if ind else ""
+        pad = ind * 2
+        marker_ch, marker_name = "\x00C\x00", "\x00N\x00"
+        parts = []
+        for i, (start, stop) in enumerate(timeline):
+            title = title_fmt.format(name=marker_name, n=i + 1)
+            desc = desc_fmt.format(name=marker_name, n=i + 1)
+            parts.append(
+                f'{ind}<programme start="{escape_attr(start)}" stop="{escape_attr(stop)}" '
+                f'channel="{marker_ch}">{nl}'
+                f"{pad}<title>{escape_text(title)}</title>{nl}"
+                f"{pad}<desc>{escape_text(desc)}</desc>{nl}"
+                f"{ind}</programme>{nl}"
+            )
+        text = "".join(parts).replace("{", "{{").replace("}", "}}")
+        self.text = text.replace(marker_ch, "{0}").replace(marker_name, "{1}")
+        self.count = len(timeline)
+
+    def render(self, channel, name):
+        return self.text.format(escape_attr(channel), escape_text(name))
+
+
+def render_fragment(render, indent="  "):
+    """
+    Executa render(writer) num XMLTVWriter em memoria (sem <tv>) e retorna os
+    bytes gerados, prontos para XMLTVWriter.write_bytes.
+    """
+    buf = io.BytesIO()
+    w = XMLTVWriter(buf, indent=indent)
+    render(w)
+    w._out.flush()
+    w._out.detach()
+    return buf.getvalue()
+
+
+class WriteIfChanged(io.BufferedIOBase):
+    """
+    Destino binario de open_xmltv(only_if_changed=True). Compara cada bloco
+    gravado com o conteudo atual de path e so cria tmp na primeira diferenca
+    (copiando antes o prefixo igual do arquivo antigo); enquanto os bytes
+    coincidem nada e gravado. finish() diz se tmp deve substituir path.
+    """
+
+    def __init__(self, path, tmp):
+        super().__init__()
+        self.tmp = tmp
+        try:
+            self._old = open(path, "rb")
+        except FileNotFoundError:
+            self._old = None
+        self._out = open(tmp, "wb") if self._old is None else None
+        self._same = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._out is None:
+            if self._old.read(len(data)) == data:
+                self._same += len(data)
+                return len(data)
+            self._diverge()
+        return self._out.write(data)
+
+    def _diverge(self):
+        self._out = open(self.tmp, "wb")
+        self._old.seek(0)
+        left = self._same
+        while left:
+            chunk = self._old.read(min(left, 1 << 20))
+            if not chunk:
+                break
+            self._out.write(chunk)
+            left -= len(chunk)
+
+    def finish(self):
+        """Fecha os arquivos; True se o documento e novo ou difere do existente (tmp completo)."""
+        if self._out is None and self._old.read(1):
+            # documento novo e um prefixo do antigo
+            self._diverge()
+        changed = self._out is not None
+        self.close()
+        return changed
+
+    def close(self):
+        if not self.closed:
+            for f in (self._old, self._out):
+                if f is not None:
+                    f.close()
+        super().close()
+
+
+@contextmanager
+def open_xmltv(path, root_attrs=None, indent="  ", wrap=None, only_if_changed=False):
+    """
+    Abre path para escrita incremental e retorna um XMLTVWriter.
+    Grava em path + ".tmp" e so substitui o destino quando o documento fecha
+    sem erro, para nunca deixar um XML truncado no lugar do anterior.
+    wrap: opcional, funcao que envolve o arquivo binario (ex. run_metrics.TimedWriter).
+    only_if_changed: so grava se o conteudo diferir do path existente (WriteIfChanged);
+    ao sair, w.changed e False quando o arquivo foi mantido.
+    Ao sair, w.bytes_out e o tamanho gravado em path (0 quando mantido).
+    """
+    tmp = path + ".tmp"
+    try:
+        with (WriteIfChanged(path, tmp) if only_if_changed else open(tmp, "wb")) as f:
+            w = XMLTVWriter(wrap(f) if wrap else f, root_attrs, indent)
+            w.start()
+            yield w
+            w.end()
+            if only_if_changed:
+                w.changed = f.finish()
+        if w.changed:
+            w.bytes_out = os.path.getsize(tmp)
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)